@@ -1,66 +1,437 @@
-from fastapi import FastAPI, HTTPException
-from typing import List
+import time
+_IMPORT_STARTED = time.perf_counter() # before the other imports, to time the startup
+
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from pydantic import ValidationError
+import asyncio
+import json
+import numpy as np
 from uuid import UUID
 from pathlib import Path
 
-from app.utils.client import initialize_openai_client
-from app.utils.openai_config import OpenAIModels
-from app.utils.models import TextModel, MessageUpdateRequest
-from app.utils.prompts  import create_dynamic_prompt
-from app.utils.request_handler import handle_request
-
-app = FastAPI()
+from app.utils.client import initialize_async_openai_client
+from app.utils.compression import CompressionMiddleware
+from app.utils.embedding_cache import EmbeddingCache
+from app.utils.example_index import RetrievalBackend, get_index_manager
+from app.utils.local_embeddings import EmbeddingBackend, EmbeddingProvider, get_local_backend, local_index_path
+from app.utils.metrics import MetricsMiddleware, metrics, stage
+from app.utils.model_router import ModelRouter
+from app.utils.message_store import InMemoryMessageStore, SQLiteMessageStore
+from app.utils.openai_config import OpenAIModels, MODEL_RATE_LIMITS
+from app.utils.models import TextModel, MessageUpdateRequest, BatchTransformRequest, BatchItemResult, BatchTransformResponse, parse_fields
+from app.utils.prompt_renderer import PromptRenderer, RenderedPrompt, prompt_token_budget
+from app.utils.prompts  import aselect_examples_batch, aselect_examples_scored
+from app.utils.rate_limiter import CircuitOpenError, openai_circuit_breaker, openai_retry_budget
+from app.utils.request_handler import ahandle_request_stream
+from app.utils.response_cache import ResponseCache
+from app.utils.semantic_cache import SemanticCache, SemanticHit
+from app.utils.single_flight import SingleFlight
+from app.utils.startup import StartupTracker, warm_example_index, warm_tokenizers, warm_upstream
+from app.utils.token_bucket import rate_limiters
 
-# Initialize OpenAI client
-client = initialize_openai_client()
+# Initialize OpenAI client (async, so that waiting for the API does not block the event loop)
+client = initialize_async_openai_client()
 
 # Get model names
 LLM_MODEL = OpenAIModels.GPT4o_MINI  # OpenAIModels.GPT3_TURBO
 
 TEMPERATURE = 0 # LLM temperature
+
+# Model routing: a chat completion still running after the p95 latency of its model is hedged
+# with a duplicate call to HEDGE_MODEL (None: the same model), and the first answer wins.
+# Texts up to SHORT_TEXT_MAX_TOKENS tokens go to the fastest of ROUTING_MODELS (0: always LLM_MODEL).
+HEDGING = True
+HEDGE_MODEL = None # e.g. OpenAIModels.GPT3_TURBO
+MAX_HEDGE_RATIO = 0.1 # max share of the calls that are hedged
+SHORT_TEXT_MAX_TOKENS = 0
+ROUTING_MODELS = [LLM_MODEL] # e.g. [LLM_MODEL, OpenAIModels.GPT3_TURBO]
+model_router = ModelRouter(
+    LLM_MODEL,
+    models=ROUTING_MODELS,
+    hedge_model=HEDGE_MODEL,
+    hedging=HEDGING,
+    max_hedge_ratio=MAX_HEDGE_RATIO,
+    short_text_max_tokens=SHORT_TEXT_MAX_TOKENS)
 EMB_MODEL = OpenAIModels.TEXT_EMB_3_SMALL # Embedding model
 
 # Path to embedding database
 FOLDER = "./app/data_synthetic" # folder wiht generated synthetic data
 PATH_EMB_DB = Path(FOLDER, "embeddings.db")
 
-# Number of example to use as few-shots in the prompt
-NUM_EXAMPLES_TO_SELECT = 5
+# Embeddings used to select the examples: OpenAI (EMB_MODEL), or LOCAL to embed the user's text on the CPU
+# without a network round trip. LOCAL uses embeddings.local.db, built by "python -m app.scripts.build_local_index".
+EMBEDDING_PROVIDER = EmbeddingProvider.OPENAI
+
+# Seconds between two checks for a new version of the embedding database
+INDEX_POLL_INTERVAL = 30
+
+# Map the example index from the file next to the database (embeddings.mmap, written by build_embeddings_db
+# or "python -m app.scripts.build_mmap_index") instead of loading it in each worker: with "uvicorn --workers N",
+# the workers share one copy of the matrix and the texts in the page cache
+INDEX_MMAP = False
+
+# Number of candidate examples retrieved for the few-shots prompt: the token budget (PROMPT_MAX_TOKENS)
+# decides how many of them are used, so short examples leave room for more of them
+NUM_CANDIDATE_EXAMPLES = 20
+
+# Max number of prompt tokens: the most similar examples are included as long as they fit
+# (the budget is also limited by the context window of LLM_MODEL, see MODEL_TOKEN_LIMITS)
+PROMPT_MAX_TOKENS = 1_500
+prompt_renderer = PromptRenderer(LLM_MODEL, token_budget=prompt_token_budget(LLM_MODEL, PROMPT_MAX_TOKENS))
+
+# Max number of chat completions running at the same time for a batch request
+BATCH_CONCURRENCY = 8
+
+# Similarity search: exact, or approximate with the IVF index next to the database
+# (built with "python -m app.scripts.build_ann_index"; exact search is used if it is missing)
+RETRIEVAL_BACKEND = RetrievalBackend.EXACT
+IVF_NPROBE = 8 # number of IVF clusters scanned per request
+
+# Cache of the embeddings of the user's texts: in-process LRU, plus an optional SQLite file that survives restarts
+EMBEDDING_CACHE_SIZE = 10_000 # max number of embeddings kept in memory
+EMBEDDING_CACHE_TTL = 7 * 24 * 3600 # seconds
+EMBEDDING_CACHE_PATH = None # e.g. Path(FOLDER, "embedding_cache.db")
+embedding_cache = EmbeddingCache(
+    max_size=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    path=EMBEDDING_CACHE_PATH)
+
+# Cache of the LLM responses, used only for deterministic requests (TEMPERATURE = 0)
+RESPONSE_CACHE_SIZE = 1_000 # max number of responses kept in memory
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024 # max total size of the responses kept in memory
+RESPONSE_CACHE_TTL = 24 * 3600 # seconds
+RESPONSE_CACHE_PATH = None # e.g. Path(FOLDER, "response_cache.db")
+response_cache = ResponseCache(
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    path=RESPONSE_CACHE_PATH)
+
+# Semantic cache: a text whose embedding is close enough to a text already transformed, or to a dysfunctional
+# example of the database (cosine similarity >= SEMANTIC_CACHE_THRESHOLD), gets the same transformation
+# without an LLM call. Used only for deterministic requests (TEMPERATURE = 0), like the response cache.
+# The threshold is calibrated on the OpenAI embeddings: the cache is not used with EmbeddingProvider.LOCAL,
+# whose similarities (TF-IDF and SVD) are distributed differently and would match unrelated texts.
+SEMANTIC_CACHE_THRESHOLD = 0.97 # None: disabled
+SEMANTIC_CACHE_SIZE = 10_000 # max number of transformations kept (x 6 KB of embedding each with text-embedding-3-small)
+SEMANTIC_CACHE_TTL = 7 * 24 * 3600 # seconds
+semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    max_size=SEMANTIC_CACHE_SIZE,
+    ttl=SEMANTIC_CACHE_TTL) if SEMANTIC_CACHE_THRESHOLD is not None else None
+
+# Client-side rate limits (requests and tokens per minute) of the OpenAI models.
+# With a file path, the quota is shared by all the workers of the dyno.
+RATE_LIMIT_STATE_PATH = None # e.g. Path("/tmp/dailogy_rate_limits.db")
+rate_limiters.configure(MODEL_RATE_LIMITS, path=RATE_LIMIT_STATE_PATH)
+
+# Identical transformations in flight at the same time (e.g. a double submit) share one upstream computation
+transformations = SingleFlight()
+
+# Initializes "messages", i.e., a store of instances of TextModel, indexed by id.
+# In process memory by default; with a file path, in a SQLite file shared by all the workers
+# of the dyno, where the messages are written in the background (group commit).
+# The oldest messages are evicted beyond MESSAGES_MAX_SIZE, so memory stays bounded.
+MESSAGES_MAX_SIZE = 10_000
+MESSAGES_PAGE_MAX_LIMIT = 1_000 # max number of messages returned by a GET request
+EXPORT_PAGE_SIZE = 500 # messages read from the store per chunk of the NDJSON export
+
+# Responses of at least this size (in bytes) are compressed with gzip or deflate, when the client accepts it
+COMPRESSION_MIN_SIZE = 1024
+MESSAGE_STORE_PATH = None # e.g. Path(FOLDER, "messages.db")
+if MESSAGE_STORE_PATH is not None:
+    messages = SQLiteMessageStore(MESSAGE_STORE_PATH, max_size=MESSAGES_MAX_SIZE)
+else:
+    messages = InMemoryMessageStore(max_size=MESSAGES_MAX_SIZE)
+
+
+# Startup: before /ready answers 200, the example index is loaded and searched once, the tokenizers are loaded,
+# and connections to the OpenAI API are opened (best effort, within WARMUP_UPSTREAM_TIMEOUT seconds)
+WARMUP_UPSTREAM = True
+WARMUP_UPSTREAM_CONNECTIONS = 2
+WARMUP_UPSTREAM_TIMEOUT = 5
+startup = StartupTracker(started=_IMPORT_STARTED)
+
+
+def examples_source(load_embedder: bool = True) -> tuple[Path, EmbeddingBackend | None]:
+    # The examples database of the embedding provider, and the provider (None: the OpenAI API)
+    if EMBEDDING_PROVIDER == EmbeddingProvider.LOCAL:
+        path_examples = local_index_path(PATH_EMB_DB)
+        return path_examples, get_local_backend(path_examples) if load_embedder else None
+    return PATH_EMB_DB, None
+
+
+async def warm_up():
+    # Load the examples into the resident index once, at startup,
+    # so that requests do not pay for reading the database (required to be ready).
+    # Then load what the first requests would otherwise load lazily.
+    path_examples, _ = examples_source(load_embedder=False)
+    with startup.phase("example_index", required=True):
+        await asyncio.to_thread(warm_example_index, path_examples, RETRIEVAL_BACKEND, IVF_NPROBE)
+    if EMBEDDING_PROVIDER == EmbeddingProvider.LOCAL:
+        with startup.phase("local_embeddings", required=True):
+            await asyncio.to_thread(examples_source)
+    with startup.phase("tokenizers"):
+        await asyncio.to_thread(warm_tokenizers, [LLM_MODEL, EMB_MODEL, *ROUTING_MODELS])
+    if WARMUP_UPSTREAM:
+        with startup.phase("upstream_connections"):
+            await warm_upstream(client, WARMUP_UPSTREAM_CONNECTIONS, WARMUP_UPSTREAM_TIMEOUT)
+    startup.mark_ready()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background: the app answers "/" (liveness) at once, and "/ready" once it is warm.
+    # Then watch the database, to hot-reload the index when a new version is deployed.
+    path_examples, _ = examples_source(load_embedder=False)
+    index_manager = get_index_manager(path_examples)
+    index_manager.poll_interval = INDEX_POLL_INTERVAL
+    index_manager.use_mmap = INDEX_MMAP
+    warm_up_task = asyncio.create_task(warm_up())
+    index_manager.start()
+    yield
+    warm_up_task.cancel()
+    index_manager.stop()
+    embedding_cache.close()
+    response_cache.close()
+    messages.close()
+    await client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+startup.record("import", time.perf_counter() - _IMPORT_STARTED)
+
+# Compress the large and the streamed responses (inside the metrics middleware, so it is timed)
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+# Time the requests, and send the time spent in each stage in a Server-Timing header
+app.add_middleware(MetricsMiddleware)
+
+
+def collect_metrics() -> list[tuple]:
+    # Statistics kept by the caches, the single flight and the circuit breaker, rendered on /metrics
+    caches = {"embeddings": embedding_cache.stats(), "responses": response_cache.stats()}
+    semantic = []
+    if semantic_cache is not None:
+        caches["semantic"] = stats = semantic_cache.stats()
+        semantic = [
+            ("dailogy_semantic_cache_hits_total", "counter", "Semantic cache hits, by source of the reused transformation.",
+             [({"source": "history"}, stats["hits_history"]), ({"source": "corpus"}, stats["hits_corpus"])]),
+            ("dailogy_semantic_cache_evictions_total", "counter", "Transformations evicted from the semantic cache.",
+             [({}, stats["evictions"])]),
+            ("dailogy_semantic_cache_entries", "gauge", "Transformations in the semantic cache.", [({}, stats["size"])]),
+        ]
+    return [
+        ("dailogy_cache_hits_total", "counter", "Cache hits.",
+         [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("dailogy_cache_misses_total", "counter", "Cache misses.",
+         [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("dailogy_coalesced_requests_total", "counter", "Requests that waited for an identical transformation in flight.",
+         [({}, transformations.coalesced)]),
+        ("dailogy_circuit_breaker_open", "gauge", "1 if the circuit breaker of the OpenAI API is open.",
+         [({}, int(openai_circuit_breaker.state == openai_circuit_breaker.OPEN))]),
+        ("dailogy_messages", "gauge", "Messages in the store.", [({}, len(messages))]),
+        *semantic,
+    ]
+
+
+metrics.add_collector(collect_metrics)
 
-# Initializes "messages", i.e., an empty list used to store instances of TextModel
-messages: List[TextModel] = []
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to Dailogy API"}
 
 
+# Readiness: 503 until the startup warm-up is done, so the router can hold traffic until then ("/" is the liveness check)
+@app.get("/ready")
+async def ready():
+    status = startup.status()
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+
+# Metrics in the Prometheus text format: time per stage, tokens per model, retries, cache hits
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # The collectors query the message store, which may wait for a commit: off the event loop
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/admin/index")
+async def get_index_status():
+    path_examples, _ = examples_source(load_embedder=False)
+    return get_index_manager(path_examples).status()
+
+
+@app.get("/api/admin/cache")
+async def get_cache_stats():
+    return {
+        "embeddings": embedding_cache.stats(),
+        "responses": response_cache.stats(),
+        "semantic": semantic_cache.stats() if semantic_cache is not None else None,
+        "messages": messages.stats(),
+    }
+
+
+@app.get("/api/admin/prompts")
+async def get_prompt_stats():
+    return prompt_renderer.stats()
+
+
+@app.get("/api/admin/upstream")
+async def get_upstream_status():
+    return {
+        "circuit_breaker": openai_circuit_breaker.stats(),
+        "retry_budget": openai_retry_budget.stats(),
+        "rate_limiters": rate_limiters.stats(),
+        "single_flight": transformations.stats(),
+        "model_router": model_router.stats(),
+    }
+
+
+# Rebuild the example index in the background; the active version keeps serving requests meanwhile
+@app.post("/api/admin/index/reload", status_code=202)
+async def reload_index(force: bool = False):
+    path_examples, _ = examples_source(load_embedder=False)
+    index_manager = get_index_manager(path_examples)
+    if not path_examples.exists():
+        raise HTTPException(
+            status_code=404,
+            detail=f"embedding database {path_examples} does not exist"
+        )
+    started = index_manager.reload_in_background(force=force)
+    return {"started": started, **index_manager.status()}
+
+
+def message_projection(fields: str | None) -> set[str] | None:
+    # The fields of the messages to return (e.g. "id,transformed_text", to leave out the prompt)
+    try:
+        return parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+# List the messages, oldest first. With "limit", the messages are returned a page at a time:
+# the "X-Next-Cursor" header holds the "after" value of the next page (absent on the last page).
+# With "fields", only these fields of the messages are returned.
 @app.get("/api/messages/")
-async def get_messages():
-    return messages
+async def get_messages(
+    response: Response,
+    limit: int | None = Query(default=None, ge=1, le=MESSAGES_PAGE_MAX_LIMIT),
+    after: int | None = Query(default=None, ge=0),
+    fields: str | None = None,
+):
+    include = message_projection(fields)
+    page, next_cursor = await asyncio.to_thread(messages.page, limit=limit, after=after)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    if include is not None:
+        return [message.model_dump(mode="json", include=include) for message in page]
+    return page
+
+
+# Export the messages, oldest first, as NDJSON (one JSON object per line), streamed as they are read
+# from the store a page at a time: the memory used does not grow with the number of messages.
+# With "fields", only these fields of the messages are exported.
+@app.get("/api/messages/export")
+async def export_messages(fields: str | None = None):
+    include = message_projection(fields)
+
+    async def lines():
+        cursor = None
+        while True:
+            page, cursor = await asyncio.to_thread(messages.page, limit=EXPORT_PAGE_SIZE, after=cursor)
+            if page:
+                yield "".join(json.dumps(message.model_dump(mode="json", include=include)) + "\n" for message in page)
+            if cursor is None:
+                break
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="messages.ndjson"'}
+    )
+
+
+async def render_prompt(original_text: str) -> tuple[RenderedPrompt, SemanticHit | None, np.ndarray]:
+    # Select the examples most similar to the text, and render the prompt within the token budget.
+    # With the semantic cache, also look for a known text close enough to reuse its transformation.
+    path_examples, embedder = examples_source()
+    selected_examples, similarities, input_embedding = await aselect_examples_scored(
+        text=original_text,
+        path_emb=path_examples,
+        emb_model=EMB_MODEL,
+        client=client,
+        num_examples=NUM_CANDIDATE_EXAMPLES,
+        backend=RETRIEVAL_BACKEND,
+        nprobe=IVF_NPROBE,
+        embedding_cache=embedding_cache,
+        embedder=embedder)
+    prompt = prompt_renderer.render(original_text, selected_examples)
+
+    hit = None
+    cache = active_semantic_cache()
+    if cache is not None:
+        # The closest example of the database is a candidate too
+        corpus_match = (similarities[0], selected_examples[0]["dysfunctional"], selected_examples[0]["functional"]) \
+            if selected_examples else None
+        with stage("semantic_cache"):
+            hit = await asyncio.to_thread(cache.lookup, input_embedding, TEMPERATURE, corpus_match)
+    return prompt, hit, input_embedding
+
+
+def active_semantic_cache() -> SemanticCache | None:
+    # The semantic cache, if it is used with the configured embeddings (see SEMANTIC_CACHE_THRESHOLD)
+    if EMBEDDING_PROVIDER == EmbeddingProvider.LOCAL:
+        return None
+    return semantic_cache
+
+
+async def transform_text(original_text: str) -> tuple[RenderedPrompt, str, bool, OpenAIModels | None, SemanticHit | None]:
+    # Generate prompt
+    prompt, hit, input_embedding = await render_prompt(original_text)
+    if hit is not None:
+        return prompt, hit.transformed_text, True, None, hit
+
+    # Generate tranformed text using LLM from OpenAI API (the model is chosen by the router)
+    transformed_text, _, from_cache, model = await model_router.ahandle_request(
+        prompt=prompt.text,
+        client=client,
+        temperature=TEMPERATURE,
+        response_cache=response_cache,
+        user_text=original_text
+    )
+    if active_semantic_cache() is not None:
+        semantic_cache.add(input_embedding, original_text, transformed_text, TEMPERATURE)
+    return prompt, transformed_text, from_cache, model, None
 
 
 # Transform text
 @app.post("/api/messages/", response_model=TextModel)
-async def transform_message(text_model: TextModel):
+async def transform_message(text_model: TextModel, response: Response):
     try:
-        # Generate prompt
-        prompt = create_dynamic_prompt(
-            user_text=text_model.original_text,
-            path_emb=PATH_EMB_DB,
-            emb_model=EMB_MODEL,
-            client=client,
-            num_examples=NUM_EXAMPLES_TO_SELECT)
-        text_model.prompt = prompt
-
-        # Generate tranformed text using LLM from OpenAI API
-        transformed_text, _ = handle_request(
-            prompt=text_model.prompt,
-            client=client,
-            model=LLM_MODEL,
-            temperature=TEMPERATURE
-        )
+        # Concurrent requests with the same text wait for the same transformation;
+        # each of them still stores its own message
+        (prompt, transformed_text, from_cache, model, hit), _ = await transformations.do(
+            (LLM_MODEL, TEMPERATURE, text_model.original_text),
+            lambda: transform_text(text_model.original_text))
+        text_model.prompt = prompt.text
+        response.headers["X-Prompt-Tokens"] = str(prompt.tokens)
+        response.headers["X-Prompt-Tokens-Saved"] = str(prompt.tokens_saved)
+        # Set by the server only (a value sent by the client is ignored)
+        text_model.semantic_similarity = hit.similarity if hit is not None else None
+        if hit is not None:
+            # No LLM call: the transformation of a known text was reused
+            response.headers["X-Semantic-Cache"] = hit.source
+        else:
+            response.headers["X-LLM-Model"] = getattr(model, "value", model)
         text_model.transformed_text = transformed_text
+        text_model.from_cache = from_cache
 
         messages.append(text_model)
 
@@ -69,19 +440,166 @@ async def transform_message(text_model: TextModel):
             "original_text": text_model.original_text,
             "prompt": text_model.prompt,
             "transformed_text": text_model.transformed_text,
+            "from_cache": text_model.from_cache,
+            "semantic_similarity": text_model.semantic_similarity,
             }
     
+    # If the OpenAI API is down, fail fast and tell the client when to retry
+    except CircuitOpenError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+
     # If something goes wrong, return a 500 error and a message
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def format_sse(event: str, data: dict) -> str:
+    # A server-sent event
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Transform text, streaming the transformed text as server-sent events while it is generated:
+# - "start": {"id"} once the prompt is ready,
+# - "delta": {"text"} for each piece of transformed text,
+# - "done": {"message", "token_usage", "prompt"} when the message is stored,
+# - "error": {"detail"} if the generation fails.
+@app.post("/api/messages/stream")
+async def transform_message_stream(text_model: TextModel):
+    try:
+        # Generate prompt (before streaming, so that errors get a proper status code)
+        prompt, hit, input_embedding = await render_prompt(text_model.original_text)
+        text_model.prompt = prompt.text
+        text_model.semantic_similarity = hit.similarity if hit is not None else None
+    except CircuitOpenError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        yield format_sse("start", {"id": str(text_model.id)})
+        try:
+            if hit is not None:
+                # No LLM call: the transformation of a known text is sent in one piece
+                yield format_sse("delta", {"text": hit.transformed_text})
+                transformed_text, token_usage, from_cache = hit.transformed_text, (0, 0, 0), True
+            else:
+                async for item in ahandle_request_stream(
+                    prompt=text_model.prompt,
+                    client=client,
+                    # Streamed completions are routed, but not hedged
+                    model=model_router.choose(text_model.original_text),
+                    temperature=TEMPERATURE,
+                    response_cache=response_cache
+                ):
+                    if isinstance(item, str):
+                        yield format_sse("delta", {"text": item})
+                    else:
+                        transformed_text, token_usage, from_cache = item
+                if active_semantic_cache() is not None:
+                    semantic_cache.add(input_embedding, text_model.original_text, transformed_text, TEMPERATURE)
+
+            text_model.transformed_text = transformed_text
+            text_model.from_cache = from_cache
+            messages.append(text_model)
+
+            completion_tokens, prompt_tokens, total_tokens = token_usage
+            yield format_sse("done", {
+                "message": text_model.model_dump(mode="json"),
+                "token_usage": {
+                    "completion_tokens": completion_tokens,
+                    "prompt_tokens": prompt_tokens,
+                    "total_tokens": total_tokens,
+                },
+                "prompt": prompt.info(),
+            })
+        except Exception as e:
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Don't let proxies buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Transform several texts: one embedding call and one similarity search for the whole batch,
+# then the chat completions run concurrently. A failed item does not fail the batch.
+@app.post("/api/messages/batch", response_model=BatchTransformResponse)
+async def transform_messages_batch(batch: BatchTransformRequest):
+    results = [BatchItemResult(index=i) for i in range(len(batch.texts))]
+
+    # Validate each text on its own
+    text_models = {}
+    for i, text in enumerate(batch.texts):
+        try:
+            text_models[i] = TextModel(original_text=text)
+        except ValidationError as e:
+            results[i].error = str(e)
+
+    if text_models:
+        try:
+            path_examples, embedder = examples_source()
+            selected_examples = await aselect_examples_batch(
+                texts=[text_model.original_text for text_model in text_models.values()],
+                path_emb=path_examples,
+                emb_model=EMB_MODEL,
+                client=client,
+                num_examples=NUM_CANDIDATE_EXAMPLES,
+                backend=RETRIEVAL_BACKEND,
+                nprobe=IVF_NPROBE,
+                embedding_cache=embedding_cache,
+                embedder=embedder)
+        except CircuitOpenError as e:
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+                headers={"Retry-After": str(max(1, round(e.retry_after)))}
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def transform(i: int, text_model: TextModel, examples: list[dict]):
+            try:
+                text_model.prompt = prompt_renderer.render(text_model.original_text, examples).text
+                async with semaphore:
+                    transformed_text, _, from_cache, _ = await model_router.ahandle_request(
+                        prompt=text_model.prompt,
+                        client=client,
+                        temperature=TEMPERATURE,
+                        response_cache=response_cache,
+                        user_text=text_model.original_text
+                    )
+                text_model.transformed_text = transformed_text
+                text_model.from_cache = from_cache
+                messages.append(text_model)
+                results[i].message = text_model
+            except Exception as e:
+                results[i].error = str(e)
+
+        # Each transformation records its own error: one failure must not leave the others unretrieved
+        await asyncio.gather(*(
+            transform(i, text_model, examples)
+            for (i, text_model), examples in zip(text_models.items(), selected_examples)
+        ), return_exceptions=True)
+
+    return BatchTransformResponse(results=results)
+
+
 @app.delete("/api/messages/{message_id}")
 async def delete_message(message_id: UUID):
-    for message in messages:
-        if message.id == message_id:
-            messages.remove(message)
-            return
+    if await asyncio.to_thread(messages.delete, message_id):
+        return
     raise HTTPException(
         status_code=404,
         detail=f"message with id: {message_id} does not exist"
@@ -90,15 +608,8 @@ async def delete_message(message_id: UUID):
 
 @app.put("/api/messages/{message_id}")
 async def update_message(message_update: MessageUpdateRequest, message_id: UUID):
-    for message in messages:
-        if message.id == message_id:
-            if message_update.original_text is not None:
-                message.original_text = message_update.original_text
-            if message_update.prompt is not None:
-                message.prompt = message_update.prompt
-            if message_update.transformed_text is not None:
-                message.transformed_text = message_update.transformed_text
-            return
+    if await asyncio.to_thread(messages.update, message_id, **message_update.model_dump(exclude_none=True)):
+        return
     raise HTTPException(
         status_code=404,
         detail=f"message with id: {message_id} does not exist"
@@ -0,0 +1,58 @@
+"""
+Benchmark the CPU-side stages of the example selection and of the prompt assembly on synthetic corpora,
+and write the results as JSON, to compare them across commits.
+
+Usage:
+    python -m app.scripts.benchmark --sizes 1000 10000 100000 --output bench/results.json
+    python -m app.scripts.benchmark --sizes 1000 10000 100000 --compare bench/baseline.json --threshold 0.2
+
+The corpora (random embeddings of dimension --dim) are cached in --data-dir; 1M examples at the
+real dimension take about 6 GiB on disk, and as much memory to load.
+With --compare, the script exits with status 1 if a stage is slower than the baseline by more than --threshold.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from app.utils.benchmark import EMBEDDING_DIM, compare_results, run_benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the retrieval and the prompt assembly.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="numbers of examples")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="dimension of the embeddings")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=Path, default=Path("bench/data"), help="folder of the synthetic corpora")
+    parser.add_argument("--output", type=Path, default=None, help="JSON file for the results")
+    parser.add_argument("--compare", type=Path, default=None, help="JSON results of a baseline run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.data_dir, dim=args.dim, repeat=args.repeat, seed=args.seed,
+                            progress=lambda message: print(f"Benchmarking {message}", file=sys.stderr))
+
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"Saved to {args.output}", file=sys.stderr)
+
+    print(f"\n{'examples':>10} {'stage':<22} {'median ms':>11} {'peak MiB':>10}")
+    for size, stages in report["results"].items():
+        for stage, timing in stages.items():
+            peak = f"{timing['peak_mib']:.1f}" if timing["peak_mib"] is not None else "-"
+            print(f"{size:>10} {stage:<22} {timing['median_ms']:>11.3f} {peak:>10}")
+
+    if args.compare is not None:
+        rows = compare_results(json.loads(args.compare.read_text()), report, threshold=args.threshold)
+        print(f"\n{'examples':>10} {'stage':<22} {'baseline':>10} {'current':>10} {'ratio':>7}")
+        for row in rows:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['size']:>10} {row['stage']:<22} {row['baseline']:>10.3f} {row['current']:>10.3f} {row['ratio']:>7.2f}{flag}")
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Build the IVF (approximate nearest-neighbour) index of an embedding database and report its recall@k
+against the exact search.
+
+Usage:
+    python -m app.scripts.build_ann_index app/data_synthetic/embeddings.db --n-lists 1024 --nprobe 16
+
+The index is saved next to the database (embeddings.ivf.npz). The running app picks it up with the
+next snapshot of the example index (or on POST /api/admin/index/reload), when RETRIEVAL_BACKEND is IVF.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.ann_index import IVFIndex, ann_index_path, recall_report
+from app.utils.example_index import ExampleIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the IVF index of an embedding database.")
+    parser.add_argument("path_emb", type=Path, help="database with the examples and their embeddings")
+    parser.add_argument("--n-lists", type=int, default=None, help="number of clusters (default: sqrt of the corpus size)")
+    parser.add_argument("--n-iter", type=int, default=20, help="k-means iterations")
+    parser.add_argument("--nprobe", type=int, default=8, help="default number of clusters scanned per query")
+    parser.add_argument("--k", type=int, default=5, help="k of the recall@k report")
+    parser.add_argument("--num-queries", type=int, default=200, help="queries of the recall report")
+    parser.add_argument("--noise", type=float, default=0.5, help="noise added to the corpus rows used as queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-only", action="store_true", help="evaluate the existing index without rebuilding it")
+    args = parser.parse_args()
+
+    index = ExampleIndex.from_db(args.path_emb)
+    path_ann = ann_index_path(args.path_emb)
+
+    if args.report_only:
+        ann = IVFIndex.load(path_ann)
+    else:
+        start = time.perf_counter()
+        ann = IVFIndex.build(index.ids, index.matrix, n_lists=args.n_lists, n_iter=args.n_iter, seed=args.seed, nprobe=args.nprobe)
+        print(f"Built IVF index with {ann.n_lists} lists over {len(index)} examples in {time.perf_counter() - start:.1f} s")
+        ann.save(path_ann)
+        print(f"Saved to {path_ann}")
+    index.attach_ann(ann)
+
+    # Queries: corpus rows with random noise, so they are not identical to an example
+    rng = np.random.default_rng(args.seed)
+    rows = rng.choice(len(index), min(args.num_queries, len(index)), replace=False)
+    queries = index.matrix[rows] + rng.normal(scale=args.noise / np.sqrt(index.dim), size=(len(rows), index.dim))
+
+    print(f"\n{'nprobe':>8} {f'recall@{args.k}':>10} {'exact ms':>10} {'ivf ms':>10}")
+    for row in recall_report(index, queries, k=args.k):
+        print(f"{row['nprobe']:>8} {row[f'recall@{args.k}']:>10.3f} {row['exact_ms']:>10.3f} {row['ann_ms']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
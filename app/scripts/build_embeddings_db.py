@@ -0,0 +1,76 @@
+"""
+Build (or extend) the embedding database from files of dysfunctional/functional pairs.
+
+Usage:
+    python -m app.scripts.build_embeddings_db pairs.csv more_pairs.jsonl --output app/data_synthetic/embeddings.db
+
+The files have the fields "dysfunctional" and "functional" (a header row for .csv, one JSON object
+per line for .jsonl). Pairs already in the database are not embedded again. The build works on
+embeddings.db.building: if it is interrupted, run the same command again to resume it.
+When it is done, the database is replaced atomically and the running app hot-reloads it.
+Its memory-mapped index (embeddings.mmap, see INDEX_MMAP in app/main.py) is written next to it.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from pathlib import Path
+
+from app.utils.client import initialize_async_openai_client
+from app.utils.corpus_builder import EmbeddingsDbBuilder, iter_pairs
+from app.utils.mmap_index import mmap_index_path
+from app.utils.openai_config import OpenAIModels, MODEL_RATE_LIMITS
+from app.utils.token_bucket import rate_limiters
+
+
+async def build(args):
+    client = initialize_async_openai_client()
+    builder = EmbeddingsDbBuilder(
+        args.output, args.model, client,
+        batch_size=args.batch_size, concurrency=args.concurrency, write_mmap=not args.no_mmap)
+    try:
+        if builder.resumed:
+            print(f"Resuming the build in {builder.work_path} ({builder.pending()} pairs queued)")
+
+        start = time.perf_counter()
+        counts = builder.ingest(itertools.chain.from_iterable(iter_pairs(path) for path in args.inputs))
+        print(f"Read {counts['read']} pairs, queued {counts['queued']} new ones in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+
+        def progress(done, total):
+            elapsed = time.perf_counter() - start
+            print(f"\rEmbedded {done}/{total} pairs ({done / elapsed:.0f}/s)", end="", flush=True)
+
+        embedded = await builder.embed(progress)
+        if embedded:
+            print()
+        count = builder.finalize()
+        print(f"Wrote {args.output} with {count} examples")
+        if not args.no_mmap:
+            print(f"Wrote {mmap_index_path(args.output)}")
+    except BaseException:
+        builder.close()
+        raise
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the embedding database from files of dysfunctional/functional pairs.")
+    parser.add_argument("inputs", type=Path, nargs="+", help=".csv or .jsonl files with the pairs")
+    parser.add_argument("--output", type=Path, default=Path("app/data_synthetic/embeddings.db"), help="database to build or extend")
+    parser.add_argument("--model", type=OpenAIModels, default=OpenAIModels.TEXT_EMB_3_SMALL, help="embedding model")
+    parser.add_argument("--batch-size", type=int, default=1_000, help="texts per embeddings API call (at most 2048)")
+    parser.add_argument("--concurrency", type=int, default=4, help="API calls running at the same time")
+    parser.add_argument("--no-mmap", action="store_true", help="do not write the memory-mapped index of the database")
+    parser.add_argument("--rate-limit-state", type=Path, default=None,
+                        help="SQLite file of the rate limiters, to share the quota with the app (RATE_LIMIT_STATE_PATH)")
+    args = parser.parse_args()
+
+    rate_limiters.configure(MODEL_RATE_LIMITS, path=args.rate_limit_state)
+    asyncio.run(build(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Build the local embedding model and the example database embedded with it, then report how often
+it selects the same examples as the OpenAI embeddings.
+
+Usage:
+    python -m app.scripts.build_local_index app/data_synthetic/embeddings.db --n-components 128
+
+The database is written next to the source (embeddings.local.db). Set
+`EMBEDDING_PROVIDER = EmbeddingProvider.LOCAL` in app/main.py to use it: the user's text is then
+embedded on the CPU, without calling the OpenAI API.
+"""
+import argparse
+import time
+from pathlib import Path
+
+from app.utils.example_index import ExampleIndex
+from app.utils.local_embeddings import LocalEmbeddingBackend, build_local_index, local_index_path, overlap_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local embedding model and its example database.")
+    parser.add_argument("path_emb", type=Path, help="database with the examples and their OpenAI embeddings")
+    parser.add_argument("--output", type=Path, default=None, help="database to write (default: <path_emb>.local.db)")
+    parser.add_argument("--n-features", type=int, default=2 ** 15, help="number of hashed n-gram features")
+    parser.add_argument("--n-components", type=int, default=128, help="dimension of the local embeddings")
+    parser.add_argument("--k", type=int, default=5, help="k of the overlap@k report")
+    parser.add_argument("--num-queries", type=int, default=500, help="examples used as queries of the report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-only", action="store_true", help="evaluate the existing local database without rebuilding it")
+    args = parser.parse_args()
+
+    output = args.output or local_index_path(args.path_emb)
+    if args.report_only:
+        backend = LocalEmbeddingBackend.load(output)
+    else:
+        start = time.perf_counter()
+        backend = build_local_index(args.path_emb, output, n_features=args.n_features, n_components=args.n_components, seed=args.seed)
+        print(f"Built {output} ({backend.dim} dimensions) in {time.perf_counter() - start:.1f} s")
+
+    report = overlap_report(
+        ExampleIndex.from_db(args.path_emb), ExampleIndex.from_db(output), backend,
+        num_queries=args.num_queries, k=args.k, seed=args.seed)
+    print(f"overlap@{args.k} with the OpenAI embeddings: {report[f'overlap@{args.k}']:.3f} ({report['num_queries']} queries)")
+    print(f"local embedding latency: {report['embed_ms_mean']:.3f} ms mean, {report['embed_ms_p95']:.3f} ms p95")
+
+
+if __name__ == "__main__":
+    main()
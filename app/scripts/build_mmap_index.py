@@ -0,0 +1,36 @@
+"""
+Write the memory-mapped index of an embedding database: the normalized embedding matrix, the ids and
+the texts in one file that all the workers map read-only, so the page cache holds a single copy.
+
+Usage:
+    python -m app.scripts.build_mmap_index app/data_synthetic/embeddings.db
+
+The index is saved next to the database (embeddings.mmap). build_embeddings_db writes it too; run this
+script for a database built or converted otherwise (e.g. embeddings.local.db). The running app maps it
+with the next snapshot of the example index when INDEX_MMAP is True, and loads the examples from the
+database as long as the index is missing or was built from another version of the database.
+"""
+import argparse
+import time
+from pathlib import Path
+
+from app.utils.example_index import ExampleIndex, build_mmap_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the memory-mapped index of an embedding database.")
+    parser.add_argument("path_emb", type=Path, help="database with the examples and their embeddings")
+    parser.add_argument("--output", type=Path, default=None, help="file to write (default: next to the database, .mmap)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = build_mmap_index(args.path_emb, args.output)
+    print(f"Wrote {path} ({path.stat().st_size / 1e6:.1f} MB) in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    index = ExampleIndex.from_mmap(path)
+    print(f"Mapped {len(index)} examples of dimension {index.dim} in {1000 * (time.perf_counter() - start):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+One-shot conversion of an embedding database from the JSON embedding column to float32 BLOBs.
+
+Usage:
+    python -m app.scripts.convert_embeddings_db app/data_synthetic/embeddings.db app/data_synthetic/embeddings.f32.db
+
+Then replace embeddings.db with the converted file (e.g. with `mv`, which is atomic):
+the running app picks up the new version without a restart.
+"""
+import argparse
+import time
+from pathlib import Path
+
+from app.utils.embedding_store import convert_embeddings_db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the JSON embeddings of an examples database into float32 BLOBs.")
+    parser.add_argument("src", type=Path, help="database with the JSON embedding column")
+    parser.add_argument("dst", type=Path, help="database to create with the float32 embedding column")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="rows converted per batch")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = convert_embeddings_db(args.src, args.dst, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    src_size = args.src.stat().st_size
+    dst_size = args.dst.stat().st_size
+    print(f"Converted {count} examples in {elapsed:.1f} s")
+    print(f"Size: {src_size / 1e6:.1f} MB -> {dst_size / 1e6:.1f} MB ({dst_size / src_size:.0%})")
+
+
+if __name__ == "__main__":
+    main()
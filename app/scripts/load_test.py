@@ -0,0 +1,79 @@
+"""
+Drive POST /api/messages/ of a running app at a target rate or concurrency, and report the latency
+percentiles, the throughput, the error rate and the number of upstream (OpenAI) calls.
+
+Usage:
+    python -m app.scripts.load_test http://127.0.0.1:8000 --rps 20 --duration 30 --mock-url http://127.0.0.1:8001
+    python -m app.scripts.load_test http://127.0.0.1:8000 --concurrency 50 --num-requests 2000 --texts texts.txt
+
+With --mock-url (see app.scripts.mock_openai_server), the calls received by the mock are counted.
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+
+import httpx
+
+from app.utils.load_generator import run_load
+
+# Used when no --texts file is given
+DEFAULT_TEXTS = [
+    "You never listen to me when I talk about my day.",
+    "Why do I always have to be the one who cleans the kitchen?",
+    "You forgot to pick up the kids again, as usual.",
+    "Whatever, do what you want, you always do anyway.",
+    "I can't believe you spent that much money without asking me.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app.")
+    parser.add_argument("url", help="base URL of the app")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rps", type=float, help="requests per second (open loop)")
+    mode.add_argument("--concurrency", type=int, help="concurrent clients (closed loop)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds of load (default: 30 without --num-requests)")
+    parser.add_argument("--num-requests", type=int, default=None, help="number of requests to send")
+    parser.add_argument("--texts", type=Path, default=None, help="file with one original text per line")
+    parser.add_argument("--unique", action="store_true", help="make every text unique (defeats the response caches)")
+    parser.add_argument("--timeout", type=float, default=60, help="timeout of a request, in seconds")
+    parser.add_argument("--mock-url", default=None, help="base URL of the mock OpenAI server, to count the upstream calls")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    texts = DEFAULT_TEXTS
+    if args.texts is not None:
+        texts = [line.strip() for line in args.texts.read_text(encoding="utf-8").splitlines() if line.strip()]
+    if args.unique:
+        texts = [f"{text} ({i})" for i, text in enumerate(texts * 200)]
+    duration = args.duration if args.duration is not None or args.num_requests is not None else 30
+
+    if args.mock_url:
+        httpx.post(f"{args.mock_url}/stats/reset")
+
+    report = asyncio.run(run_load(
+        args.url, texts, rps=args.rps, concurrency=args.concurrency, duration=duration,
+        num_requests=args.num_requests, timeout=args.timeout))
+    summary = report.summary()
+
+    if args.mock_url:
+        upstream = httpx.get(f"{args.mock_url}/stats").json()
+        summary["upstream"] = upstream
+        summary["upstream_calls_per_request"] = sum(upstream["calls"].values()) / max(1, report.requests)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    latency = summary["latency_ms"]
+    print(f"requests   {summary['requests']} in {summary['duration_s']:.1f} s ({summary['throughput_rps']:.1f} req/s)")
+    print(f"errors     {summary['errors']} ({100 * summary['error_rate']:.2f} %)  statuses: {summary['statuses']}")
+    print(f"latency    p50 {latency['p50']:.0f} ms  p95 {latency['p95']:.0f} ms  p99 {latency['p99']:.0f} ms  max {latency['max']:.0f} ms")
+    if args.mock_url:
+        print(f"upstream   {summary['upstream']['calls']}  ({summary['upstream_calls_per_request']:.2f} calls per request), "
+              f"429: {summary['upstream']['rate_limited']}, 500: {summary['upstream']['server_errors']}")
+
+
+if __name__ == "__main__":
+    main()
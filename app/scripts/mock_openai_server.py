@@ -0,0 +1,48 @@
+"""
+Run a local stand-in for the OpenAI embeddings and chat completions endpoints, for load tests.
+
+Usage:
+    python -m app.scripts.mock_openai_server --port 8001 --chat-median-ms 400 --chat-p99-ms 2000 --rate-limit-ratio 0.02
+
+Then start the app against it (its embedding database must have the same dimension, --embedding-dim):
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=sk-mock uvicorn app.main:app --port 8000
+
+GET /stats returns the number of calls received, and POST /stats/reset resets it.
+"""
+import argparse
+
+import uvicorn
+
+from app.utils.mock_openai import LatencyModel, MockOpenAI
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock of the OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--embedding-median-ms", type=float, default=60, help="median latency of an embeddings call")
+    parser.add_argument("--embedding-p99-ms", type=float, default=300, help="p99 latency of an embeddings call")
+    parser.add_argument("--chat-median-ms", type=float, default=400, help="median latency of a chat completion (first token)")
+    parser.add_argument("--chat-p99-ms", type=float, default=2000, help="p99 latency of a chat completion (first token)")
+    parser.add_argument("--token-ms", type=float, default=20, help="delay between two streamed chunks")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of the calls answered with 429")
+    parser.add_argument("--server-error-ratio", type=float, default=0.0, help="share of the calls answered with 500")
+    parser.add_argument("--retry-after-ms", type=float, default=100, help="delay requested by the 429 responses")
+    parser.add_argument("--embedding-dim", type=int, default=1536, help="dimension of the embeddings")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockOpenAI(
+        embedding_latency=LatencyModel(args.embedding_median_ms, args.embedding_p99_ms),
+        chat_latency=LatencyModel(args.chat_median_ms, args.chat_p99_ms),
+        token_ms=args.token_ms,
+        rate_limit_ratio=args.rate_limit_ratio,
+        server_error_ratio=args.server_error_ratio,
+        retry_after_ms=args.retry_after_ms,
+        embedding_dim=args.embedding_dim,
+        seed=args.seed)
+    uvicorn.run(mock.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
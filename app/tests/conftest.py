@@ -0,0 +1,130 @@
+import asyncio
+import json
+import sqlite3
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+
+def create_embeddings_db(path, embeddings):
+    """Write a small examples database with the JSON embedding column used by embeddings.db."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE examples (id INTEGER PRIMARY KEY, dysfunctional TEXT, embedding TEXT, functional TEXT)")
+    conn.executemany(
+        "INSERT INTO examples (id, dysfunctional, embedding, functional) VALUES (?, ?, ?, ?)",
+        [
+            (i + 1, f"dysfunctional {i + 1}", json.dumps([float(x) for x in embedding]), f"functional {i + 1}")
+            for i, embedding in enumerate(embeddings)
+        ]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def embeddings():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(200, 32))
+
+
+@pytest.fixture
+def emb_db(tmp_path, embeddings):
+    return create_embeddings_db(tmp_path / "embeddings.db", embeddings)
+
+
+class FakeAsyncOpenAI:
+    """Async stand-in for the OpenAI client: embeddings from a fixed table, echoing chat completions."""
+
+    def __init__(self, embeddings):
+        self.table = embeddings
+        self.embedding_calls = []
+        self.chat_calls = 0
+        self.model_list_calls = 0
+        self.embeddings = SimpleNamespace(create=self.create_embeddings)
+        self.models = SimpleNamespace(list=self.list_models)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat))
+
+    async def create_embeddings(self, input, model):
+        self.embedding_calls.append(list(input))
+        data = [SimpleNamespace(index=i, embedding=list(self.table[len(text) % len(self.table)])) for i, text in enumerate(input)]
+        return SimpleNamespace(data=data, usage=SimpleNamespace(total_tokens=10 * len(input)))
+
+    async def list_models(self):
+        self.model_list_calls += 1
+        return SimpleNamespace(data=[])
+
+    async def create_chat(self, model, messages, temperature, stream=False, **kwargs):
+        self.chat_calls += 1
+        await asyncio.sleep(0.01)
+        user_text = messages[-1]["content"].strip().splitlines()[-1].strip()
+        if "FAIL" in user_text:
+            raise ValueError("upstream refused the text")
+        content = f"functional: {user_text}"
+        usage = SimpleNamespace(completion_tokens=5, prompt_tokens=100, total_tokens=105)
+        if stream:
+            return FakeAsyncStream(content, usage)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=usage)
+
+
+class FakeAsyncStream:
+    """Stream of chat completion chunks, one word per chunk, then a chunk with the usage."""
+
+    def __init__(self, content, usage):
+        words = content.split(" ")
+        self.chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word if i == 0 else " " + word))])
+            for i, word in enumerate(words)
+        ]
+        self.chunks.append(SimpleNamespace(choices=[], usage=usage))
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def reset_openai_breaker():
+    """The circuit breaker and the retry budget are shared by the process: isolate the tests from each other."""
+    from app.utils.rate_limiter import openai_circuit_breaker, openai_retry_budget
+
+    yield
+    with openai_circuit_breaker._lock:
+        openai_circuit_breaker.state = openai_circuit_breaker.CLOSED
+        openai_circuit_breaker.failures = 0
+        openai_circuit_breaker._trial_in_flight = False
+    openai_retry_budget.tokens = openai_retry_budget.max_tokens
+
+
+@pytest.fixture
+def fake_app(monkeypatch, emb_db, embeddings):
+    """Point app.main at a fake OpenAI client, the test database, and empty messages and caches."""
+    import app.main as main
+    from app.utils.embedding_cache import EmbeddingCache
+    from app.utils.message_store import InMemoryMessageStore
+    from app.utils.model_router import ModelRouter
+    from app.utils.response_cache import ResponseCache
+    from app.utils.single_flight import SingleFlight
+
+    fake_client = FakeAsyncOpenAI(embeddings)
+    monkeypatch.setattr(main, "client", fake_client)
+    monkeypatch.setattr(main, "PATH_EMB_DB", emb_db)
+    monkeypatch.setattr(main, "messages", InMemoryMessageStore())
+    monkeypatch.setattr(main, "embedding_cache", EmbeddingCache())
+    monkeypatch.setattr(main, "response_cache", ResponseCache())
+    monkeypatch.setattr(main, "transformations", SingleFlight())
+    monkeypatch.setattr(main, "model_router", ModelRouter(main.LLM_MODEL))
+    # The fake embeddings are the embeddings of the examples: the semantic cache would answer every text
+    monkeypatch.setattr(main, "semantic_cache", None)
+    return fake_client
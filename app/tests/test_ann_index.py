@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from app.utils.ann_index import IVFIndex, ann_index_path, recall_report
+from app.utils.example_index import ExampleIndex, ExampleIndexManager, RetrievalBackend
+
+
+def clustered_index(n=2000, dim=32, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    embeddings = centers[rng.integers(n_clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))
+    return ExampleIndex(list(range(n)), [f"d{i}" for i in range(n)], [f"f{i}" for i in range(n)], embeddings)
+
+
+def test_ivf_lists_cover_every_row():
+    index = clustered_index()
+    ann = IVFIndex.build(index.ids, index.matrix, n_lists=16)
+    assert ann.list_offsets[-1] == len(index)
+    assert np.array_equal(np.sort(ann.list_rows), np.arange(len(index)))
+
+
+def test_ivf_recall():
+    index = clustered_index()
+    index.attach_ann(IVFIndex.build(index.ids, index.matrix, n_lists=16))
+    rng = np.random.default_rng(1)
+    queries = index.matrix[:50] + 0.05 * rng.normal(size=(50, index.dim))
+
+    report = recall_report(index, queries, k=5, nprobes=(1, 4, 16))
+    assert [row["nprobe"] for row in report] == [1, 4, 16]
+    assert report[1]["recall@5"] > 0.9
+    # Scanning every list is an exact search
+    assert report[-1]["recall@5"] == 1.0
+
+
+def test_ivf_save_load_and_fingerprint(tmp_path):
+    index = clustered_index()
+    ann = IVFIndex.build(index.ids, index.matrix, n_lists=8, nprobe=3)
+    path = tmp_path / "embeddings.ivf.npz"
+    ann.save(path)
+
+    loaded = IVFIndex.load(path)
+    assert loaded.nprobe == 3
+    assert loaded.fingerprint == ann.fingerprint
+    assert np.array_equal(loaded.list_rows, ann.list_rows)
+
+    with pytest.raises(ValueError):
+        clustered_index(seed=1).attach_ann(loaded)
+
+
+def test_manager_attaches_ann(emb_db):
+    index = ExampleIndex.from_db(emb_db)
+    IVFIndex.build(index.ids, index.matrix, n_lists=4).save(ann_index_path(emb_db))
+
+    manager = ExampleIndexManager(emb_db)
+    assert manager.index.ann is not None
+    query = index.matrix[0]
+    indices, _ = manager.index.search(query, 5, RetrievalBackend.IVF, nprobe=4)
+    assert indices[0] == 0
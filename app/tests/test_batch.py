@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.example_index import ExampleIndex
+
+
+def test_search_batch_matches_search(embeddings):
+    index = ExampleIndex(list(range(len(embeddings))), ["d"] * len(embeddings), ["f"] * len(embeddings), embeddings)
+    queries = embeddings[:7] + 0.1
+
+    indices, similarities = index.search_batch(queries, 5, max_scores=3 * len(index))
+    for query, row, row_similarities in zip(queries, indices, similarities):
+        expected, expected_similarities = index.search(query, 5)
+        assert row.tolist() == expected.tolist()
+        assert np.allclose(row_similarities, expected_similarities, atol=1e-6)
+
+
+@pytest.mark.asyncio
+async def test_transform_messages_batch(fake_app):
+    texts = ["First message of the batch", "short", "This one should FAIL", "Another message of the batch"]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/api/messages/batch", json={"texts": texts})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == [0, 1, 2, 3]
+
+    assert results[0]["message"]["original_text"] == texts[0]
+    assert results[0]["message"]["transformed_text"] == f"functional: {texts[0]}"
+    assert results[3]["message"]["transformed_text"] == f"functional: {texts[3]}"
+    assert results[1]["message"] is None and "at least 10 characters" in results[1]["error"]
+    assert results[2]["message"] is None and "upstream refused" in results[2]["error"]
+
+    # One embedding call for the three valid texts
+    assert fake_app.embedding_calls == [[texts[0], texts[2], texts[3]]]
+    assert len(main.messages) == 2
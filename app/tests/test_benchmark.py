@@ -0,0 +1,28 @@
+from app.utils.benchmark import build_synthetic_corpus, compare_results, run_benchmarks, synthetic_corpus_path
+from app.utils.embedding_store import read_examples
+
+
+def test_synthetic_corpus(tmp_path):
+    path = build_synthetic_corpus(synthetic_corpus_path(tmp_path, 50, 16), 50, dim=16, batch_size=20)
+    ids, dysfunctional, functional, embeddings = read_examples(path)
+
+    assert ids == list(range(1, 51))
+    assert embeddings.shape == (50, 16)
+    assert all(dysfunctional) and all(functional)
+
+
+def test_run_and_compare_benchmarks(tmp_path):
+    report = run_benchmarks([200], tmp_path, dim=16, repeat=2)
+
+    stages = report["results"]["200"]
+    assert {"read_db", "build_index", "map_index", "find_closest_list", "find_closest_sklearn", "search", "search_mapped",
+            "search_batch", "build_prompt", "render_prompt"} <= set(stages)
+    assert stages["build_index"]["peak_mib"] > 0
+    assert stages["search"]["median_ms"] > 0
+    assert report["parameters"]["dim"] == 16
+
+    # A stage twice as slow as in the baseline is a regression
+    baseline = {"results": {"200": {stage: dict(timing) for stage, timing in stages.items()}}}
+    baseline["results"]["200"]["search"]["median_ms"] /= 2
+    regressions = [row["stage"] for row in compare_results(baseline, report, threshold=0.5) if row["regression"]]
+    assert regressions == ["search"]
@@ -0,0 +1,127 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.utils.cache import LRUCache, SQLiteCache, TieredCache
+from app.utils.embedding_cache import EmbeddingCache, embedding_cache_key
+from app.utils.prompts import get_embedding, select_examples, aselect_examples
+
+
+class FakeEmbeddingsClient:
+    """Stand-in for the OpenAI client that counts the calls to embeddings.create."""
+
+    def __init__(self):
+        self.calls = 0
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    def create(self, input, model):
+        self.calls += 1
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text)), 1.0, 0.5]) for text in input])
+
+
+def test_lru_eviction_and_stats():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "bytes": 0, "hits": 2, "misses": 1, "evictions": 1}
+
+
+def test_lru_ttl_and_max_bytes():
+    cache = LRUCache(max_size=10, ttl=0.05)
+    cache.set("a", 1)
+    time.sleep(0.06)
+    assert cache.get("a") is None
+
+    cache = LRUCache(max_size=10, max_bytes=10, size_of=len)
+    cache.set("a", "x" * 6)
+    cache.set("b", "y" * 6)
+    assert cache.get("a") is None
+    assert cache.get("b") == "y" * 6
+    cache.set("c", "z" * 11)  # larger than the whole cache: not stored
+    assert cache.get("c") is None
+    cache.set("b", "z" * 11)  # the previous value is not served either
+    assert cache.get("b") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_tiered_cache_promotes_from_store(tmp_path):
+    store = SQLiteCache(tmp_path / "cache.db")
+    cache = TieredCache(LRUCache(), store, encode=str.encode, decode=bytes.decode)
+    cache.set("k", "v")
+
+    # A new process: empty memory tier, same file
+    restarted = TieredCache(LRUCache(), SQLiteCache(tmp_path / "cache.db"), encode=str.encode, decode=bytes.decode)
+    assert restarted.get("k") == "v"
+    assert restarted.memory.get("k") == "v"
+    assert restarted.get("missing") is None
+    assert restarted.stats()["hits"] == 2
+    assert restarted.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_async_access(tmp_path):
+    cache = TieredCache(LRUCache(), SQLiteCache(tmp_path / "cache.db"), encode=str.encode, decode=bytes.decode)
+    await cache.aset("k", "v")
+    assert await cache.aget("k") == "v"
+
+    restarted = TieredCache(LRUCache(), SQLiteCache(tmp_path / "cache.db"), encode=str.encode, decode=bytes.decode)
+    assert await restarted.aget("k") == "v"
+    assert restarted.memory.get("k") == "v"
+    assert await restarted.aget("missing") is None
+
+
+def test_sqlite_cache_purges_expired_entries(tmp_path):
+    store = SQLiteCache(tmp_path / "cache.db", ttl=0.05, purge_interval=0.1)
+    store.set("old", b"x")
+    time.sleep(0.1)
+    store.set("new", b"y")  # purges the expired entry
+    assert len(store) == 1
+    assert store.stats()["purged"] == 1
+
+    time.sleep(0.06)
+    # Opening the file purges the entries expired since
+    assert len(SQLiteCache(tmp_path / "cache.db", ttl=0.05)) == 0
+
+
+def test_embedding_cache_key_normalizes_whitespace():
+    assert embedding_cache_key("m", "  Hello   world\n") == embedding_cache_key("m", "Hello world")
+    assert embedding_cache_key("m", "Hello world") != embedding_cache_key("other", "Hello world")
+
+
+def test_get_embedding_uses_cache(tmp_path):
+    client = FakeEmbeddingsClient()
+    cache = EmbeddingCache(max_size=10, path=tmp_path / "embeddings_cache.db")
+
+    first = get_embedding("some text", "model", client, cache=cache)
+    second = get_embedding("some  text ", "model", client, cache=cache)
+    assert client.calls == 1
+    assert np.array_equal(first, second)
+    assert cache.stats()["hits"] == 1
+
+    # Survives a restart
+    restarted = EmbeddingCache(max_size=10, path=tmp_path / "embeddings_cache.db")
+    assert np.array_equal(get_embedding("some text", "model", client, cache=restarted), first)
+    assert client.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_aselect_examples_matches_select_examples(emb_db, embeddings):
+    class FakeAsyncEmbeddingsClient:
+        def __init__(self):
+            self.embeddings = SimpleNamespace(create=self.create)
+
+        async def create(self, input, model):
+            return SimpleNamespace(data=[SimpleNamespace(embedding=list(embeddings[5])) for _ in input])
+
+    sync_client = SimpleNamespace(embeddings=SimpleNamespace(
+        create=lambda input, model: SimpleNamespace(data=[SimpleNamespace(embedding=list(embeddings[5]))])))
+
+    selected = await aselect_examples("text", emb_db, "model", FakeAsyncEmbeddingsClient(), num_examples=3)
+    assert selected == select_examples("text", emb_db, "model", sync_client, num_examples=3)
+    assert selected[0]["dysfunctional"] == "dysfunctional 6"
@@ -0,0 +1,94 @@
+import asyncio
+import gzip
+import zlib
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from httpx import AsyncClient, ASGITransport
+
+from app.utils.compression import CompressionMiddleware, negotiate_encoding
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert negotiate_encoding("deflate") == "deflate"
+    assert negotiate_encoding("gzip;q=0.5, deflate;q=0.8") == "deflate"
+    assert negotiate_encoding("gzip;q=0, *") == "deflate"
+    assert negotiate_encoding("br, identity") is None
+    assert negotiate_encoding("") is None
+
+
+def make_app():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.get("/small")
+    async def small():
+        return PlainTextResponse("tiny")
+
+    @app.get("/large")
+    async def large():
+        return PlainTextResponse("x" * 10_000)
+
+    @app.get("/stream")
+    async def stream():
+        async def lines():
+            for i in range(5):
+                yield f"line {i}\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/events")
+    async def events():
+        async def lines():
+            yield "event: start\n\n"
+        return StreamingResponse(lines(), media_type="text/event-stream")
+
+    return app
+
+
+@pytest.mark.asyncio
+async def test_compression_middleware():
+    async with AsyncClient(transport=ASGITransport(app=make_app()), base_url="http://test") as ac:
+        response = await ac.get("/small", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+        assert response.text == "tiny"
+
+        response = await ac.get("/large", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert int(response.headers["content-length"]) < 100
+        assert response.text == "x" * 10_000
+
+        response = await ac.get("/large", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+
+        response = await ac.get("/stream", headers={"Accept-Encoding": "deflate"})
+        assert response.headers["content-encoding"] == "deflate"
+        assert response.text == "".join(f"line {i}\n" for i in range(5))
+
+        response = await ac.get("/events", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_stream_pieces_decode_as_they_arrive():
+    app = make_app()
+    scope = {"type": "http", "method": "GET", "path": "/stream", "raw_path": b"/stream", "query_string": b"",
+             "headers": [(b"accept-encoding", b"gzip")], "root_path": "", "scheme": "http", "server": ("test", 80)}
+    messages = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        await disconnected.wait()  # the client stays connected
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    assert (b"content-encoding", b"gzip") in messages[0]["headers"]
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pieces = [decompressor.decompress(message["body"]) for message in messages[1:]]
+    assert pieces[:5] == [f"line {i}\n".encode() for i in range(5)]
+    assert gzip.decompress(b"".join(message["body"] for message in messages[1:])) == b"".join(pieces)
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+
+from app.utils.corpus_builder import EmbeddingsDbBuilder, building_path, iter_pairs
+from app.utils.embedding_store import read_examples, read_metadata, connect_read_only
+from app.utils.openai_config import OpenAIModels
+from app.tests.conftest import FakeAsyncOpenAI
+
+MODEL = OpenAIModels.TEXT_EMB_3_SMALL
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FailingAsyncOpenAI(FakeAsyncOpenAI):
+    """Fails (with an error that is not retried) after a number of embedding calls."""
+
+    def __init__(self, embeddings, fail_after):
+        super().__init__(embeddings)
+        self.fail_after = fail_after
+
+    async def create_embeddings(self, input, model):
+        if len(self.embedding_calls) >= self.fail_after:
+            raise Interrupted
+        return await super().create_embeddings(input, model)
+
+
+@pytest.fixture
+def pair_files(tmp_path):
+    csv_path = tmp_path / "pairs.csv"
+    csv_path.write_text(
+        "dysfunctional,functional\n"
+        + "".join(f"dysfunctional text {i},functional text {i}\n" for i in range(30))
+        + "dysfunctional   text 0,functional text 0\n"  # duplicate, up to whitespace
+        + ",empty\n")
+    jsonl_path = tmp_path / "pairs.jsonl"
+    jsonl_path.write_text("".join(
+        json.dumps({"dysfunctional": f"dysfunctional text {i}", "functional": f"functional text {i}"}) + "\n"
+        for i in range(20, 50)))
+    return csv_path, jsonl_path
+
+
+def all_pairs(pair_files):
+    return (pair for path in pair_files for pair in iter_pairs(path))
+
+
+@pytest.mark.asyncio
+async def test_build_deduplicates_and_resumes(tmp_path, embeddings, pair_files):
+    path = tmp_path / "embeddings.db"
+
+    # The first run is interrupted after two batches
+    failing = FailingAsyncOpenAI(embeddings, fail_after=2)
+    builder = EmbeddingsDbBuilder(path, MODEL, failing, batch_size=8, concurrency=1)
+    assert builder.ingest(all_pairs(pair_files)) == {"read": 61, "queued": 50}
+    with pytest.raises(Interrupted):
+        await builder.embed()
+    builder.close()
+    assert not path.exists()
+
+    # The second run resumes: nothing is queued or embedded twice
+    client = FakeAsyncOpenAI(embeddings)
+    builder = EmbeddingsDbBuilder(path, MODEL, client, batch_size=8, concurrency=3)
+    assert builder.resumed
+    assert builder.ingest(all_pairs(pair_files))["queued"] == 0
+    assert builder.pending() == 34
+    assert await builder.embed() == 34
+    assert builder.finalize() == 50
+    assert not building_path(path).exists()
+
+    embedded = [text for call in failing.embedding_calls + client.embedding_calls for text in call]
+    assert len(embedded) == len(set(embedded)) == 50
+
+    ids, dysfunctional, functional, matrix = read_examples(path)
+    assert sorted(dysfunctional) == sorted(f"dysfunctional text {i}" for i in range(50))
+    for text, row in zip(dysfunctional, matrix):
+        assert np.allclose(row, embeddings[len(text) % len(embeddings)], atol=1e-6)
+    conn = connect_read_only(path)
+    assert read_metadata(conn)["embedding_model"] == MODEL.value
+    assert read_metadata(conn)["num_examples"] == "50"
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_build_extends_existing_database(tmp_path, embeddings, pair_files):
+    path = tmp_path / "embeddings.db"
+    builder = EmbeddingsDbBuilder(path, MODEL, FakeAsyncOpenAI(embeddings), batch_size=16)
+    builder.ingest(iter_pairs(pair_files[0]))
+    await builder.embed()
+    assert builder.finalize() == 30
+
+    client = FakeAsyncOpenAI(embeddings)
+    builder = EmbeddingsDbBuilder(path, MODEL, client, batch_size=16)
+    assert builder.ingest(all_pairs(pair_files))["queued"] == 20
+    await builder.embed()
+    assert builder.finalize() == 50
+    assert sum(len(call) for call in client.embedding_calls) == 20
+
+    with pytest.raises(ValueError):
+        EmbeddingsDbBuilder(path, "another-embedding-model", client)
+    assert not building_path(path).exists()
+
+
+def test_build_refuses_json_database(emb_db, embeddings):
+    with pytest.raises(ValueError):
+        EmbeddingsDbBuilder(emb_db, MODEL, FakeAsyncOpenAI(embeddings))
+    assert not building_path(emb_db).exists()
@@ -0,0 +1,56 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from app.utils.embedding_store import (
+    EMBEDDING_FORMAT_FLOAT32,
+    EMBEDDING_FORMAT_JSON,
+    convert_embeddings_db,
+    get_embedding_format,
+    read_examples,
+    read_metadata,
+)
+from app.utils.example_index import ExampleIndex
+from app.utils.prompts import load_examples
+
+
+def test_convert_json_to_float32(emb_db, embeddings, tmp_path):
+    dst = tmp_path / "embeddings.f32.db"
+    assert convert_embeddings_db(emb_db, dst, batch_size=64) == embeddings.shape[0]
+
+    conn = sqlite3.connect(dst)
+    assert get_embedding_format(conn) == EMBEDDING_FORMAT_FLOAT32
+    assert read_metadata(conn)["embedding_dim"] == str(embeddings.shape[1])
+    conn.close()
+
+    ids_json, dys_json, fun_json, emb_json = read_examples(emb_db)
+    ids_bin, dys_bin, fun_bin, emb_bin = read_examples(dst)
+    assert ids_json == ids_bin
+    assert dys_json == dys_bin
+    assert fun_json == fun_bin
+    assert emb_bin.dtype == np.float32
+    assert np.array_equal(emb_json, emb_bin)
+
+
+def test_loaders_read_both_formats(emb_db, tmp_path):
+    dst = tmp_path / "embeddings.f32.db"
+    convert_embeddings_db(emb_db, dst)
+
+    assert np.array_equal(ExampleIndex.from_db(emb_db).matrix, ExampleIndex.from_db(dst).matrix)
+    assert [e["id"] for e in load_examples(emb_db)] == [e["id"] for e in load_examples(dst)]
+
+
+def test_convert_refuses_existing_or_converted(emb_db, tmp_path):
+    conn = sqlite3.connect(emb_db)
+    assert get_embedding_format(conn) == EMBEDDING_FORMAT_JSON
+    conn.close()
+
+    with pytest.raises(FileExistsError):
+        convert_embeddings_db(emb_db, emb_db)
+
+    dst = tmp_path / "embeddings.f32.db"
+    convert_embeddings_db(emb_db, dst)
+    with pytest.raises(ValueError):
+        convert_embeddings_db(dst, tmp_path / "again.db")
+    assert not (tmp_path / "again.db").exists()
@@ -0,0 +1,88 @@
+import os
+import time
+
+import numpy as np
+
+from app.tests.conftest import create_embeddings_db
+from app.utils.example_index import ExampleIndex, ExampleIndexManager, get_example_index, top_k
+from app.utils.prompts import load_examples, find_closest
+
+
+def brute_force(query, embeddings, top_n):
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    similarities = embeddings @ (query / np.linalg.norm(query))
+    return similarities.argsort()[-top_n:][::-1], similarities
+
+
+def test_top_k_sorted():
+    scores = np.array([0.1, 0.9, 0.3, 0.7, 0.5])
+    assert top_k(scores, 3).tolist() == [1, 3, 4]
+    assert top_k(scores, 10).tolist() == [1, 3, 4, 2, 0]
+    assert top_k(scores, 0).tolist() == []
+
+
+def test_index_from_db(emb_db, embeddings):
+    index = ExampleIndex.from_db(emb_db)
+    assert len(index) == embeddings.shape[0]
+    assert index.matrix.dtype == np.float32
+    assert index.matrix.flags["C_CONTIGUOUS"]
+    assert np.allclose(np.linalg.norm(index.matrix, axis=1), 1, atol=1e-5)
+
+
+def test_search_matches_brute_force(emb_db, embeddings):
+    index = ExampleIndex.from_db(emb_db)
+    query = embeddings[7] + 0.1
+    expected, similarities = brute_force(query, embeddings, 5)
+
+    indices, scores = index.search(query, 5)
+    assert indices.tolist() == expected.tolist()
+    assert np.allclose(scores, similarities[expected], atol=1e-5)
+
+
+def test_find_closest_keeps_return_shape(emb_db, embeddings):
+    query = list(embeddings[3])
+    from_index, sims_index = find_closest(query, get_example_index(emb_db), 5)
+    from_list, sims_list = find_closest(query, load_examples(emb_db), 5)
+
+    assert from_index == from_list
+    assert from_index[0] == {"dysfunctional": "dysfunctional 4", "functional": "functional 4"}
+    assert all(isinstance(sim, np.float64) for sim in sims_index)
+    assert np.allclose(sims_index, sims_list)
+
+
+def test_get_example_index_is_cached(emb_db):
+    assert get_example_index(emb_db) is get_example_index(emb_db)
+
+
+def test_manager_swaps_snapshot_on_change(tmp_path, embeddings):
+    path = create_embeddings_db(tmp_path / "embeddings.db", embeddings[:10])
+    manager = ExampleIndexManager(path)
+    old = manager.snapshot
+    assert old.version == 1
+    assert len(old.index) == 10
+
+    # Nothing changed: the active snapshot is kept
+    assert manager.reload() is False
+    assert manager.snapshot is old
+
+    # A new version of the database is deployed
+    path.unlink()
+    create_embeddings_db(path, embeddings[:20])
+    os.utime(path, (old.source_mtime + 10, old.source_mtime + 10))
+    assert manager.reload() is True
+    assert manager.snapshot.version == 2
+    assert len(manager.index) == 20
+    # Readers holding the old snapshot still see the old index
+    assert len(old.index) == 10
+    assert manager.status()["active"]["num_examples"] == 20
+
+
+def test_manager_reload_in_background(emb_db):
+    manager = ExampleIndexManager(emb_db)
+    manager.reload()
+    assert manager.reload_in_background(force=True)
+    for _ in range(100):
+        if manager.snapshot.version == 2:
+            break
+        time.sleep(0.05)
+    assert manager.snapshot.version == 2
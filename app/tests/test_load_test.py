@@ -0,0 +1,71 @@
+import random
+
+import httpx
+import numpy as np
+import pytest
+from openai import AsyncOpenAI, RateLimitError
+
+from app.main import app
+from app.utils.load_generator import run_load
+from app.utils.mock_openai import LatencyModel, MockOpenAI, mock_embedding
+from app.utils.openai_config import OpenAIModels
+from app.utils.prompts import aget_embeddings
+from app.utils.request_handler import asend_request, astream_request
+
+
+def mock_client(mock):
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=mock.app), base_url="http://mock/v1")
+    return AsyncOpenAI(api_key="sk-mock", base_url="http://mock/v1", http_client=http_client, max_retries=0)
+
+
+def test_latency_model():
+    rng = random.Random(0)
+    latencies = 1000 * np.array([LatencyModel(100, 400).sample(rng) for _ in range(20_000)])
+    assert np.percentile(latencies, 50) == pytest.approx(100, rel=0.05)
+    assert np.percentile(latencies, 99) == pytest.approx(400, rel=0.1)
+    assert LatencyModel(0).sample(rng) == 0
+
+
+@pytest.mark.asyncio
+async def test_mock_openai_endpoints():
+    mock = MockOpenAI(embedding_dim=64)
+    client = mock_client(mock)
+
+    embeddings = await aget_embeddings(["first text", "second text"], OpenAIModels.TEXT_EMB_3_SMALL, client)
+    assert np.allclose(embeddings[0], mock_embedding("first text", 64), atol=1e-6)
+
+    response, token_usage = await asend_request(client, OpenAIModels.GPT4o_MINI, "system", "a prompt\nthe text", 0)
+    assert response == "functional: the text"
+
+    chunks = [item async for item in astream_request(client, OpenAIModels.GPT4o_MINI, "system", "a prompt\nthe text", 0)]
+    assert "".join(chunks[:-1]) == "functional: the text"
+    assert chunks[-1] == token_usage
+
+    assert mock.stats()["calls"] == {"embeddings": 1, "chat": 2}
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_mock_openai_injects_rate_limits():
+    mock = MockOpenAI(rate_limit_ratio=1.0, retry_after_ms=250)
+    client = mock_client(mock)
+
+    with pytest.raises(RateLimitError) as error:
+        await client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "text"}])
+    assert error.value.response.headers["retry-after-ms"] == "250"
+    assert mock.stats()["rate_limited"] == 1
+    await client.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", [{"concurrency": 4}, {"rps": 200}])
+async def test_load_generator(fake_app, mode):
+    texts = ["the first text", "the second text", "FAIL this text"]
+    report = await run_load("http://test", texts, num_requests=30, transport=httpx.ASGITransport(app=app), **mode)
+    summary = report.summary()
+
+    assert summary["requests"] == 30
+    assert summary["statuses"] == {"200": 20, "500": 10}
+    assert summary["error_rate"] == pytest.approx(1 / 3)
+    assert 0 < summary["latency_ms"]["p50"] <= summary["latency_ms"]["p95"] <= summary["latency_ms"]["p99"]
+    assert summary["throughput_rps"] > 0
@@ -0,0 +1,99 @@
+import sqlite3
+
+import numpy as np
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.embedding_store import create_binary_db, encode_embedding, read_examples
+from app.utils.example_index import ExampleIndex
+from app.utils.local_embeddings import (
+    EmbeddingProvider,
+    LocalEmbeddingBackend,
+    build_local_index,
+    get_local_backend,
+    local_index_path,
+    overlap_report,
+)
+from app.utils.prompts import aselect_examples
+
+TOPICS = {
+    "chores": ["dishes", "laundry", "kitchen", "cleaning", "trash", "vacuum"],
+    "money": ["money", "bills", "rent", "spending", "budget", "savings"],
+    "time": ["late", "waiting", "schedule", "weekend", "plans", "calendar"],
+    "family": ["mother", "parents", "sister", "holidays", "visit", "cousins"],
+}
+
+
+@pytest.fixture
+def topic_db(tmp_path):
+    """Examples about a few topics, with reference embeddings made of the embeddings of their words."""
+    rng = np.random.default_rng(0)
+    word_vectors = {word: rng.normal(size=32) for words in TOPICS.values() for word in words}
+    conn = sqlite3.connect(tmp_path / "embeddings.db")
+    create_binary_db(conn, 32)
+    rows = []
+    for i in range(200):
+        topic = i % len(TOPICS)
+        words = rng.choice(list(TOPICS.values())[topic], 3, replace=False)
+        text = f"you never care about the {words[0]} or the {words[1]} and {words[2]}"
+        embedding = sum(word_vectors[word] for word in words) + 0.1 * rng.normal(size=32)
+        rows.append((i + 1, text, encode_embedding(embedding), f"functional {i + 1}"))
+    conn.executemany("INSERT INTO examples (id, dysfunctional, embedding, functional) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return tmp_path / "embeddings.db"
+
+
+def test_local_embeddings(topic_db):
+    _, dysfunctional, _, _ = read_examples(topic_db)
+    backend = LocalEmbeddingBackend.fit(dysfunctional, n_features=2 ** 12, n_components=32)
+
+    embeddings = backend.embed(["the dishes and the laundry", "the dishes and the kitchen", "my parents and my sister"])
+    assert embeddings.shape == (3, 32)
+    assert embeddings.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1, atol=1e-5)
+    assert embeddings[0] @ embeddings[1] > embeddings[0] @ embeddings[2]
+
+
+def test_build_local_index_and_overlap_report(topic_db):
+    backend = build_local_index(topic_db, n_features=2 ** 12, n_components=32)
+    path = local_index_path(topic_db)
+
+    ids, dysfunctional, _, matrix = read_examples(path)
+    assert ids == read_examples(topic_db)[0]
+    assert matrix.shape == (200, 32)
+
+    loaded = LocalEmbeddingBackend.load(path)
+    assert np.allclose(loaded.embed(dysfunctional[:5]), backend.embed(dysfunctional[:5]), atol=1e-6)
+    assert get_local_backend(path).dim == 32
+
+    report = overlap_report(ExampleIndex.from_db(topic_db), ExampleIndex.from_db(path), backend, num_queries=50)
+    assert report["num_queries"] == 50
+    assert report["overlap@5"] > 0.3
+    assert report["embed_ms_mean"] > 0
+
+
+@pytest.mark.asyncio
+async def test_select_examples_with_local_embeddings(topic_db):
+    backend = build_local_index(topic_db, n_features=2 ** 12, n_components=32)
+    selected = await aselect_examples(
+        "why are the dishes and the laundry always left to me",
+        local_index_path(topic_db), emb_model=None, client=None, num_examples=3, embedder=backend)
+
+    assert len(selected) == 3
+    assert all(any(word in example["dysfunctional"] for word in TOPICS["chores"]) for example in selected)
+
+
+@pytest.mark.asyncio
+async def test_transform_message_with_local_embeddings(fake_app, monkeypatch, emb_db):
+    build_local_index(emb_db, n_features=2 ** 12, n_components=16)
+    monkeypatch.setattr(main, "EMBEDDING_PROVIDER", EmbeddingProvider.LOCAL)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/api/messages/", json={"original_text": "dysfunctional 42 again"})
+
+    assert response.status_code == 200
+    assert fake_app.embedding_calls == []
+    assert fake_app.chat_calls == 1
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import sqlite3
+import threading
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.message_store import InMemoryMessageStore, SQLiteMessageStore
+from app.utils.models import TextModel
+
+
+def make_messages(n):
+    return [TextModel(original_text=f"message number {i}") for i in range(n)]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = InMemoryMessageStore() if request.param == "memory" else SQLiteMessageStore(tmp_path / "messages.db")
+    yield store
+    store.close()
+
+
+def test_get_update_delete(store):
+    first, second = make_messages(2)
+    store.append(first)
+    store.append(second)
+
+    assert store.get(first.id) == first
+    assert store.update(second.id, transformed_text="updated")
+    assert store.get(second.id).transformed_text == "updated"
+    assert not store.update(make_messages(1)[0].id, transformed_text="updated")
+
+    assert store.delete(first.id)
+    assert not store.delete(first.id)
+    assert store.get(first.id) is None
+    assert first.id not in store
+    assert [message.id for message in store] == [second.id]
+
+
+def test_pagination_survives_deletes(store):
+    texts = make_messages(10)
+    for message in texts:
+        store.append(message)
+
+    page, cursor = store.page(limit=4)
+    assert page == texts[:4]
+    assert len(store) == 10
+
+    # Deleting the last message of the page does not invalidate its cursor
+    store.delete(texts[3].id)
+    store.delete(texts[5].id)
+    page, cursor = store.page(limit=4, after=cursor)
+    assert page == [texts[4], texts[6], texts[7], texts[8]]
+
+    page, cursor = store.page(limit=4, after=cursor)
+    assert page == [texts[9]]
+    assert cursor is None
+
+
+def test_eviction_and_compaction():
+    store = InMemoryMessageStore(max_size=50)
+    texts = make_messages(500)
+    for i, message in enumerate(texts):
+        store.append(message)
+        if i % 3 == 0:
+            store.delete(message.id)
+
+    remaining = [message for i, message in enumerate(texts) if i % 3 != 0][-50:]
+    assert list(store) == remaining
+    assert len(store) == 50
+    assert store.evictions == 500 - 500 // 3 - 1 - 50
+    assert len(store._order) < 4 * len(store)
+
+    # The cursors still work after the compactions
+    page, cursor = store.page(limit=20)
+    page, cursor = store.page(limit=40, after=cursor)
+    assert page == remaining[20:]
+    assert cursor is None
+
+
+def test_sqlite_store_is_shared_and_durable(tmp_path):
+    path = tmp_path / "messages.db"
+    worker_1 = SQLiteMessageStore(path, commit_interval=0.01)
+    worker_2 = SQLiteMessageStore(path)
+    texts = make_messages(3)
+    for message in texts:
+        worker_1.append(message)
+    worker_1.flush()
+
+    assert [message.id for message in worker_2] == [message.id for message in texts]
+    assert worker_2.delete(texts[0].id)
+    worker_1.close()
+    worker_2.close()
+
+    reopened = SQLiteMessageStore(path)
+    assert [message.id for message in reopened] == [message.id for message in texts[1:]]
+    reopened.close()
+
+
+def test_sqlite_store_group_commit_and_eviction(tmp_path):
+    store = SQLiteMessageStore(tmp_path / "messages.db", max_size=30, commit_interval=0.5)
+    texts = make_messages(100)
+    for message in texts:
+        store.append(message)
+
+    # A read does not wait for the end of the commit interval
+    assert [message.id for message in store] == [message.id for message in texts[-30:]]
+    assert store.commits < 10
+    assert store.stats()["written"] == 100
+    assert store.evictions == 70
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_paginated(monkeypatch):
+    store = InMemoryMessageStore()
+    monkeypatch.setattr(main, "messages", store)
+    texts = make_messages(5)
+    for message in texts:
+        store.append(message)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/api/messages/", params={"limit": 3})
+        assert [message["id"] for message in response.json()] == [str(message.id) for message in texts[:3]]
+
+        cursor = response.headers["X-Next-Cursor"]
+        response = await ac.get("/api/messages/", params={"limit": 3, "after": cursor})
+        assert [message["id"] for message in response.json()] == [str(message.id) for message in texts[3:]]
+        assert "X-Next-Cursor" not in response.headers
+
+        response = await ac.get("/api/messages/", params={"limit": 0})
+        assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_export_messages_ndjson(monkeypatch, store):
+    monkeypatch.setattr(main, "messages", store)
+    monkeypatch.setattr(main, "EXPORT_PAGE_SIZE", 4)
+    texts = make_messages(10)
+    for message in texts:
+        message.prompt = "a long few-shot prompt " * 100
+        store.append(message)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/api/messages/export", params={"fields": "id,transformed_text"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert records == [{"id": str(message.id), "transformed_text": ""} for message in texts]
+
+        response = await ac.get("/api/messages/export", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.text.splitlines()) == 10
+        assert json.loads(response.text.splitlines()[0])["prompt"] == texts[0].prompt
+
+        response = await ac.get("/api/messages/", params={"fields": "original_text"})
+        assert response.json()[0] == {"original_text": "message number 0"}
+
+        response = await ac.get("/api/messages/export", params={"fields": "id,password"})
+        assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_slow_commit_does_not_stall_the_event_loop(monkeypatch, tmp_path):
+    store = SQLiteMessageStore(tmp_path / "messages.db")
+    monkeypatch.setattr(main, "messages", store)
+    store.append(make_messages(1)[0])
+    store.flush()
+
+    # A commit in progress holds the connection for 0.5 s
+    store._lock.acquire()
+    threading.Timer(0.5, store._lock.release).start()
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        request = asyncio.create_task(ac.get("/api/messages/"))
+        await asyncio.sleep(0.1)
+        assert not request.done()  # the event loop kept running while the request waited
+        assert len((await request).json()) == 1
+    store.close()
+
+
+def test_sqlite_store_adds_semantic_similarity_column(tmp_path):
+    path = tmp_path / "messages.db"
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, original_text TEXT NOT NULL,
+                               prompt TEXT NOT NULL, transformed_text TEXT NOT NULL, from_cache INTEGER NOT NULL, created_at REAL NOT NULL)""")
+    conn.close()
+
+    store = SQLiteMessageStore(path)
+    message = TextModel(original_text="message number 1", semantic_similarity=0.98)
+    store.append(message)
+    assert store.get(message.id).semantic_similarity == 0.98
+    store.close()
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+from app.main import app
+from app.utils.metrics import MetricsRegistry, RequestTimings, STAGE_SECONDS, TOKENS, _request_timings, stage
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_calls_total", "Calls.", ("model",))
+    histogram = registry.histogram("test_seconds", "Durations.", ("stage",), buckets=(0.1, 1))
+    registry.add_collector(lambda: [("test_size", "gauge", "Size.", [({}, 3)])])
+
+    counter.inc(model="gpt-4o-mini")
+    counter.inc(2, model="gpt-4o-mini")
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage="llm")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_calls_total counter" in lines
+    assert 'test_calls_total{model="gpt-4o-mini"} 3' in lines
+    assert 'test_seconds_bucket{stage="llm",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="llm",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="llm",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="llm"} 3' in lines
+    assert "test_size 3" in lines
+
+    with pytest.raises(ValueError):
+        registry.counter("test_calls_total", "Again.")
+
+
+@pytest.mark.asyncio
+async def test_stages_are_recorded_in_worker_threads():
+    timings = RequestTimings()
+    token = _request_timings.set(timings)
+    try:
+        def search():
+            with stage("test_search"):
+                pass
+
+        await asyncio.to_thread(search)
+        await asyncio.to_thread(search)
+    finally:
+        _request_timings.reset(token)
+
+    assert list(timings.stages) == ["test_search"]
+    assert timings.server_timing().startswith("test_search;dur=")
+    assert STAGE_SECONDS.count(stage="test_search") == 2
+
+
+@pytest.mark.asyncio
+async def test_server_timing_and_metrics_endpoint(fake_app):
+    prompt_tokens = TOKENS.value(model="gpt-4o-mini", type="prompt")
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/api/messages/", json={"original_text": "You never listen to me."})
+        assert response.status_code == 200
+        stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+        assert {"embedding", "search", "prompt", "llm", "total"} <= set(stages)
+
+        response = await ac.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'dailogy_stage_seconds_count{stage="llm"}' in response.text
+    assert 'dailogy_http_request_seconds_count{method="POST",route="/api/messages/",status="200"}' in response.text
+    assert 'dailogy_cache_misses_total{cache="responses"}' in response.text
+    assert TOKENS.value(model="gpt-4o-mini", type="prompt") == prompt_tokens + 100
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+from app.tests.conftest import create_embeddings_db
+from app.utils.example_index import ExampleIndex, ExampleIndexManager, build_mmap_index
+from app.utils.mmap_index import MappedTexts, mmap_index_path, write_mmap_index
+from app.utils.prompts import find_closest
+
+
+def test_mapped_index_matches_db(emb_db, embeddings):
+    path = build_mmap_index(emb_db)
+    assert path == mmap_index_path(emb_db) == emb_db.with_name("embeddings.mmap")
+
+    index = ExampleIndex.from_db(emb_db)
+    mapped = ExampleIndex.from_mmap(path)
+    assert mapped.mapped and not index.mapped
+    assert not mapped.matrix.flags["WRITEABLE"]
+    assert np.array_equal(mapped.matrix, index.matrix)
+    assert mapped.ids.tolist() == index.ids.tolist()
+    assert mapped.fingerprint == index.fingerprint
+
+    query = list(embeddings[3] + 0.1)
+    assert find_closest(query, mapped, 5) == find_closest(query, index, 5)
+
+
+def test_mapped_texts(tmp_path):
+    texts = ["Tu n'écoutes jamais", "", "why me? 🙄"]
+    path = tmp_path / "texts.mmap"
+    write_mmap_index(path, np.arange(3), np.eye(3), texts, ["a", "b", "c"], source_hash="x")
+
+    mapped = ExampleIndex.from_mmap(path)
+    assert isinstance(mapped.dysfunctional, MappedTexts)
+    assert list(mapped.dysfunctional) == texts
+    assert mapped.dysfunctional[np.int64(2)] == texts[2]
+    assert mapped.dysfunctional[-1] == texts[-1]
+    assert mapped.get_examples(np.array([2, 0])) == [
+        {"dysfunctional": texts[2], "functional": "c"}, {"dysfunctional": texts[0], "functional": "a"}]
+    with pytest.raises(IndexError):
+        mapped.functional[3]
+
+
+def test_from_mmap_checks_source(emb_db):
+    path = build_mmap_index(emb_db)
+    with pytest.raises(ValueError):
+        ExampleIndex.from_mmap(path, source_hash="another version")
+    with pytest.raises(ValueError):
+        ExampleIndex.from_mmap(emb_db)
+
+
+def test_manager_maps_up_to_date_index(tmp_path, embeddings):
+    path = create_embeddings_db(tmp_path / "embeddings.db", embeddings[:10])
+    manager = ExampleIndexManager(path, use_mmap=True)
+
+    # No mapped index yet: the examples are loaded from the database
+    assert not manager.index.mapped
+
+    build_mmap_index(path)
+    assert manager.reload() is True
+    assert manager.index.mapped
+    assert manager.status()["active"]["mapped"] is True
+    assert manager.reload() is False
+
+    # A new version of the database: the stale mapped index is ignored until it is rebuilt
+    path.unlink()
+    create_embeddings_db(path, embeddings[:20])
+    os.utime(path, (manager.snapshot.source_mtime + 10, manager.snapshot.source_mtime + 10))
+    assert manager.reload() is True
+    assert not manager.index.mapped
+    assert len(manager.index) == 20
+
+    build_mmap_index(path)
+    assert manager.reload() is True
+    assert manager.index.mapped
+    assert len(manager.index) == 20
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils.model_router import LatencyTracker, ModelRouter
+from app.utils.openai_config import OpenAIModels
+
+FAST, SLOW = OpenAIModels.GPT3_TURBO, OpenAIModels.GPT4o_MINI
+
+
+class SlowChatClient:
+    """Chat completions that take the latency of their model, or the delay of the next scripted call."""
+
+    def __init__(self, latencies, delays=()):
+        self.latencies = latencies
+        self.delays = list(delays)
+        self.calls = []
+        self.cancelled = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, temperature):
+        self.calls.append(model)
+        delay = self.delays.pop(0) if self.delays else self.latencies[model]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f"answer of {model.value}"))],
+            usage=SimpleNamespace(completion_tokens=5, prompt_tokens=100, total_tokens=105))
+
+
+def warm_tracker(**latencies):
+    tracker = LatencyTracker(window=50, min_samples=10)
+    for model, latency in latencies.items():
+        for _ in range(20):
+            tracker.observe(OpenAIModels[model], latency)
+    return tracker
+
+
+def test_latency_tracker_window():
+    tracker = LatencyTracker(window=10, min_samples=5)
+    for latency in range(4):
+        tracker.observe(FAST, latency)
+    assert tracker.percentile(FAST, 50) is None
+
+    for latency in range(100):
+        tracker.observe(FAST, latency)
+    assert tracker.percentile(FAST, 0) == 90
+    assert tracker.stats()[FAST.value]["samples"] == 10
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged_and_loser_cancelled():
+    client = SlowChatClient({SLOW: 0.01}, delays=[2.0])
+    router = ModelRouter(SLOW, max_hedge_ratio=1.0, tracker=warm_tracker(GPT4o_MINI=0.02))
+
+    start = time.perf_counter()
+    transformed_text, _, from_cache, model = await router.ahandle_request("prompt", client, 0)
+
+    assert time.perf_counter() - start < 1.0
+    assert transformed_text == "answer of gpt-4o-mini"
+    assert client.calls == [SLOW, SLOW]
+    await asyncio.sleep(0)  # let the cancelled call unwind
+    assert client.cancelled == 1
+    assert router.stats()["hedges"] == router.stats()["hedges_won"] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedge_to_fallback_model_and_ratio_limit():
+    client = SlowChatClient({SLOW: 0.5, FAST: 0.01})
+    router = ModelRouter(SLOW, hedge_model=FAST, max_hedge_ratio=0.5, tracker=warm_tracker(GPT4o_MINI=0.02))
+    router._recent.append(False)  # an earlier call, not hedged
+
+    *_, model = await router.ahandle_request("prompt", client, 0)
+    assert model == FAST
+
+    # One hedge in two calls: the next call is not hedged
+    *_, model = await router.ahandle_request("prompt", client, 0)
+    assert model == SLOW
+    assert router.hedges == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_cancels_the_call():
+    client = SlowChatClient({SLOW: 2.0})
+    router = ModelRouter(SLOW, max_hedge_ratio=1.0, tracker=warm_tracker(GPT4o_MINI=0.5))
+
+    request = asyncio.ensure_future(router.ahandle_request("prompt", client, 0))
+    await asyncio.sleep(0.05)  # waiting for the hedge delay
+    request.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await request
+    await asyncio.sleep(0)
+    assert client.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_no_winner_when_both_calls_fail():
+    client = SlowChatClient({SLOW: 0.01}, delays=[0.05, 0.2])
+    router = ModelRouter(SLOW, max_hedge_ratio=1.0, tracker=warm_tracker(GPT4o_MINI=0.02))
+
+    async def fail(*args, **kwargs):
+        await client.create(*args, **kwargs)
+        raise ValueError("invalid request")
+
+    client.chat.completions.create = fail
+    with pytest.raises(ValueError):
+        await router.ahandle_request("prompt", client, 0)
+    assert router.stats()["hedges"] == 1
+    assert router.stats()["hedges_won"] == 0
+
+
+def test_hedge_allowance_does_not_build_up():
+    router = ModelRouter(SLOW, max_hedge_ratio=0.1, tracker=warm_tracker(GPT4o_MINI=0.02))
+    assert router.hedge_delay(SLOW) is None  # no calls yet
+
+    # A long quiet period: only the recent calls count
+    router._recent.extend([False] * 10_000)
+    hedges = 0
+    while router.hedge_delay(SLOW) is not None:
+        router._recent.append(True)
+        hedges += 1
+    assert hedges <= 0.1 * router.tracker.window
+
+
+@pytest.mark.asyncio
+async def test_fast_call_is_not_hedged():
+    client = SlowChatClient({SLOW: 0.01})
+    router = ModelRouter(SLOW, max_hedge_ratio=1.0, tracker=warm_tracker(GPT4o_MINI=0.5))
+
+    await router.ahandle_request("prompt", client, 0)
+    assert client.calls == [SLOW]
+    assert router.hedges == 0
+
+
+def test_short_texts_go_to_the_fastest_model():
+    router = ModelRouter(SLOW, models=[SLOW, FAST], short_text_max_tokens=10, tracker=warm_tracker(GPT4o_MINI=0.8))
+
+    # The latency of FAST is unknown: it gets the short texts until it is known
+    assert router.choose("ok, fine") == FAST
+    router.tracker = warm_tracker(GPT4o_MINI=0.8, GPT3_TURBO=0.3)
+    assert router.choose("ok, fine") == FAST
+    assert router.choose("you never " * 20) == SLOW
+    router.tracker = warm_tracker(GPT4o_MINI=0.2, GPT3_TURBO=0.3)
+    assert router.choose("ok, fine") == SLOW
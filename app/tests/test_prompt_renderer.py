@@ -0,0 +1,72 @@
+import pytest
+
+from app.utils.openai_config import OpenAIModels
+from app.utils.prompt_renderer import PromptRenderer, normalize_whitespace, prompt_token_budget
+from app.utils.prompts import build_prompt
+from app.utils.tokens import count_tokens
+
+MODEL = OpenAIModels.GPT4o_MINI
+
+EXAMPLES = [
+    {"dysfunctional": "You never help   with the dishes.", "functional": "Could you help me with the dishes tonight?"},
+    {"dysfunctional": "You always " + "complain about everything " * 40, "functional": "I feel criticized lately."},
+    {"dysfunctional": "Whatever.", "functional": "I need a moment before we talk."},
+]
+
+
+def test_normalize_whitespace():
+    text = """
+        ### Title
+            indented   line\t with  spaces
+
+
+
+        last line
+    """
+    assert normalize_whitespace(text) == "### Title\nindented line with spaces\n\nlast line"
+
+
+def test_render_without_budget_is_compact():
+    renderer = PromptRenderer(MODEL)
+    prompt = renderer.render("  I am tired of waiting for you  ", EXAMPLES)
+
+    assert prompt.num_examples == 3
+    assert "\n    " not in prompt.text
+    assert "- Input: You never help with the dishes." in prompt.text
+    assert prompt.text.endswith("\nI am tired of waiting for you")
+    assert prompt.tokens == count_tokens(prompt.text, MODEL)
+    legacy_tokens = count_tokens(build_prompt("I am tired of waiting for you", EXAMPLES), MODEL)
+    assert prompt.tokens_saved == pytest.approx(legacy_tokens - prompt.tokens, abs=5)
+    assert prompt.tokens_saved > 0
+
+
+def test_render_fits_examples_in_budget():
+    unlimited = PromptRenderer(MODEL).render("I am tired of waiting for you", EXAMPLES)
+    renderer = PromptRenderer(MODEL, token_budget=unlimited.tokens - 50)
+    prompt = renderer.render("I am tired of waiting for you", EXAMPLES)
+
+    # The long example is skipped, the shorter one after it still fits
+    assert prompt.num_examples == 2
+    assert prompt.num_dropped == 1
+    assert "complain about everything" not in prompt.text
+    assert "- Input: Whatever." in prompt.text
+    assert prompt.tokens <= renderer.token_budget
+
+    # No room for any example: the examples section is left out
+    prompt = PromptRenderer(MODEL, token_budget=10).render("I am tired of waiting for you", EXAMPLES)
+    assert prompt.num_examples == 0
+    assert "### Examples" not in prompt.text
+
+    assert renderer.stats()["rendered"] == 1
+    assert renderer.stats()["dropped_examples"] == 1
+
+
+def test_prompt_token_budget():
+    assert prompt_token_budget(OpenAIModels.GPT4, completion_tokens=192) == 8_000
+    assert prompt_token_budget(OpenAIModels.GPT4, max_tokens=1_000) == 1_000
+    assert prompt_token_budget(OpenAIModels.TEXT_EMB_3_SMALL, max_tokens=1_000) == 1_000
+
+
+def test_invalid_template():
+    with pytest.raises(ValueError):
+        PromptRenderer(MODEL, example="- Input: {text}")
@@ -0,0 +1,198 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import BadRequestError, InternalServerError, RateLimitError
+
+from app.utils.rate_limiter import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    RetryError,
+    get_retry_after,
+    retry_with_exponential_backoff,
+)
+from app.utils.prompts import aget_embeddings, get_embedding
+
+
+def api_error(error_class, status_code, headers=None):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return error_class("error", response=response, body=None)
+
+
+def flaky(errors):
+    """Return a function that raises the given errors, then returns 'ok'."""
+    calls = []
+
+    def func():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return func, calls
+
+
+def test_get_retry_after():
+    assert get_retry_after(api_error(RateLimitError, 429, {"retry-after": "2"})) == 2
+    assert get_retry_after(api_error(RateLimitError, 429, {"retry-after-ms": "150"})) == 0.15
+    assert get_retry_after(api_error(RateLimitError, 429)) is None
+    assert get_retry_after(ValueError()) is None
+
+
+def test_retries_transient_errors_and_honors_retry_after():
+    func, calls = flaky([
+        api_error(RateLimitError, 429, {"retry-after-ms": "100"}),
+        api_error(InternalServerError, 503),
+    ])
+    wrapped = retry_with_exponential_backoff(func, initial_delay=0.01, jitter=False, budget=None, breaker=None)
+    assert wrapped() == "ok"
+    assert len(calls) == 3
+    assert calls[1] - calls[0] >= 0.1
+
+
+def test_does_not_retry_client_errors():
+    func, calls = flaky([api_error(BadRequestError, 400)])
+    wrapped = retry_with_exponential_backoff(func, initial_delay=0.01, budget=None, breaker=None)
+    with pytest.raises(BadRequestError):
+        wrapped()
+    assert len(calls) == 1
+
+
+def test_gives_up_after_max_retries_and_deadline():
+    func, calls = flaky([api_error(InternalServerError, 500)] * 10)
+    wrapped = retry_with_exponential_backoff(func, initial_delay=0.01, max_retries=2, budget=None, breaker=None)
+    with pytest.raises(RetryError):
+        wrapped()
+    assert len(calls) == 3
+
+    # The server asks to wait longer than the deadline: give up without sleeping
+    func, calls = flaky([api_error(RateLimitError, 429, {"retry-after": "30"})])
+    wrapped = retry_with_exponential_backoff(func, deadline=1, budget=None, breaker=None)
+    start = time.monotonic()
+    with pytest.raises(RetryError):
+        wrapped()
+    assert time.monotonic() - start < 0.5
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0, max_tokens=1)
+    func, calls = flaky([api_error(InternalServerError, 500)] * 10)
+    wrapped = retry_with_exponential_backoff(func, initial_delay=0.01, max_retries=5, budget=budget, breaker=None)
+    with pytest.raises(RetryError):
+        wrapped()
+    assert len(calls) == 2  # one retry, then the budget is empty
+    assert budget.stats()["exhausted"] == 1
+
+
+def test_circuit_breaker_fails_fast_then_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+    func, calls = flaky([api_error(InternalServerError, 500)] * 2)
+    wrapped = retry_with_exponential_backoff(func, initial_delay=0.01, max_retries=0, budget=None, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(RetryError):
+            wrapped()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        wrapped()
+    assert len(calls) == 2  # the upstream was not called
+
+    time.sleep(0.1)
+    assert wrapped() == "ok"  # half-open trial succeeds
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_call_releases_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    breaker.record_failure()
+    started = asyncio.Event()
+
+    @retry_with_exponential_backoff(initial_delay=0.01, budget=None, breaker=breaker)
+    async def func(hang):
+        if hang:
+            started.set()
+            await asyncio.sleep(10)
+        return "ok"
+
+    await asyncio.sleep(0.05)
+    trial = asyncio.create_task(func(True))
+    await started.wait()
+    with pytest.raises(CircuitOpenError):
+        await func(False)  # the trial is in flight
+
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    assert await func(False) == "ok"  # the next call is the trial
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_rate_limited_trial_call_releases_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.05)
+
+    # The trial gets a 429 and gives up: the next call is the trial
+    func, calls = flaky([api_error(RateLimitError, 429, {"retry-after-ms": "10"})])
+    with pytest.raises(RetryError):
+        retry_with_exponential_backoff(func, max_retries=0, budget=None, breaker=breaker)()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    # The trial gets a 429 and retries: its retry is the trial
+    func, calls = flaky([api_error(RateLimitError, 429, {"retry-after-ms": "10"})])
+    assert retry_with_exponential_backoff(func, budget=None, breaker=breaker)() == "ok"
+    assert len(calls) == 2
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_embedding_calls_are_retried():
+    error = api_error(RateLimitError, 429, {"retry-after-ms": "10"})
+    response = SimpleNamespace(
+        data=[SimpleNamespace(index=0, embedding=[1.0, 0.0])],
+        usage=SimpleNamespace(total_tokens=3),
+    )
+    func, calls = flaky([error])
+
+    async def acreate(**kwargs):
+        func()
+        return response
+
+    client = SimpleNamespace(embeddings=SimpleNamespace(create=acreate))
+    assert await aget_embeddings(["some text"], "model", client) == [[1.0, 0.0]]
+    assert len(calls) == 2
+
+    func, calls = flaky([error])
+    client = SimpleNamespace(embeddings=SimpleNamespace(create=lambda **kwargs: func() and response))
+    assert get_embedding("some text", "model", client) == [1.0, 0.0]
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_async_retries_do_not_block_the_event_loop():
+    attempts = []
+
+    @retry_with_exponential_backoff(initial_delay=0.2, jitter=False, budget=None, breaker=None)
+    async def func():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise api_error(RateLimitError, 429)
+        return "ok"
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    result, _ = await asyncio.gather(func(), ticker())
+    assert result == "ok"
+    assert ticks == 10
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils.request_handler import handle_request, ahandle_request
+from app.utils.response_cache import ResponseCache
+
+
+class FakeChatClient:
+    """Stand-in for the OpenAI client that counts the calls to chat.completions.create."""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f"transformed {self.calls}"))],
+            usage=SimpleNamespace(completion_tokens=3, prompt_tokens=10, total_tokens=13))
+
+
+class FakeAsyncChatClient(FakeChatClient):
+    """Async stand-in for the OpenAI client, with a fixed upstream latency."""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.sync_create = self.create
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.acreate))
+
+    async def acreate(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self.sync_create(**kwargs)
+
+
+def test_handle_request_without_cache():
+    client = FakeChatClient()
+    assert handle_request("prompt", client, "gpt-4o-mini", 0) == ("transformed 1", 13)
+    assert handle_request("prompt", client, "gpt-4o-mini", 0, return_from_cache=True) == ("transformed 2", 13, False)
+
+
+def test_handle_request_serves_deterministic_requests_from_cache(tmp_path):
+    client = FakeChatClient()
+    cache = ResponseCache(path=tmp_path / "responses.db")
+
+    assert handle_request("prompt", client, "gpt-4o-mini", 0, cache, return_from_cache=True) == ("transformed 1", 13, False)
+    assert handle_request("prompt", client, "gpt-4o-mini", 0, cache, return_from_cache=True) == ("transformed 1", 0, True)
+    assert handle_request("other prompt", client, "gpt-4o-mini", 0, cache, return_from_cache=True) == ("transformed 2", 13, False)
+    assert handle_request("prompt", client, "gpt-4o", 0, cache, return_from_cache=True) == ("transformed 3", 13, False)
+    assert client.calls == 3
+
+    # Persisted across restarts
+    restarted = ResponseCache(path=tmp_path / "responses.db")
+    assert handle_request("prompt", client, "gpt-4o-mini", 0, restarted, return_from_cache=True) == ("transformed 1", 0, True)
+
+
+def test_handle_request_bypasses_cache_with_temperature():
+    client = FakeChatClient()
+    cache = ResponseCache()
+
+    handle_request("prompt", client, "gpt-4o-mini", 0.7, cache)
+    assert handle_request("prompt", client, "gpt-4o-mini", 0.7, cache, return_from_cache=True) == ("transformed 2", 13, False)
+    assert cache.stats()["bypassed"] == 2
+    assert len(cache.memory) == 0
+
+
+def test_response_cache_max_bytes():
+    cache = ResponseCache(max_size=100, max_bytes=20)
+    cache.set_response("m", 0, "", "a", "x" * 15, (1, 1, 2))
+    cache.set_response("m", 0, "", "b", "y" * 15, (1, 1, 2))
+    assert cache.get_response("m", 0, "", "a") is None
+    assert cache.get_response("m", 0, "", "b") == ("y" * 15, (1, 1, 2))
+
+
+@pytest.mark.asyncio
+async def test_ahandle_request_with_cache():
+    client = FakeAsyncChatClient()
+    cache = ResponseCache()
+    assert await ahandle_request("prompt", client, "gpt-4o-mini", 0, cache) == ("transformed 1", 13, False)
+    assert await ahandle_request("prompt", client, "gpt-4o-mini", 0, cache) == ("transformed 1", 0, True)
+
+
+@pytest.mark.asyncio
+async def test_ahandle_request_runs_concurrently():
+    client = FakeAsyncChatClient(latency=0.2)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(ahandle_request(f"prompt {i}", client, "gpt-4o-mini", 0) for i in range(100)))
+    # 100 upstream calls of 200 ms overlap on a single event loop
+    assert time.perf_counter() - start < 2
+    assert len({text for text, _, _ in results}) == 100
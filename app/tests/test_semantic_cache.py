@@ -0,0 +1,131 @@
+import json
+import time
+
+import numpy as np
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.semantic_cache import SemanticCache
+
+
+def unit(rng, dim=32):
+    vector = rng.normal(size=dim)
+    return vector / np.linalg.norm(vector)
+
+
+def test_lookup_near_duplicates():
+    rng = np.random.default_rng(0)
+    cache = SemanticCache(threshold=0.95)
+    known = unit(rng)
+    cache.add(known, "You never listen to me", "I feel unheard when we talk")
+
+    paraphrase = known + 0.05 * unit(rng)
+    hit = cache.lookup(paraphrase)
+    assert hit.transformed_text == "I feel unheard when we talk"
+    assert hit.source == "history"
+    assert 0.95 <= hit.similarity < 1
+    assert cache.lookup(unit(rng)) is None
+
+    # The closest example of the corpus wins if it is closer
+    hit = cache.lookup(paraphrase, corpus_match=(0.999, "dysfunctional", "functional"))
+    assert (hit.source, hit.transformed_text, hit.similarity) == ("corpus", "functional", 0.999)
+
+    assert cache.stats() == {
+        "size": 1, "max_size": 10_000, "threshold": 0.95, "hits": 2, "hits_history": 1, "hits_corpus": 1,
+        "misses": 1, "hit_rate": 2 / 3, "evictions": 0, "bypassed": 0,
+    }
+
+    # Non-deterministic requests bypass the cache
+    assert cache.lookup(known, temperature=0.7) is None
+    assert cache.stats()["bypassed"] == 1
+
+
+def test_eviction_and_ttl():
+    rng = np.random.default_rng(1)
+    vectors = [unit(rng) for _ in range(4)]
+    cache = SemanticCache(threshold=0.99, max_size=3)
+    for i, vector in enumerate(vectors[:3]):
+        cache.add(vector, f"text {i}", f"functional {i}")
+
+    # "text 0" is used, so "text 1" is the least recently used
+    assert cache.lookup(vectors[0]).transformed_text == "functional 0"
+    cache.add(vectors[3], "text 3", "functional 3")
+    assert len(cache) == 3
+    assert cache.evictions == 1
+    assert cache.lookup(vectors[1]) is None
+    assert cache.lookup(vectors[3]).transformed_text == "functional 3"
+
+    # The same text is stored once
+    cache.add(vectors[3], "text  3", "functional 3 bis")
+    assert len(cache) == 3
+    assert cache.lookup(vectors[3]).transformed_text == "functional 3 bis"
+
+    cache = SemanticCache(threshold=0.99, ttl=0.05)
+    cache.add(vectors[0], "text 0", "functional 0")
+    assert cache.lookup(vectors[0]) is not None
+    time.sleep(0.06)
+    assert cache.lookup(vectors[0]) is None
+
+
+@pytest.mark.asyncio
+async def test_transform_message_reuses_transformations(fake_app, embeddings, monkeypatch):
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache(threshold=0.99))
+    # Embeddings far from the examples: only the past texts can match
+    rng = np.random.default_rng(2)
+    fake_app.table = rng.normal(size=embeddings.shape)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.post("/api/messages/", json={"original_text": "Why do you never listen to me"})
+        # Same length: same fake embedding, as for a paraphrase
+        second = await ac.post("/api/messages/", json={"original_text": "Why do you never listen to us"})
+
+        assert fake_app.chat_calls == 1
+        assert first.json()["semantic_similarity"] is None
+        assert "X-Semantic-Cache" not in first.headers
+        assert second.headers["X-Semantic-Cache"] == "history"
+        assert second.json()["transformed_text"] == "functional: Why do you never listen to me"
+        assert second.json()["semantic_similarity"] == pytest.approx(1, abs=1e-5)
+
+        # Embeddings of the examples themselves: the functional text of the example is reused
+        fake_app.table = embeddings
+        response = await ac.post("/api/messages/stream", json={"original_text": "Why do I always do the dishes"})
+        assert fake_app.chat_calls == 1
+        assert f"functional {len('Why do I always do the dishes') % len(embeddings) + 1}" in response.text
+
+        stats = (await ac.get("/api/admin/cache")).json()["semantic"]
+        assert (stats["hits_history"], stats["hits_corpus"], stats["misses"]) == (1, 1, 1)
+        assert 'dailogy_semantic_cache_hits_total{source="corpus"} 1' in (await ac.get("/metrics")).text
+
+
+@pytest.mark.asyncio
+async def test_semantic_similarity_is_set_by_the_server(fake_app, embeddings, monkeypatch):
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache(threshold=0.99))
+    rng = np.random.default_rng(3)
+    fake_app.table = rng.normal(size=embeddings.shape)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        # Misses: a value sent by the client is not stored
+        response = await ac.post("/api/messages/", json={"original_text": "You are always late", "semantic_similarity": 0.99})
+        assert response.json()["semantic_similarity"] is None
+        response = await ac.post("/api/messages/stream", json={"original_text": "You never call me back", "semantic_similarity": 0.99})
+        done = [line for line in response.text.splitlines() if line.startswith("data: ")][-1]
+        assert json.loads(done[len("data: "):])["message"]["semantic_similarity"] is None
+        assert fake_app.chat_calls == 2
+        assert all(message.semantic_similarity is None for message in main.messages)
+
+        # Corpus hit on the non-streamed endpoint
+        fake_app.table = embeddings
+        response = await ac.post("/api/messages/", json={"original_text": "Why do I always do the dishes"})
+        assert fake_app.chat_calls == 2
+        assert response.headers["X-Semantic-Cache"] == "corpus"
+        assert "X-LLM-Model" not in response.headers
+        assert response.json()["semantic_similarity"] == pytest.approx(1, abs=1e-5)
+
+
+def test_semantic_cache_is_not_used_with_local_embeddings(monkeypatch):
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache())
+    assert main.active_semantic_cache() is main.semantic_cache
+    monkeypatch.setattr(main, "EMBEDDING_PROVIDER", main.EmbeddingProvider.LOCAL)
+    assert main.active_semantic_cache() is None
@@ -0,0 +1,97 @@
+import asyncio
+import gc
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight()
+    started = []
+
+    async def compute(value):
+        started.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    results = await asyncio.gather(
+        *(flight.do("a", lambda: compute(1)) for _ in range(5)),
+        flight.do("b", lambda: compute(10)))
+
+    assert [result for result, _ in results] == [2] * 5 + [20]
+    assert [shared for _, shared in results] == [False, True, True, True, True, False]
+    assert started == [1, 10]
+    assert flight.stats()["upstream_calls"] == 2
+    assert flight.stats()["coalesced"] == 4
+    assert flight.stats()["in_flight"] == 0
+
+    # Once the computation is done, the next call starts a new one
+    await flight.do("a", lambda: compute(1))
+    assert started == [1, 10, 1]
+
+
+@pytest.mark.asyncio
+async def test_errors_are_shared_and_cancellation_is_not():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream error")
+
+    results = await asyncio.gather(flight.do("a", fail), flight.do("a", fail), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    first = asyncio.ensure_future(flight.do("b", compute))
+    second = asyncio.ensure_future(flight.do("b", compute))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == ("done", True)
+
+
+@pytest.mark.asyncio
+async def test_error_without_callers_is_retrieved():
+    flight = SingleFlight()
+    loop = asyncio.get_running_loop()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream error")
+
+    caller = asyncio.ensure_future(flight.do("a", fail))
+    await asyncio.sleep(0)
+    caller.cancel()  # the only caller is gone: the computation fails on its own
+    await asyncio.sleep(0.05)
+    del caller
+    gc.collect()
+    loop.set_exception_handler(None)
+    assert errors == []
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_are_coalesced(fake_app):
+    text = "You forgot my birthday again"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        responses = await asyncio.gather(*(
+            ac.post("/api/messages/", json={"original_text": text}) for _ in range(5)))
+
+    assert all(response.status_code == 200 for response in responses)
+    ids = {response.json()["id"] for response in responses}
+    assert len(ids) == 5
+    assert {response.json()["transformed_text"] for response in responses} == {f"functional: {text}"}
+    assert len(main.messages) == 5
+    assert int(responses[0].headers["X-Prompt-Tokens-Saved"]) > 0
+
+    assert fake_app.chat_calls == 1
+    assert len(fake_app.embedding_calls) == 1
+    assert main.transformations.stats()["coalesced"] == 4
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+from app.utils.startup import StartupTracker
+
+
+def test_import_does_not_load_heavy_modules():
+    code = "import sys, app.main; print(','.join(m for m in ('sklearn', 'scipy') if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        env={**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "sk-test")})
+    assert result.stdout.strip() == ""
+
+
+@pytest.mark.asyncio
+async def test_ready_after_warm_up(fake_app, monkeypatch):
+    monkeypatch.setattr(main, "startup", StartupTracker())
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/ready")
+        assert response.status_code == 503
+
+        await main.warm_up()
+        response = await ac.get("/ready")
+
+    assert response.status_code == 200
+    status = response.json()
+    assert status["ready"]
+    assert {"example_index", "tokenizers", "upstream_connections"} <= set(status["phases_ms"])
+    assert status["errors"] == {}
+    assert fake_app.model_list_calls == main.WARMUP_UPSTREAM_CONNECTIONS
+
+
+@pytest.mark.asyncio
+async def test_not_ready_without_example_index(fake_app, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "startup", StartupTracker())
+    monkeypatch.setattr(main, "PATH_EMB_DB", tmp_path / "missing.db")
+    monkeypatch.setattr(main, "WARMUP_UPSTREAM", False)
+
+    await main.warm_up()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/ready")
+
+    assert response.status_code == 503
+    assert "missing.db" in response.json()["errors"]["example_index"]
+    assert "upstream_connections" not in response.json()["phases_ms"]
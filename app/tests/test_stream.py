@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+import app.main as main
+from app.main import app
+
+
+def parse_sse(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.mark.asyncio
+async def test_transform_message_stream(fake_app):
+    text = "Why do you never listen to me"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/api/messages/stream", json={"original_text": text})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+
+    assert events[0][0] == "start"
+    deltas = [data["text"] for event, data in events if event == "delta"]
+    assert len(deltas) > 1
+    assert "".join(deltas) == f"functional: {text}"
+
+    event, data = events[-1]
+    assert event == "done"
+    assert data["message"]["id"] == events[0][1]["id"]
+    assert data["message"]["transformed_text"] == f"functional: {text}"
+    assert data["token_usage"] == {"completion_tokens": 5, "prompt_tokens": 100, "total_tokens": 105}
+    # The token budget decides how many of the candidate examples are used
+    assert data["prompt"]["num_examples"] + data["prompt"]["num_dropped"] == main.NUM_CANDIDATE_EXAMPLES
+    assert data["prompt"]["tokens"] <= data["prompt"]["budget"]
+    assert data["prompt"]["tokens_saved"] > 0
+    assert [message.transformed_text for message in main.messages] == [f"functional: {text}"]
+
+
+@pytest.mark.asyncio
+async def test_transform_message_stream_from_cache(fake_app):
+    text = "Why do you never listen to me"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        await ac.post("/api/messages/stream", json={"original_text": text})
+        response = await ac.post("/api/messages/stream", json={"original_text": text})
+
+    events = parse_sse(response.text)
+    assert [event for event, _ in events] == ["start", "delta", "done"]
+    assert events[-1][1]["message"]["from_cache"] is True
+    assert fake_app.chat_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_transform_message_stream_error(fake_app):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/api/messages/stream", json={"original_text": "This one should FAIL"})
+
+    events = parse_sse(response.text)
+    assert events[-1][0] == "error"
+    assert len(main.messages) == 0
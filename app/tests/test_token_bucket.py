@@ -0,0 +1,90 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app.utils.token_bucket import ModelRateLimiter, RateLimiterRegistry, SQLiteBucketStore
+from app.utils.tokens import count_tokens
+
+
+def drain_requests(limiter):
+    while limiter.try_acquire(0) == 0:
+        pass
+
+
+def test_try_acquire_waits_for_both_buckets():
+    limiter = ModelRateLimiter("model", rpm=600, tpm=60_000)
+    assert limiter.try_acquire(50_000) == 0
+    # 10_000 tokens left, refilled at 1_000 tokens per second
+    wait = limiter.try_acquire(20_000)
+    assert 9.9 < wait <= 10
+
+    drain_requests(limiter)
+    assert 0 < limiter.try_acquire(0) <= 0.1
+
+
+def test_reconcile_gives_back_unused_tokens():
+    limiter = ModelRateLimiter("model", rpm=600, tpm=60_000)
+    assert limiter.try_acquire(60_000) == 0
+    assert limiter.try_acquire(10_000) > 0
+    limiter.reconcile(estimated_tokens=60_000, actual_tokens=40_000)
+    assert limiter.try_acquire(10_000) == 0
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_served_in_order():
+    limiter = ModelRateLimiter("model", rpm=600, tpm=1_000_000)
+    drain_requests(limiter)
+
+    order = []
+
+    async def request(i):
+        await limiter.acquire(10)
+        order.append(i)
+
+    start = time.monotonic()
+    await asyncio.gather(*(request(i) for i in range(5)))
+    # One request every 100 ms
+    assert 0.4 < time.monotonic() - start < 1
+    assert order == [0, 1, 2, 3, 4]
+    assert limiter.stats()["throttled"] == 5
+
+
+def test_sqlite_store_shares_the_quota(tmp_path):
+    worker_1 = ModelRateLimiter("model", rpm=600, tpm=60_000, store=SQLiteBucketStore(tmp_path / "limits.db"))
+    worker_2 = ModelRateLimiter("model", rpm=600, tpm=60_000, store=SQLiteBucketStore(tmp_path / "limits.db"))
+    assert worker_1.try_acquire(60_000) == 0
+    assert worker_2.try_acquire(10_000) > 0
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_does_not_block_the_event_loop(tmp_path):
+    store = SQLiteBucketStore(tmp_path / "buckets.db")
+    limiter = ModelRateLimiter("gpt-4o-mini", rpm=60, tpm=100_000, store=store)
+
+    # Another worker holds the write lock for 0.5 s
+    other = sqlite3.connect(tmp_path / "buckets.db", isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.5, other.execute, ("COMMIT",)).start()
+
+    acquire = asyncio.ensure_future(limiter.acquire(100))
+    await asyncio.sleep(0.1)
+    assert not acquire.done()  # the event loop kept running while the limiter waited
+    await acquire
+    await limiter.areconcile(100, 50)
+    assert limiter.acquired == 1
+    store.close()
+
+
+def test_registry():
+    registry = RateLimiterRegistry()
+    registry.configure({"gpt-4o-mini": {"rpm": 500, "tpm": 200_000}})
+    assert registry.get("gpt-4o-mini").rpm == 500
+    assert registry.get("unknown") is None
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert 2 <= count_tokens("Hello, how are you?") <= 6
@@ -1,25 +1,117 @@
-from .client import initialize_openai_client
+from .cache import LRUCache, SQLiteCache, TieredCache
+from .client import initialize_openai_client, initialize_async_openai_client
 from .config import OPENAI_API_KEY
-from .models import TextModel, MessageUpdateRequest
-from.openai_config import OpenAIModels, MODEL_TOKEN_LIMITS
-from .prompts import get_embedding, load_examples, find_closest, select_examples, create_dynamic_prompt
-from .rate_limiter import retry_with_exponential_backoff
-from .request_handler import count_token_usage, send_request, handle_request
+from .compression import CompressionMiddleware
+from .models import TextModel, MessageUpdateRequest, BatchTransformRequest, BatchItemResult, BatchTransformResponse
+from.openai_config import OpenAIModels, MODEL_TOKEN_LIMITS, MODEL_RATE_LIMITS
+from .ann_index import IVFIndex
+from .benchmark import run_benchmarks, compare_results
+from .embedding_cache import EmbeddingCache
+from .local_embeddings import EmbeddingBackend, EmbeddingProvider, LocalEmbeddingBackend, build_local_index, get_local_backend
+from .load_generator import LoadReport, run_load
+from .mock_openai import LatencyModel, MockOpenAI
+from .metrics import MetricsRegistry, MetricsMiddleware, metrics, stage
+from .model_router import LatencyTracker, ModelRouter
+from .message_store import InMemoryMessageStore, SQLiteMessageStore
+from .example_index import RetrievalBackend, ExampleIndex, ExampleIndexManager, build_mmap_index, get_index_manager, get_example_index
+from .prompts import (
+    get_embedding, aget_embedding, aget_embeddings, load_examples, find_closest, retrieve_examples, retrieve_examples_batch,
+    select_examples, aselect_examples, aselect_examples_scored, aselect_examples_batch, create_dynamic_prompt, acreate_dynamic_prompt, build_prompt
+)
+from .rate_limiter import retry_with_exponential_backoff, Retrying, RetryError, RetryBudget, CircuitBreaker, CircuitOpenError
+from .prompt_renderer import PromptRenderer, RenderedPrompt, normalize_whitespace, prompt_token_budget
+from .response_cache import ResponseCache
+from .semantic_cache import SemanticCache, SemanticHit
+from .single_flight import SingleFlight
+from .startup import StartupTracker
+from .token_bucket import ModelRateLimiter, RateLimiterRegistry, rate_limiters
+from .tokens import count_tokens, count_message_tokens
+from .request_handler import (
+    count_token_usage, send_request, asend_request, astream_request, handle_request, ahandle_request, ahandle_request_stream
+)
 
 __all__ = [
+    "LRUCache",
+    "SQLiteCache",
+    "TieredCache",
     "initialize_openai_client",
+    "initialize_async_openai_client",
     "OPENAI_API_KEY",
+    "CompressionMiddleware",
     "TextModel"
     "MessageUpdateRequest",
+    "BatchTransformRequest",
+    "BatchItemResult",
+    "BatchTransformResponse",
     "OpenAIModels"
     "MODEL_TOKEN_LIMITS",
+    "MODEL_RATE_LIMITS",
+    "IVFIndex",
+    "run_benchmarks",
+    "compare_results",
+    "EmbeddingCache",
+    "EmbeddingBackend",
+    "EmbeddingProvider",
+    "LocalEmbeddingBackend",
+    "build_local_index",
+    "get_local_backend",
+    "LoadReport",
+    "run_load",
+    "LatencyModel",
+    "MockOpenAI",
+    "MetricsRegistry",
+    "MetricsMiddleware",
+    "metrics",
+    "stage",
+    "LatencyTracker",
+    "ModelRouter",
+    "InMemoryMessageStore",
+    "SQLiteMessageStore",
+    "RetrievalBackend",
+    "ExampleIndex",
+    "ExampleIndexManager",
+    "build_mmap_index",
+    "get_index_manager",
+    "get_example_index",
     "get_embedding"
     "load_examples",
+    "aget_embedding",
+    "aget_embeddings",
     "find_closest",
+    "retrieve_examples",
+    "retrieve_examples_batch",
     "select_examples",
+    "aselect_examples",
+    "aselect_examples_scored",
+    "aselect_examples_batch",
     "create_dynamic_prompt",
+    "acreate_dynamic_prompt",
+    "build_prompt",
     "retry_with_exponential_backoff",
+    "Retrying",
+    "RetryError",
+    "RetryBudget",
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "PromptRenderer",
+    "RenderedPrompt",
+    "normalize_whitespace",
+    "prompt_token_budget",
+    "ResponseCache",
+    "SemanticCache",
+    "SemanticHit",
+    "SingleFlight",
+    "StartupTracker",
+    "ModelRateLimiter",
+    "RateLimiterRegistry",
+    "rate_limiters",
+    "count_tokens",
+    "count_message_tokens",
     "count_token_usage",
     "send_request",
+    "asend_request",
+    "astream_request",
     "handle_request",
+    "ahandle_request",
+    "ahandle_request_stream",
 ]
@@ -0,0 +1,288 @@
+import hashlib
+import time
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.similarity import normalize_rows, top_k
+
+
+def ann_index_path(path_emb: Path) -> Path:
+    """
+    Return the path of the ANN index persisted next to a .db file (e.g. embeddings.ivf.npz).
+    """
+
+    path_emb = Path(path_emb)
+    return path_emb.with_name(path_emb.stem + ".ivf.npz")
+
+
+def corpus_fingerprint(ids: np.ndarray, matrix: np.ndarray) -> str:
+    """
+    Return a fingerprint of a corpus (ids, shape, and a sample of the rows), used to check that
+    a persisted ANN index was built from the same examples as the index it is attached to.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(str(matrix.shape).encode())
+    digest.update(np.ascontiguousarray(ids).tobytes())
+    step = max(1, matrix.shape[0] // 1024)
+    digest.update(np.ascontiguousarray(matrix[::step], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def assign_clusters(matrix: np.ndarray, centroids: np.ndarray, batch_size: int = 65_536) -> np.ndarray:
+    """
+    Return the index of the closest centroid (highest dot product) of each row, computed in batches
+    to bound the size of the score matrix.
+    """
+
+    assignments = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], batch_size):
+        scores = matrix[start:start + batch_size] @ centroids.T
+        assignments[start:start + batch_size] = scores.argmax(axis=1)
+    return assignments
+
+
+def spherical_kmeans(matrix: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Cluster unit-norm rows with k-means on the cosine similarity (centroids are renormalized after each step).
+
+    Parameters:
+    -----------
+    matrix: np.ndarray
+        A float32 matrix with unit-norm rows.
+    n_clusters: int
+        Number of clusters.
+    n_iter: int
+        Number of iterations.
+    seed: int
+        Seed of the random initialization.
+
+    Returns:
+    -----------
+    np.ndarray
+        A float32 matrix with the unit-norm centroids, one per row.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    centroids = matrix[rng.choice(n, n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = assign_clusters(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+
+        # Reseed empty clusters with random rows
+        empty = np.bincount(assignments, minlength=n_clusters) == 0
+        if empty.any():
+            sums[empty] = matrix[rng.choice(n, int(empty.sum()), replace=False)]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over the rows of an example matrix.
+
+    The rows are clustered offline with spherical k-means; each cluster keeps the list of its rows.
+    A search scores the query against the centroids, then only against the rows of the `nprobe`
+    closest clusters. The index stores row indices only: the vectors are those of the ExampleIndex
+    it is attached to.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray, fingerprint: str, nprobe: int = 8):
+        """
+        Parameters:
+        -----------
+        centroids: np.ndarray
+            Unit-norm centroids, one per cluster (inverted list).
+        list_offsets: np.ndarray
+            The rows of cluster c are list_rows[list_offsets[c]:list_offsets[c + 1]].
+        list_rows: np.ndarray
+            Row indices of the example matrix, grouped by cluster.
+        fingerprint: str
+            Fingerprint of the corpus the index was built from (see `corpus_fingerprint`).
+        nprobe: int
+            Default number of clusters to scan per query.
+        """
+
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_rows = np.asarray(list_rows, dtype=np.int64)
+        self.fingerprint = fingerprint
+        self.nprobe = nprobe
+
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+
+    @classmethod
+    def build(cls, ids: np.ndarray, matrix: np.ndarray, n_lists: int | None = None, n_iter: int = 20,
+              max_train_size: int | None = None, seed: int = 0, nprobe: int = 8) -> "IVFIndex":
+        """
+        Build the index over the rows of a normalized example matrix.
+
+        Parameters:
+        -----------
+        ids: np.ndarray
+            Ids of the examples (used for the fingerprint).
+        matrix: np.ndarray
+            A float32 matrix with unit-norm rows.
+        n_lists: int | None
+            Number of clusters. Default: about the square root of the number of rows.
+        n_iter: int
+            Number of k-means iterations.
+        max_train_size: int | None
+            Maximum number of rows used to train the centroids. Default: 256 rows per cluster.
+        seed: int
+            Seed of the random initialization and sampling.
+        nprobe: int
+            Default number of clusters to scan per query.
+        """
+
+        n = matrix.shape[0]
+        if n == 0:
+            raise ValueError("Cannot build an ANN index over an empty corpus.")
+        if n_lists is None:
+            n_lists = max(1, int(round(np.sqrt(n))))
+        n_lists = min(n_lists, n)
+        if max_train_size is None:
+            max_train_size = 256 * n_lists
+
+        rng = np.random.default_rng(seed)
+        train = matrix if n <= max_train_size else matrix[np.sort(rng.choice(n, max_train_size, replace=False))]
+        centroids = spherical_kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+
+        assignments = assign_clusters(matrix, centroids)
+        list_rows = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(centroids, list_offsets, list_rows, corpus_fingerprint(ids, matrix), nprobe)
+
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, top_n: int = 5, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows of the example matrix approximately most similar to a normalized query.
+
+        Parameters:
+        -----------
+        matrix: np.ndarray
+            The normalized example matrix the index was built from.
+        query: np.ndarray
+            A unit-norm float32 query vector.
+        top_n: int
+            Number of rows to return.
+        nprobe: int | None
+            Number of clusters to scan. Default: the index's nprobe.
+
+        Returns:
+        -----------
+        tuple
+            indices: np.ndarray
+                Row indices, from the most to the least similar.
+            similarities: np.ndarray
+                Cosine similarities of the selected rows.
+        """
+
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        centroid_scores = self.centroids @ query
+        while True:
+            probes = top_k(centroid_scores, nprobe)
+            rows = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+            # Scan more clusters if the probed ones hold fewer than top_n rows
+            if len(rows) >= min(top_n, len(self.list_rows)) or nprobe >= self.n_lists:
+                break
+            nprobe = min(2 * nprobe, self.n_lists)
+
+        scores = matrix[rows] @ query
+        best = top_k(scores, top_n)
+
+        return rows[best], scores[best]
+
+
+    def save(self, path: Path):
+        """
+        Persist the index as a .npz file (no pickled objects).
+        """
+
+        # Write to a temporary file first, so a reader never sees a partial index
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_rows=self.list_rows,
+                fingerprint=np.array(self.fingerprint),
+                nprobe=np.array(self.nprobe))
+        tmp.replace(path)
+
+
+    @classmethod
+    def load(cls, path: Path) -> "IVFIndex":
+        """
+        Load an index saved with `save`.
+        """
+
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                centroids=data["centroids"],
+                list_offsets=data["list_offsets"],
+                list_rows=data["list_rows"],
+                fingerprint=str(data["fingerprint"]),
+                nprobe=int(data["nprobe"]))
+
+
+def recall_report(index, queries: np.ndarray, k: int = 5, nprobes: tuple = (1, 2, 4, 8, 16, 32)) -> list[dict]:
+    """
+    Compare the ANN search of an ExampleIndex with the exact search.
+
+    Parameters:
+    -----------
+    index: ExampleIndex
+        An example index with an attached IVF index.
+    queries: np.ndarray
+        Query embeddings, one per row.
+    k: int
+        Number of neighbours to compare (recall@k).
+    nprobes: tuple
+        Values of nprobe to evaluate.
+
+    Returns:
+    -----------
+    list[dict]
+        One entry per nprobe with the recall@k and the mean search latency (exact and ANN) in ms.
+    """
+
+    exact, exact_seconds = [], 0.0
+    for query in queries:
+        start = time.perf_counter()
+        indices, _ = index.search(query, k)
+        exact_seconds += time.perf_counter() - start
+        exact.append(set(indices.tolist()))
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > index.ann.n_lists:
+            break
+        hits, ann_seconds = 0, 0.0
+        for query, expected in zip(queries, exact):
+            start = time.perf_counter()
+            indices, _ = index.search(query, k, backend="ivf", nprobe=nprobe)
+            ann_seconds += time.perf_counter() - start
+            hits += len(expected.intersection(indices.tolist()))
+        report.append({
+            "nprobe": nprobe,
+            f"recall@{k}": hits / sum(len(expected) for expected in exact),
+            "exact_ms": 1000 * exact_seconds / len(queries),
+            "ann_ms": 1000 * ann_seconds / len(queries),
+        })
+
+    return report
@@ -0,0 +1,290 @@
+import gc
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from app.utils.embedding_store import create_binary_db, encode_embedding
+from app.utils.example_index import ExampleIndex, build_mmap_index
+from app.utils.mmap_index import mmap_index_path
+from app.utils.openai_config import OpenAIModels
+from app.utils.prompt_renderer import PromptRenderer
+from app.utils.prompts import build_prompt, find_closest, load_examples
+
+# Dimension of the text-embedding-3-small embeddings of embeddings.db
+EMBEDDING_DIM = 1536
+
+# Words of the synthetic texts
+_WORDS = ("you", "never", "always", "listen", "money", "kids", "kitchen", "late", "again", "why", "me", "care",
+          "weekend", "plans", "forgot", "talk", "help", "tired", "house", "call")
+
+
+def synthetic_corpus_path(folder: Path, num_examples: int, dim: int, seed: int = 0) -> Path:
+    return Path(folder, f"bench_{num_examples}x{dim}_s{seed}.db")
+
+
+def build_synthetic_corpus(path: Path, num_examples: int, dim: int = EMBEDDING_DIM, seed: int = 0,
+                           batch_size: int = 10_000) -> Path:
+    """
+    Write an embedding database (float32 format) with random examples: texts of 10 to 40 words,
+    and random unit-norm embeddings. An existing file is kept (the corpora are deterministic).
+
+    Parameters:
+    -----------
+    path: Path
+        The .db file to write.
+    num_examples: int
+        Number of examples.
+    dim: int
+        Dimension of the embeddings.
+    seed: int
+        Seed of the texts and embeddings.
+    batch_size: int
+        Examples generated and written per transaction (bounds the memory used).
+
+    Returns:
+    -----------
+    Path
+        The path of the database.
+    """
+
+    path = Path(path)
+    if path.exists():
+        return path
+
+    rng = np.random.default_rng(seed)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp)
+    with conn:
+        create_binary_db(conn, dim, {"embedding_model": "synthetic"})
+        for start in range(0, num_examples, batch_size):
+            stop = min(start + batch_size, num_examples)
+            embeddings = rng.normal(size=(stop - start, dim)).astype(np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+            lengths = rng.integers(10, 40, size=(stop - start, 2))
+            conn.executemany(
+                "INSERT INTO examples (id, dysfunctional, embedding, functional) VALUES (?, ?, ?, ?)",
+                [(start + i + 1,
+                  " ".join(rng.choice(_WORDS, lengths[i, 0])),
+                  encode_embedding(embeddings[i]),
+                  " ".join(rng.choice(_WORDS, lengths[i, 1])))
+                 for i in range(stop - start)])
+    conn.close()
+    tmp.replace(path)
+    return path
+
+
+def time_stage(func: Callable[[], object], repeat: int = 5, warmup: int = 1, measure_memory: bool = True) -> dict:
+    """
+    Time a function, then measure the peak of the memory it allocates.
+
+    The peak is measured with tracemalloc (which also tracks the numpy arrays) in a separate call,
+    so that its overhead does not distort the timings.
+
+    Returns:
+    -----------
+    dict
+        The mean, median, min and max time of a call (in ms), the number of calls timed,
+        and the peak memory allocated during a call (in MiB, None if not measured).
+    """
+
+    for _ in range(warmup):
+        func()
+
+    # As timeit: no garbage collection during the timed calls
+    times = []
+    gc.collect()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(1000 * (time.perf_counter() - start))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    peak_mib = None
+    if measure_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_mib = peak / 2 ** 20
+
+    return {
+        "mean_ms": float(np.mean(times)),
+        "median_ms": float(np.median(times)),
+        "min_ms": float(np.min(times)),
+        "max_ms": float(np.max(times)),
+        "repeat": repeat,
+        "peak_mib": peak_mib,
+    }
+
+
+def _find_closest_sklearn(input_embedding: np.ndarray, examples: list[dict], top_n: int = 5) -> list[dict]:
+    # The original find_closest: pairwise cosine similarity, then a full argsort
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    embeddings = np.array([example["embedding"] for example in examples])
+    similarities = cosine_similarity([input_embedding], embeddings)[0]
+    indices = np.argsort(similarities)[::-1][:top_n]
+    return [{"dysfunctional": examples[i]["dysfunctional"], "functional": examples[i]["functional"]} for i in indices]
+
+
+def benchmark_corpus(path: Path, repeat: int = 5, top_n: int = 5, batch_size: int = 32,
+                     slow_stages_max_examples: int = 100_000, seed: int = 0) -> dict:
+    """
+    Time the CPU-side stages of the example selection and of the prompt assembly on one corpus.
+
+    Stages:
+    - read_db: `load_examples` (the examples as a list of dictionaries);
+    - build_index: `ExampleIndex.from_db` (the resident index, built at startup and on reload);
+    - map_index: `ExampleIndex.from_mmap` (the index mapped from its file, with INDEX_MMAP);
+    - find_closest_list: `find_closest` on the list of dictionaries (converted to an index on each call);
+    - find_closest_sklearn: the original implementation (`cosine_similarity` and a full argsort);
+    - search: `ExampleIndex.search`, the per-request search of the app;
+    - search_mapped: the same search on the mapped index (its pages in the page cache);
+    - search_batch: `ExampleIndex.search_batch` with `batch_size` queries;
+    - build_prompt: the prompt of `create_dynamic_prompt`;
+    - render_prompt: `PromptRenderer.render`.
+
+    The stages on the list of dictionaries are skipped above `slow_stages_max_examples` examples.
+
+    Returns:
+    -----------
+    dict
+        The timings of each stage (see `time_stage`), by stage name.
+    """
+
+    rng = np.random.default_rng(seed)
+    index = ExampleIndex.from_db(path)
+    query = rng.normal(size=index.dim).astype(np.float32)
+    queries = rng.normal(size=(batch_size, index.dim)).astype(np.float32)
+    slow_repeat = max(1, repeat // 2)
+
+    stages = {}
+    small = len(index) <= slow_stages_max_examples
+    if small:
+        stages["read_db"] = time_stage(lambda: load_examples(path), repeat=slow_repeat)
+    stages["build_index"] = time_stage(lambda: ExampleIndex.from_db(path), repeat=slow_repeat)
+    mmap_path = mmap_index_path(path)
+    if not mmap_path.exists():
+        build_mmap_index(path, mmap_path)
+    stages["map_index"] = time_stage(lambda: ExampleIndex.from_mmap(mmap_path), repeat=repeat)
+    if small:
+        examples = load_examples(path)
+        stages["find_closest_list"] = time_stage(lambda: find_closest(query, examples, top_n), repeat=slow_repeat)
+        stages["find_closest_sklearn"] = time_stage(lambda: _find_closest_sklearn(query, examples, top_n), repeat=slow_repeat)
+        del examples
+    stages["search"] = time_stage(lambda: index.search(query, top_n), repeat=10 * repeat)
+    mapped = ExampleIndex.from_mmap(mmap_path)
+    stages["search_mapped"] = time_stage(lambda: mapped.search(query, top_n), repeat=10 * repeat)
+    stages["search_batch"] = time_stage(lambda: index.search_batch(queries, top_n), repeat=repeat)
+
+    selected, _ = find_closest(query, index, top_n)
+    user_text = "Why do I always have to remind you about the kids' appointments?"
+    renderer = PromptRenderer(OpenAIModels.GPT4o_MINI)
+    stages["build_prompt"] = time_stage(lambda: build_prompt(user_text, selected), repeat=100 * repeat, measure_memory=False)
+    stages["render_prompt"] = time_stage(lambda: renderer.render(user_text, selected), repeat=10 * repeat, measure_memory=False)
+
+    return stages
+
+
+def environment_info() -> dict:
+    """
+    Return what identifies a benchmark run: the git commit, and the versions of Python and numpy, and the machine.
+    """
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_benchmarks(sizes: list[int], data_dir: Path, dim: int = EMBEDDING_DIM, repeat: int = 5, seed: int = 0,
+                   progress: Callable[[str], None] | None = None) -> dict:
+    """
+    Build (or reuse) a synthetic corpus of each size, and time the stages on each of them.
+
+    Returns:
+    -----------
+    dict
+        The environment (see `environment_info`), the parameters, and the results:
+        {"results": {"<size>": {"<stage>": {"mean_ms": ..., ...}}}}.
+    """
+
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    results = {}
+    for size in sizes:
+        path = synthetic_corpus_path(data_dir, size, dim, seed)
+        if progress is not None:
+            progress(f"corpus of {size} examples ({path})")
+        build_synthetic_corpus(path, size, dim, seed)
+        results[str(size)] = benchmark_corpus(path, repeat=repeat, seed=seed)
+
+    return {
+        "environment": environment_info(),
+        "parameters": {"dim": dim, "repeat": repeat, "seed": seed, "sizes": list(sizes)},
+        "results": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = 0.2, metric: str = "median_ms") -> list[dict]:
+    """
+    Compare two benchmark runs (as returned by `run_benchmarks`), stage by stage.
+
+    Parameters:
+    -----------
+    baseline: dict
+        The reference run.
+    current: dict
+        The new run.
+    threshold: float
+        Relative slowdown above which a stage is a regression (0.2: 20 % slower).
+    metric: str
+        The timing compared.
+
+    Returns:
+    -----------
+    list[dict]
+        One row per stage present in both runs: size, stage, baseline and current values, ratio,
+        and whether it is a regression.
+    """
+
+    rows = []
+    for size, stages in current["results"].items():
+        for stage, timing in stages.items():
+            reference = baseline.get("results", {}).get(size, {}).get(stage)
+            if reference is None:
+                continue
+            ratio = timing[metric] / reference[metric] if reference[metric] else float("inf")
+            rows.append({
+                "size": int(size),
+                "stage": stage,
+                "baseline": reference[metric],
+                "current": timing[metric],
+                "ratio": ratio,
+                "regression": ratio > 1 + threshold,
+            })
+    return rows
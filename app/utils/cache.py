@@ -0,0 +1,294 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with least-recently-used eviction.
+
+    Entries are evicted when the cache holds more than `max_size` entries or more than `max_bytes`
+    bytes (as measured by `size_of`), and expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None, max_bytes: int | None = None,
+                 size_of: Callable[[Any], int] | None = None):
+        """
+        Parameters:
+        -----------
+        max_size: int
+            Maximum number of entries.
+        ttl: float | None
+            Seconds after which an entry expires (None: entries don't expire).
+        max_bytes: int | None
+            Maximum total size of the entries (None: no limit). Requires `size_of`.
+        size_of: Callable[[Any], int] | None
+            Function returning the size in bytes of a value.
+        """
+
+        if max_bytes is not None and size_of is None:
+            raise ValueError("max_bytes requires a size_of function.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key: str) -> Any | None:
+        """
+        Return the value stored for the key, or None if it is missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key: str, value: Any):
+        """
+        Store a value, evicting the least recently used entries if the cache is full.
+        """
+
+        size = self.size_of(value) if self.size_of is not None else 0
+        if self.max_size <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            # Not stored: the previous value of the key must not be served instead
+            with self._lock:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._bytes -= old[2]
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteCache:
+    """
+    Persistent key-value store in a SQLite file (WAL mode), used as the second tier of a TieredCache.
+    Values are bytes; entries expire `ttl` seconds after they were stored. The expired entries are
+    deleted when the cache is opened, then by `set` every `purge_interval` seconds, so the file
+    does not grow without bound.
+    """
+
+    def __init__(self, path: Path, table: str = "cache", ttl: float | None = None, purge_interval: float = 3600):
+        """
+        Parameters:
+        -----------
+        path: Path
+            The .db file of the cache (created if missing).
+        table: str
+            Name of the table, so several caches can share a file.
+        ttl: float | None
+            Seconds after which an entry expires (None: entries don't expire).
+        purge_interval: float
+            Seconds between two deletions of the expired entries.
+        """
+
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.path = Path(path)
+        self.table = table
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.purged = 0
+        self.purge_expired()
+
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and row[1] + self.ttl <= time.time()):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()))
+            if self.ttl is not None and time.monotonic() >= self._next_purge:
+                self._purge_expired()
+
+
+    def _purge_expired(self) -> int:
+        deleted = self._conn.execute(f"DELETE FROM {self.table} WHERE created_at <= ?", (time.time() - self.ttl,)).rowcount
+        self.purged += deleted
+        self._next_purge = time.monotonic() + self.purge_interval
+        return deleted
+
+
+    def purge_expired(self) -> int:
+        """
+        Delete the expired entries and return how many were deleted.
+        """
+
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            return self._purge_expired()
+
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+    def stats(self) -> dict:
+        return {"path": str(self.path), "hits": self.hits, "misses": self.misses, "purged": self.purged}
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-process LRUCache in front of an optional persistent SQLiteCache.
+    A value found only in the persistent tier is promoted to the in-process tier.
+    `aget` and `aset` access the persistent tier in a thread, so the event loop does not wait on the disk.
+    """
+
+    def __init__(self, memory: LRUCache, store: SQLiteCache | None = None,
+                 encode: Callable[[Any], bytes] | None = None, decode: Callable[[bytes], Any] | None = None):
+        """
+        Parameters:
+        -----------
+        memory: LRUCache
+            The in-process tier.
+        store: SQLiteCache | None
+            The persistent tier (None: in-process only).
+        encode: Callable[[Any], bytes] | None
+            Converts a value to the bytes stored in the persistent tier.
+        decode: Callable[[bytes], Any] | None
+            Converts the bytes of the persistent tier back to a value.
+        """
+
+        if store is not None and (encode is None or decode is None):
+            raise ValueError("A persistent tier requires encode and decode functions.")
+        self.memory = memory
+        self.store = store
+        self.encode = encode
+        self.decode = decode
+
+
+    def get(self, key: str) -> Any | None:
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            data = self.store.get(key)
+            if data is not None:
+                value = self.decode(data)
+                self.memory.set(key, value)
+        return value
+
+
+    def set(self, key: str, value: Any):
+        self.memory.set(key, value)
+        if self.store is not None:
+            self.store.set(key, self.encode(value))
+
+
+    async def aget(self, key: str) -> Any | None:
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            data = await asyncio.to_thread(self.store.get, key)
+            if data is not None:
+                value = self.decode(data)
+                self.memory.set(key, value)
+        return value
+
+
+    async def aset(self, key: str, value: Any):
+        self.memory.set(key, value)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.set, key, self.encode(value))
+
+
+    @property
+    def hits(self) -> int:
+        return self.memory.hits + (self.store.hits if self.store is not None else 0)
+
+
+    @property
+    def misses(self) -> int:
+        # A request is a miss only if no tier has the value
+        return self.store.misses if self.store is not None else self.memory.misses
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory": self.memory.stats(),
+            "store": self.store.stats() if self.store is not None else None,
+        }
+
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
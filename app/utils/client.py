@@ -1,7 +1,7 @@
 import environ
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
-from app.utils.config import OPENAI_API_KEY
+from app.utils.config import OPENAI_API_KEY, OPENAI_BASE_URL
 
 
 def initialize_openai_client():
@@ -13,4 +13,18 @@ def initialize_openai_client():
             "No API key found. Please set a OPENAI_API_KEY in the .env file."
         )
 
-    return OpenAI(api_key=api_key)
+    # Retries are handled by retry_with_exponential_backoff (see rate_limiter)
+    return OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=0)
+
+
+def initialize_async_openai_client():
+    # OpenAI API key
+    api_key = OPENAI_API_KEY
+
+    if not api_key:
+        raise ValueError(
+            "No API key found. Please set a OPENAI_API_KEY in the .env file."
+        )
+
+    # Retries are handled by retry_with_exponential_backoff (see rate_limiter)
+    return AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=0)
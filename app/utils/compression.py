@@ -0,0 +1,119 @@
+import zlib
+
+# Content codings the middleware can produce, by order of preference at equal quality
+ENCODINGS = ("gzip", "deflate")
+
+# Content types that are never compressed: a compressed event stream would be buffered by the clients
+EXCLUDED_CONTENT_TYPES = ("text/event-stream",)
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """
+    Choose the content coding of a response from the Accept-Encoding header of the request
+    (e.g. "gzip;q=0.8, deflate"): the supported coding with the highest quality, or None to send
+    the response as it is.
+    """
+
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+
+    best, best_quality = None, 0.0
+    for coding in ENCODINGS:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def _compressor(encoding: str):
+    # gzip: a gzip header and trailer; deflate: the zlib format, which is what HTTP calls "deflate"
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    return zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+
+def _vary(headers: list) -> list:
+    # The response depends on the Accept-Encoding of the request (for the caches in between)
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            if b"accept-encoding" not in value.lower():
+                headers[i] = (name, value + b", Accept-Encoding")
+            return headers
+    return [*headers, (b"vary", b"Accept-Encoding")]
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that compresses the responses with gzip or deflate, as negotiated with the
+    Accept-Encoding header of the request.
+
+    A response sent in one piece is compressed only from `minimum_size` bytes. A streamed response
+    (e.g. the NDJSON export) is compressed piece by piece, each piece flushed so the client can decode
+    the records as they arrive: the server only holds the state of the compressor, whatever the size
+    of the response. Event streams and responses that already have a Content-Encoding are sent as they are.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers", ()))
+        encoding = negotiate_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None  # held until the first piece of the body tells whether to compress
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                response_headers = {name.lower(): value for name, value in message.get("headers", ())}
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                if b"content-encoding" in response_headers or content_type.startswith(EXCLUDED_CONTENT_TYPES):
+                    return await send(message)
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or (start_message is None and compressor is None):
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                start, start_message = start_message, None
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    return await send(message)
+
+                compressor = _compressor(encoding)
+                response_headers = [(name, value) for name, value in start.get("headers", ()) if name.lower() != b"content-length"]
+                response_headers.append((b"content-encoding", encoding.encode()))
+                if not more_body:
+                    body = compressor.compress(body) + compressor.flush()
+                    response_headers.append((b"content-length", str(len(body)).encode()))
+                    await send({**start, "headers": _vary(response_headers)})
+                    return await send({"type": "http.response.body", "body": body})
+                await send({**start, "headers": _vary(response_headers)})
+
+            # Each piece is flushed, so the client can decode it without waiting for the next one
+            body = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
@@ -12,3 +12,7 @@ else:
     # Initialize environment variables
     environ.Env.read_env('.env')
     OPENAI_API_KEY = env("OPENAI_API_KEY")
+
+# Base URL of the OpenAI API (None: api.openai.com), e.g. http://127.0.0.1:8001/v1 for the mock server
+# of the load tests (python -m app.scripts.mock_openai_server)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
@@ -0,0 +1,295 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from openai import AsyncOpenAI
+
+from app.utils.embedding_cache import normalize_text
+from app.utils.embedding_store import (
+    EMBEDDING_FORMAT_FLOAT32,
+    create_binary_db,
+    encode_embedding,
+    get_embedding_format,
+    read_metadata,
+)
+from app.utils.example_index import build_mmap_index
+from app.utils.openai_config import OpenAIModels
+from app.utils.prompts import aget_embeddings
+from app.utils.rate_limiter import retry_with_exponential_backoff
+
+
+def iter_pairs(path: Path) -> Iterator[tuple[str, str]]:
+    """
+    Stream the (dysfunctional, functional) pairs of a .csv file (with a header row) or a .jsonl file
+    (one object per line), both with the fields "dysfunctional" and "functional".
+    Rows with an empty text are skipped.
+    """
+
+    path = Path(path)
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.suffix == ".csv":
+            rows = csv.DictReader(f)
+        elif path.suffix in (".jsonl", ".ndjson"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            raise ValueError(f"Unsupported file type: {path} (expected .csv or .jsonl)")
+
+        for row in rows:
+            dysfunctional = (row.get("dysfunctional") or "").strip()
+            functional = (row.get("functional") or "").strip()
+            if dysfunctional and functional:
+                yield dysfunctional, functional
+
+
+def pair_hash(dysfunctional: str, functional: str) -> str:
+    """
+    Return the hash of a pair of normalized texts: pairs that differ only by whitespace are duplicates.
+    """
+
+    return hashlib.sha256(f"{normalize_text(dysfunctional)}\x1f{normalize_text(functional)}".encode("utf-8")).hexdigest()
+
+
+def building_path(path: Path) -> Path:
+    """
+    Return the path of the working file of a build (e.g. embeddings.db.building).
+    """
+
+    path = Path(path)
+    return path.with_name(path.name + ".building")
+
+
+@retry_with_exponential_backoff(max_retries=8, deadline=None)
+async def _embed_batch(texts: list[str], model: OpenAIModels, client: AsyncOpenAI) -> list:
+    return await aget_embeddings(texts, model, client, retry=False)
+
+
+class EmbeddingsDbBuilder:
+    """
+    Build (or extend) an embedding database offline, from files of dysfunctional/functional pairs.
+
+    The build works on a copy of the database (embeddings.db.building):
+    1. `ingest` streams the pairs into a queue table, skipping the pairs already queued or embedded
+       (same normalized texts);
+    2. `embed` sends the queued texts to the embeddings API in large batches, with concurrent workers
+       behind the shared rate limiter. Each batch is written, and removed from the queue, in one
+       transaction: an interrupted build resumes where it stopped;
+    3. `finalize` replaces the database with the working file (atomically, so the running app
+       hot-reloads it), then writes its memory-mapped index (see `build_mmap_index`).
+    """
+
+    def __init__(self, path: Path, model: OpenAIModels, client: AsyncOpenAI,
+                 batch_size: int = 1_000, concurrency: int = 4, commit_every: int = 10_000, write_mmap: bool = True):
+        """
+        Parameters:
+        -----------
+        path: Path
+            The database to build. If it exists, its examples are kept and only the new pairs are embedded.
+        model: OpenAIModels
+            Name of the model for the embeddings.
+        client: AsyncOpenAI
+            An async client for the OpenAI API.
+        batch_size: int
+            Texts embedded per API call (at most 2048).
+        concurrency: int
+            Number of API calls running at the same time.
+        commit_every: int
+            Pairs ingested per transaction.
+        write_mmap: bool
+            Whether `finalize` writes the memory-mapped index of the database.
+        """
+
+        self.path = Path(path)
+        self.model = model
+        self.client = client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.commit_every = commit_every
+        self.write_mmap = write_mmap
+        self.work_path = building_path(self.path)
+        self.resumed = self.work_path.exists()
+
+        if not self.resumed and self.path.exists():
+            shutil.copyfile(self.path, self.work_path)
+        self.conn = sqlite3.connect(self.work_path)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._prepare()
+
+
+    def _prepare(self):
+        conn = self.conn
+        has_examples = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'examples'").fetchone()
+        if has_examples and get_embedding_format(conn) != EMBEDDING_FORMAT_FLOAT32:
+            conn.close()
+            if not self.resumed:
+                self.work_path.unlink()
+            raise ValueError(f"{self.path} stores JSON embeddings: convert it first (app.scripts.convert_embeddings_db).")
+
+        model = read_metadata(conn).get("embedding_model")
+        if model is not None and model != getattr(self.model, "value", self.model):
+            conn.close()
+            if not self.resumed:
+                self.work_path.unlink()
+            raise ValueError(f"{self.path} was built with {model}, not {getattr(self.model, 'value', self.model)}.")
+
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS example_hashes (hash TEXT PRIMARY KEY)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hash TEXT NOT NULL UNIQUE,
+                    dysfunctional TEXT NOT NULL,
+                    functional TEXT NOT NULL
+                )""")
+
+            # A database built by other means: hash its examples once
+            if has_examples and conn.execute("SELECT COUNT(*) FROM example_hashes").fetchone()[0] == 0:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO example_hashes (hash) VALUES (?)",
+                    ((pair_hash(d, f),) for d, f in conn.execute("SELECT dysfunctional, functional FROM examples").fetchall()))
+
+
+    def ingest(self, pairs: Iterable[tuple[str, str]]) -> dict:
+        """
+        Queue the pairs that are not queued or embedded yet.
+
+        Returns:
+        -----------
+        dict
+            Number of pairs read, and of pairs queued.
+        """
+
+        read = queued = 0
+        batch = []
+
+        def flush():
+            nonlocal queued
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany("""
+                    INSERT OR IGNORE INTO pending (hash, dysfunctional, functional)
+                    SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM example_hashes WHERE hash = ?)""", batch)
+                queued += self.conn.total_changes - before
+            batch.clear()
+
+        for dysfunctional, functional in pairs:
+            digest = pair_hash(dysfunctional, functional)
+            batch.append((digest, dysfunctional, functional, digest))
+            read += 1
+            if len(batch) >= self.commit_every:
+                flush()
+        if batch:
+            flush()
+
+        return {"read": read, "queued": queued}
+
+
+    def pending(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+
+    async def embed(self, progress: Callable[[int, int], None] | None = None) -> int:
+        """
+        Embed the queued pairs and write them to the examples table.
+
+        Parameters:
+        -----------
+        progress: Callable[[int, int], None] | None
+            Called after each batch with the number of pairs embedded so far and the number queued at the start.
+
+        Returns:
+        -----------
+        int
+            Number of pairs embedded.
+        """
+
+        total = self.pending()
+        done = 0
+        last_seq = 0
+        batches: asyncio.Queue = asyncio.Queue(maxsize=2 * self.concurrency)
+
+        async def produce():
+            nonlocal last_seq
+            while rows := self.conn.execute(
+                    "SELECT seq, dysfunctional, functional FROM pending WHERE seq > ? ORDER BY seq LIMIT ?",
+                    (last_seq, self.batch_size)).fetchall():
+                last_seq = rows[-1][0]
+                await batches.put(rows)
+            for _ in range(self.concurrency):
+                await batches.put(None)
+
+        async def work():
+            nonlocal done
+            while (rows := await batches.get()) is not None:
+                embeddings = await _embed_batch([row[1] for row in rows], self.model, self.client)
+                self._write(rows, embeddings)
+                done += len(rows)
+                if progress is not None:
+                    progress(done, total)
+
+        workers = [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        producer = asyncio.create_task(produce())
+        try:
+            await asyncio.gather(producer, *workers)
+        except BaseException:
+            for task in [producer, *workers]:
+                task.cancel()
+            raise
+
+        return done
+
+
+    def _write(self, rows: list[tuple], embeddings: list):
+        # One transaction per batch: the examples are written and dequeued together
+        with self.conn:
+            dim = len(embeddings[0])
+            metadata = read_metadata(self.conn)
+            if "embedding_dim" not in metadata:
+                create_binary_db(self.conn, dim, {"embedding_model": getattr(self.model, "value", self.model)})
+            elif int(metadata["embedding_dim"]) != dim:
+                raise ValueError(f"Embeddings of dimension {dim}, but the database has dimension {metadata['embedding_dim']}.")
+
+            self.conn.executemany(
+                "INSERT INTO examples (dysfunctional, embedding, functional) VALUES (?, ?, ?)",
+                [(row[1], encode_embedding(embedding), row[2]) for row, embedding in zip(rows, embeddings)])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO example_hashes (hash) SELECT hash FROM pending WHERE seq = ?",
+                [(row[0],) for row in rows])
+            self.conn.executemany("DELETE FROM pending WHERE seq = ?", [(row[0],) for row in rows])
+
+
+    def finalize(self) -> int:
+        """
+        Replace the database with the working file. Every queued pair must have been embedded.
+
+        Returns:
+        -----------
+        int
+            Number of examples in the database.
+        """
+
+        if self.pending():
+            raise RuntimeError(f"{self.pending()} pairs are not embedded yet: run `embed` first.")
+
+        if "embedding_dim" not in read_metadata(self.conn):
+            raise ValueError("No examples to write.")
+
+        count = self.conn.execute("SELECT COUNT(*) FROM examples").fetchone()[0]
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('num_examples', ?)", (str(count),))
+            self.conn.execute("DROP TABLE pending")
+        self.conn.close()
+        os.replace(self.work_path, self.path)
+        if self.write_mmap:
+            build_mmap_index(self.path)
+        return count
+
+
+    def close(self):
+        self.conn.close()
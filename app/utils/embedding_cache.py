@@ -0,0 +1,80 @@
+import hashlib
+import re
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.cache import LRUCache, SQLiteCache, TieredCache
+from app.utils.embedding_store import EMBEDDING_DTYPE, encode_embedding
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text before hashing it: Unicode NFC form, with runs of whitespace collapsed
+    to a single space and no leading or trailing whitespace.
+    """
+
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """
+    Return the cache key of the embedding of a text: the model and the hash of the normalized text.
+    """
+
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{getattr(model, 'value', model)}:{digest}"
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE)
+
+
+class EmbeddingCache(TieredCache):
+    """
+    Cache of the embeddings of the user's texts, keyed by (model, normalized text hash).
+
+    The in-process tier is an LRU cache with size and TTL limits; the optional persistent tier
+    is a SQLite file that survives restarts. Embeddings are stored as read-only float32 arrays.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float | None = None, path: Path | None = None):
+        """
+        Parameters:
+        -----------
+        max_size: int
+            Maximum number of embeddings in the in-process tier.
+        ttl: float | None
+            Seconds after which an embedding expires, in both tiers (None: never).
+        path: Path | None
+            The .db file of the persistent tier (None: in-process only).
+        """
+
+        super().__init__(
+            memory=LRUCache(max_size=max_size, ttl=ttl),
+            store=SQLiteCache(path, table="embeddings", ttl=ttl) if path is not None else None,
+            encode=encode_embedding,
+            decode=decode_embedding)
+
+
+    def get_embedding(self, model: str, text: str) -> np.ndarray | None:
+        return self.get(embedding_cache_key(model, text))
+
+
+    def set_embedding(self, model: str, text: str, embedding: list | np.ndarray) -> np.ndarray:
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False  # shared between requests
+        self.set(embedding_cache_key(model, text), embedding)
+        return embedding
+
+
+    async def aget_embedding(self, model: str, text: str) -> np.ndarray | None:
+        return await self.aget(embedding_cache_key(model, text))
+
+
+    async def aset_embedding(self, model: str, text: str, embedding: list | np.ndarray) -> np.ndarray:
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        await self.aset(embedding_cache_key(model, text), embedding)
+        return embedding
@@ -0,0 +1,221 @@
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+
+# Formats of the "embedding" column of the examples table
+EMBEDDING_FORMAT_JSON = "json"  # a JSON list of floats per row (the original format)
+EMBEDDING_FORMAT_FLOAT32 = "float32"  # a BLOB with little-endian float32 values per row
+
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+
+def connect_read_only(path: Path) -> sqlite3.Connection:
+    """
+    Open a .db file read-only, so that a missing file raises instead of creating an empty database.
+    """
+
+    return sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def read_metadata(conn: sqlite3.Connection) -> dict:
+    """
+    Return the key-value pairs of the metadata table (empty if the database has no metadata table).
+    """
+
+    has_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metadata'"
+    ).fetchone()
+    if not has_table:
+        return {}
+    return dict(conn.execute("SELECT key, value FROM metadata").fetchall())
+
+
+def get_embedding_format(conn: sqlite3.Connection) -> str:
+    """
+    Return the format of the embedding column: EMBEDDING_FORMAT_FLOAT32 or EMBEDDING_FORMAT_JSON.
+    """
+
+    return read_metadata(conn).get("embedding_format", EMBEDDING_FORMAT_JSON)
+
+
+def decode_embeddings(values: list, embedding_format: str, dim: int | None = None) -> np.ndarray:
+    """
+    Decode the values of the embedding column into a float32 matrix, one row per value.
+
+    Parameters:
+    -----------
+    values: list
+        The values of the embedding column (JSON strings or float32 BLOBs).
+    embedding_format: str
+        EMBEDDING_FORMAT_FLOAT32 or EMBEDDING_FORMAT_JSON.
+    dim: int | None
+        Dimension of the embeddings. If None, it is inferred from the first value.
+
+    Returns:
+    -----------
+    np.ndarray
+        A 2D float32 array with shape (len(values), dim).
+    """
+
+    if not values:
+        return np.empty((0, dim or 0), dtype=np.float32)
+
+    if embedding_format == EMBEDDING_FORMAT_FLOAT32:
+        # One copy of the raw bytes, no per-value parsing
+        buffer = b"".join(values)
+        if dim is None:
+            dim = len(values[0]) // EMBEDDING_DTYPE.itemsize
+        if len(buffer) != len(values) * dim * EMBEDDING_DTYPE.itemsize:
+            raise ValueError(f"Embedding BLOBs do not all have dimension {dim}.")
+        return np.frombuffer(buffer, dtype=EMBEDDING_DTYPE).reshape(len(values), dim).astype(np.float32, copy=False)
+
+    if embedding_format == EMBEDDING_FORMAT_JSON:
+        if dim is None:
+            dim = len(json.loads(values[0]))
+        matrix = np.empty((len(values), dim), dtype=np.float32)
+        for i, value in enumerate(values):
+            matrix[i] = json.loads(value)
+        return matrix
+
+    raise ValueError(f"Unknown embedding format: {embedding_format}")
+
+
+def encode_embedding(embedding: list | np.ndarray) -> bytes:
+    """
+    Encode an embedding as a float32 BLOB.
+    """
+
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def read_examples(path: Path) -> tuple[list, list[str], list[str], np.ndarray]:
+    """
+    Read the examples of a .db file, whatever the format of its embedding column.
+
+    Parameters:
+    -----------
+    path: Path
+        The path to the .db file with the examples and their embeddings.
+
+    Returns:
+    -----------
+    tuple
+        ids: list
+            Ids of the examples.
+        dysfunctional: list[str]
+            Dysfunctional texts.
+        functional: list[str]
+            Functional version of the texts.
+        embeddings: np.ndarray
+            A float32 matrix with the embeddings of the dysfunctional texts, one row per example.
+    """
+
+    conn = connect_read_only(path)
+    try:
+        metadata = read_metadata(conn)
+        rows = conn.execute("SELECT id, dysfunctional, functional, embedding FROM examples ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+
+    ids, dysfunctional, functional, values = zip(*rows) if rows else ((), (), (), ())
+    dim = int(metadata["embedding_dim"]) if "embedding_dim" in metadata else None
+    embeddings = decode_embeddings(
+        list(values),
+        metadata.get("embedding_format", EMBEDDING_FORMAT_JSON),
+        dim)
+
+    return list(ids), list(dysfunctional), list(functional), embeddings
+
+
+def create_binary_db(conn: sqlite3.Connection, dim: int, extra_metadata: dict | None = None):
+    """
+    Create the tables of a .db file that stores the embeddings as float32 BLOBs.
+
+    Parameters:
+    -----------
+    conn: sqlite3.Connection
+        Connection to the new database.
+    dim: int
+        Dimension of the embeddings, recorded in the metadata table.
+    extra_metadata: dict | None
+        Other key-value pairs to record in the metadata table.
+    """
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS examples (
+            id INTEGER PRIMARY KEY,
+            dysfunctional TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            functional TEXT NOT NULL
+        )""")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    metadata = {
+        "embedding_format": EMBEDDING_FORMAT_FLOAT32,
+        "embedding_dtype": EMBEDDING_DTYPE.str,
+        "embedding_dim": str(dim),
+        **(extra_metadata or {}),
+    }
+    conn.executemany("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", metadata.items())
+
+
+def convert_embeddings_db(src: Path, dst: Path, batch_size: int = 10_000) -> int:
+    """
+    Convert a .db file with JSON embeddings into a new .db file with float32 BLOB embeddings.
+    The rows are read and written in batches, so the whole corpus is never held in memory.
+
+    Parameters:
+    -----------
+    src: Path
+        The .db file with the JSON embedding column.
+    dst: Path
+        The .db file to create. It must not exist.
+    batch_size: int
+        Number of rows converted per batch.
+
+    Returns:
+    -----------
+    int
+        Number of converted examples.
+    """
+
+    dst = Path(dst)
+    if dst.exists():
+        raise FileExistsError(f"{dst} already exists.")
+
+    src_conn = connect_read_only(src)
+    dst_conn = sqlite3.connect(dst)
+    try:
+        src_format = get_embedding_format(src_conn)
+        if src_format != EMBEDDING_FORMAT_JSON:
+            raise ValueError(f"{src} already stores the embeddings as {src_format}.")
+
+        cursor = src_conn.execute("SELECT id, dysfunctional, embedding, functional FROM examples ORDER BY rowid")
+        dim = None
+        count = 0
+        with dst_conn:  # a single transaction
+            while rows := cursor.fetchmany(batch_size):
+                embeddings = decode_embeddings([row[2] for row in rows], EMBEDDING_FORMAT_JSON, dim)
+                if dim is None:
+                    dim = embeddings.shape[1]
+                    create_binary_db(dst_conn, dim, {"converted_from": Path(src).name})
+                dst_conn.executemany(
+                    "INSERT INTO examples (id, dysfunctional, embedding, functional) VALUES (?, ?, ?, ?)",
+                    [(row[0], row[1], encode_embedding(embedding), row[3]) for row, embedding in zip(rows, embeddings)]
+                )
+                count += len(rows)
+            if dim is None:
+                raise ValueError(f"{src} has no examples to convert.")
+            dst_conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('num_examples', ?)", (str(count),))
+    except Exception:
+        dst_conn.close()
+        dst.unlink(missing_ok=True)
+        raise
+    finally:
+        src_conn.close()
+    dst_conn.close()
+
+    return count
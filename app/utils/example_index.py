@@ -0,0 +1,553 @@
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from enum import Enum
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.ann_index import IVFIndex, ann_index_path, corpus_fingerprint
+from app.utils.embedding_store import read_examples
+from app.utils.metrics import stage
+from app.utils.mmap_index import MappedTexts, mmap_index_path, read_mmap_index, write_mmap_index
+from app.utils.similarity import normalize_rows, top_k
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalBackend(str, Enum):
+    EXACT = "exact"  # brute-force cosine similarity against every example
+    IVF = "ivf"  # approximate search with an inverted-file index (see ann_index)
+
+
+class ExampleIndex:
+    """
+    Resident index of the few-shot examples.
+
+    The embeddings of the dysfunctional examples are stored in a contiguous float32 matrix whose
+    rows are normalized ahead of time, so the cosine similarity with the user's text is a single
+    matrix-vector product. Ids and texts are stored in arrays parallel to the matrix rows.
+
+    An index loaded with `from_mmap` reads the matrix, the ids and the texts from a memory-mapped
+    file instead: the workers of a dyno that map the same file share a single copy in the page cache.
+    """
+
+    def __init__(self, ids: list, dysfunctional: list[str], functional: list[str], embeddings: np.ndarray):
+        """
+        Parameters:
+        -----------
+        ids: list
+            Ids of the examples.
+        dysfunctional: list[str]
+            Dysfunctional texts, one per example.
+        functional: list[str]
+            Functional version of the texts, one per example.
+        embeddings: np.ndarray
+            A 2D array with the embeddings of the dysfunctional texts, one row per example.
+        """
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(ids):
+            raise ValueError(
+                f"Expected one embedding per example ({len(ids)}), got an array with shape {embeddings.shape}."
+            )
+        if not (len(ids) == len(dysfunctional) == len(functional)):
+            raise ValueError("ids, dysfunctional and functional must have the same length.")
+
+        self.ids = np.asarray(ids)
+        self.dysfunctional = np.asarray(dysfunctional, dtype=object)
+        self.functional = np.asarray(functional, dtype=object)
+        self.matrix = normalize_rows(embeddings)
+        self.ann: IVFIndex | None = None
+
+
+    @classmethod
+    def from_examples(cls, examples: list[dict]) -> "ExampleIndex":
+        """
+        Build the index from a list of examples, as returned by `load_examples`.
+        """
+
+        dim = len(examples[0]["embedding"]) if examples else 0
+        embeddings = np.empty((len(examples), dim), dtype=np.float32)
+        for i, example in enumerate(examples):
+            embeddings[i] = example["embedding"]
+
+        return cls(
+            ids=[example["id"] for example in examples],
+            dysfunctional=[example["dysfunctional"] for example in examples],
+            functional=[example["functional"] for example in examples],
+            embeddings=embeddings,
+        )
+
+
+    @classmethod
+    def from_db(cls, path: Path) -> "ExampleIndex":
+        """
+        Build the index from the .db file with the examples and their embeddings
+        (stored either as JSON or as float32 BLOBs, see `embedding_store`).
+        """
+
+        ids, dysfunctional, functional, embeddings = read_examples(path)
+        return cls(ids, dysfunctional, functional, embeddings)
+
+
+    @classmethod
+    def from_mmap(cls, path: Path, source_hash: str | None = None) -> "ExampleIndex":
+        """
+        Map the index saved with `save_mmap` (read-only, nothing is copied into the process).
+        With `source_hash`, raise a ValueError if the file was built from another version of the .db file.
+        """
+
+        header, arrays = read_mmap_index(path)
+        if source_hash is not None and header["source_hash"] != source_hash:
+            raise ValueError(f"{path} was built from a different version of the examples.")
+        # Not through __init__, which would copy and normalize the matrix
+        index = cls.__new__(cls)
+        index.ids = arrays["ids"]
+        index.dysfunctional = MappedTexts(arrays["dysfunctional_offsets"], arrays["dysfunctional"])
+        index.functional = MappedTexts(arrays["functional_offsets"], arrays["functional"])
+        index.matrix = arrays["matrix"]
+        index.ann = None
+        return index
+
+
+    def save_mmap(self, path: Path, source_hash: str):
+        """
+        Save the index as a file to map with `from_mmap` (see `mmap_index`).
+        """
+
+        write_mmap_index(path, self.ids, self.matrix, self.dysfunctional, self.functional, source_hash)
+
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+
+    @property
+    def mapped(self) -> bool:
+        return isinstance(self.matrix, np.memmap)
+
+
+    @property
+    def fingerprint(self) -> str:
+        return corpus_fingerprint(self.ids, self.matrix)
+
+
+    def attach_ann(self, ann: IVFIndex):
+        """
+        Attach an ANN index, after checking that it was built from the same examples.
+        """
+
+        if ann.fingerprint != self.fingerprint:
+            raise ValueError("The ANN index was built from a different version of the examples.")
+        self.ann = ann
+
+
+    def search(self, input_embedding: list, top_n: int = 5, backend: RetrievalBackend = RetrievalBackend.EXACT,
+               nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the examples most similar to the input embedding.
+
+        Parameters:
+        -----------
+        input_embedding: list
+            Embedding of the user's text.
+        top_n: int
+            Number of examples to select.
+        backend: RetrievalBackend
+            Exact search, or approximate search with the attached IVF index
+            (falls back to the exact search if no IVF index is attached).
+        nprobe: int | None
+            Number of IVF clusters to scan (IVF backend only). Default: the IVF index's nprobe.
+
+        Returns:
+        -----------
+        tuple
+            indices: np.ndarray
+                Row indices of the selected examples, from the most to the least similar.
+            similarities: np.ndarray
+                Cosine similarities of the selected examples.
+        """
+
+        query = np.asarray(input_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        if backend == RetrievalBackend.IVF and self.ann is not None:
+            return self.ann.search(self.matrix, query, top_n, nprobe)
+
+        scores = self.matrix @ query
+        indices = top_k(scores, top_n)
+
+        return indices, scores[indices]
+
+
+    def search_batch(self, input_embeddings: np.ndarray, top_n: int = 5, backend: RetrievalBackend = RetrievalBackend.EXACT,
+                     nprobe: int | None = None, max_scores: int = 1 << 25) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the examples most similar to each of several input embeddings.
+        The exact search is a matrix-matrix product with a top-k per row, computed on chunks of
+        queries so that the score matrix holds at most `max_scores` values.
+
+        Parameters:
+        -----------
+        input_embeddings: np.ndarray
+            Embeddings of the users' texts, one per row.
+        top_n: int
+            Number of examples to select per query.
+        backend: RetrievalBackend
+            Exact search, or approximate search with the attached IVF index (one query at a time).
+        nprobe: int | None
+            Number of IVF clusters to scan (IVF backend only).
+        max_scores: int
+            Maximum size of the score matrix of a chunk.
+
+        Returns:
+        -----------
+        tuple
+            indices: np.ndarray
+                Row indices of the selected examples, shape (queries, top_n), from the most to the least similar.
+            similarities: np.ndarray
+                Cosine similarities of the selected examples, same shape.
+        """
+
+        queries = normalize_rows(np.atleast_2d(np.asarray(input_embeddings, dtype=np.float32)))
+        k = min(top_n, len(self))
+
+        if backend == RetrievalBackend.IVF and self.ann is not None:
+            results = [self.ann.search(self.matrix, query, k, nprobe) for query in queries]
+            indices = np.array([result[0] for result in results], dtype=np.intp).reshape(len(queries), k)
+            similarities = np.array([result[1] for result in results], dtype=np.float32).reshape(len(queries), k)
+            return indices, similarities
+
+        indices = np.empty((len(queries), k), dtype=np.intp)
+        similarities = np.empty((len(queries), k), dtype=np.float32)
+        if k == 0:
+            return indices, similarities
+
+        chunk = max(1, max_scores // max(1, len(self)))
+        for start in range(0, len(queries), chunk):
+            scores = queries[start:start + chunk] @ self.matrix.T
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind="stable")
+            indices[start:start + chunk] = np.take_along_axis(candidates, order, axis=1)
+            similarities[start:start + chunk] = np.take_along_axis(candidate_scores, order, axis=1)
+
+        return indices, similarities
+
+
+    def get_examples(self, indices: np.ndarray) -> list[dict]:
+        """
+        Return the dysfunctional and functional texts of the examples at the given row indices.
+        """
+
+        return [
+            {"dysfunctional": self.dysfunctional[i], "functional": self.functional[i]}
+            for i in indices
+        ]
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    Return the SHA-256 hex digest of a file's content.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IndexSnapshot:
+    """
+    A version of the example index, together with the state of the .db file it was built from.
+    The index of a snapshot is never modified after the snapshot is created.
+    """
+
+    def __init__(self, index: ExampleIndex, version: int, source_mtime: float, source_hash: str, build_seconds: float,
+                 ann_mtime: float | None = None, mmap_mtime: float | None = None):
+        self.index = index
+        self.version = version
+        self.source_mtime = source_mtime
+        self.source_hash = source_hash
+        self.ann_mtime = ann_mtime
+        self.mmap_mtime = mmap_mtime
+        self.build_seconds = build_seconds
+        self.built_at = datetime.now(timezone.utc)
+
+
+    def info(self) -> dict:
+        return {
+            "version": self.version,
+            "built_at": self.built_at.isoformat(),
+            "build_seconds": round(self.build_seconds, 4),
+            "num_examples": len(self.index),
+            "source_mtime": datetime.fromtimestamp(self.source_mtime, timezone.utc).isoformat(),
+            "source_hash": self.source_hash,
+            "mapped": self.index.mapped,
+            "ann": {"n_lists": self.index.ann.n_lists, "nprobe": self.index.ann.nprobe} if self.index.ann is not None else None,
+        }
+
+
+class ExampleIndexManager:
+    """
+    Keep the example index of a .db file up to date without restarting the app.
+
+    A new snapshot is built in a background thread when the file's mtime and content hash change
+    (checked every `poll_interval` seconds once `start` is called), or when `reload` is requested.
+    The ANN index persisted next to the .db file (see `ann_index_path`), if any, is part of the
+    snapshot: a change of the ANN index file also triggers a new snapshot.
+    With `use_mmap`, the index is mapped from the file persisted next to the .db file (see
+    `mmap_index_path`) instead of being loaded into the process, as long as that file was built
+    from the current version of the .db file; a change of that file also triggers a new snapshot.
+    The active snapshot is replaced with a single reference assignment: a reader that already took
+    the old snapshot finishes on it, and no reader ever sees a half-built index.
+    """
+
+    def __init__(self, path: Path, poll_interval: float = 30.0, use_mmap: bool = False):
+        """
+        Parameters:
+        -----------
+        path: Path
+            The path to the .db file with the examples and their embeddings.
+        poll_interval: float
+            Seconds between two checks of the file's mtime.
+        use_mmap: bool
+            Whether to map the index from its memory-mapped file, when it is up to date.
+        """
+
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self.use_mmap = use_mmap
+        self._snapshot: IndexSnapshot | None = None
+        self._build_lock = threading.Lock()  # only one build at a time
+        self._building = threading.Event()
+        self._stop = threading.Event()
+        self._watcher: threading.Thread | None = None
+        self.last_error: str | None = None
+
+
+    @property
+    def snapshot(self) -> IndexSnapshot:
+        """
+        The active snapshot. It is built synchronously if no snapshot exists yet.
+        """
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.reload()
+            snapshot = self._snapshot
+        return snapshot
+
+
+    @property
+    def index(self) -> ExampleIndex:
+        return self.snapshot.index
+
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Build a new snapshot if the .db file changed since the active one (or if `force` is True),
+        then make it the active snapshot.
+
+        Returns:
+        -----------
+        bool
+            True if a new snapshot was activated.
+        """
+
+        with self._build_lock:
+            self._building.set()
+            try:
+                current = self._snapshot
+                mtime = self.path.stat().st_mtime
+                ann_path = ann_index_path(self.path)
+                ann_mtime = ann_path.stat().st_mtime if ann_path.exists() else None
+                mmap_path = mmap_index_path(self.path)
+                mmap_mtime = mmap_path.stat().st_mtime if self.use_mmap and mmap_path.exists() else None
+                unchanged_sidecars = current is not None and current.ann_mtime == ann_mtime and current.mmap_mtime == mmap_mtime
+                if not force and unchanged_sidecars and current.source_mtime == mtime:
+                    return False
+
+                source_hash = file_digest(self.path)
+                if not force and unchanged_sidecars and current.source_hash == source_hash:
+                    # Touched but not modified: nothing to rebuild
+                    current.source_mtime = mtime
+                    return False
+
+                start = time.perf_counter()
+                with stage("index_build"):
+                    index = self._build(source_hash, mmap_path if mmap_mtime is not None else None)
+                if ann_mtime is not None:
+                    try:
+                        index.attach_ann(IVFIndex.load(ann_path))
+                    except ValueError as e:
+                        # Stale ANN index: the exact search is used until it is rebuilt
+                        logger.warning("Ignoring %s: %s", ann_path, e)
+                version = current.version + 1 if current is not None else 1
+                self._snapshot = IndexSnapshot(index, version, mtime, source_hash, time.perf_counter() - start, ann_mtime, mmap_mtime)
+                self.last_error = None
+                logger.info("Example index version %d activated (%d examples%s)", version, len(index), ", mapped" if index.mapped else "")
+                return True
+            finally:
+                self._building.clear()
+
+
+    def _build(self, source_hash: str, mmap_path: Path | None) -> ExampleIndex:
+        if mmap_path is not None:
+            try:
+                return ExampleIndex.from_mmap(mmap_path, source_hash)
+            except ValueError as e:
+                # Stale mapped index: the examples are loaded into the process until it is rebuilt
+                logger.warning("Ignoring %s: %s", mmap_path, e)
+        elif self.use_mmap:
+            logger.warning("No mapped index %s: the examples are loaded into the process", mmap_index_path(self.path))
+        return ExampleIndex.from_db(self.path)
+
+
+    def reload_in_background(self, force: bool = False) -> bool:
+        """
+        Start a rebuild in a background thread, unless one is already running.
+
+        Returns:
+        -----------
+        bool
+            True if a rebuild was started.
+        """
+
+        if self._building.is_set():
+            return False
+        threading.Thread(target=self._safe_reload, args=(force,), daemon=True).start()
+        return True
+
+
+    def _safe_reload(self, force: bool = False):
+        try:
+            self.reload(force)
+        except Exception as e:
+            # Keep serving the active snapshot
+            self.last_error = str(e)
+            logger.exception("Failed to rebuild the example index from %s", self.path)
+
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            if self.path.exists():
+                self._safe_reload()
+
+
+    def start(self):
+        """
+        Start watching the .db file for changes.
+        """
+
+        if self._watcher is None or not self._watcher.is_alive():
+            self._stop.clear()
+            self._watcher = threading.Thread(target=self._watch, name="example-index-watcher", daemon=True)
+            self._watcher.start()
+
+
+    def stop(self):
+        """
+        Stop watching the .db file.
+        """
+
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+            self._watcher = None
+
+
+    def status(self) -> dict:
+        """
+        Return the version and build time of the active snapshot, to check rollouts.
+        """
+
+        snapshot = self._snapshot
+        return {
+            "path": str(self.path),
+            "active": snapshot.info() if snapshot is not None else None,
+            "building": self._building.is_set(),
+            "last_error": self.last_error,
+        }
+
+
+# Index managers, by path of the .db file
+_index_managers: dict[str, ExampleIndexManager] = {}
+_index_managers_lock = threading.Lock()
+
+
+def get_index_manager(path: Path) -> ExampleIndexManager:
+    """
+    Return the (process-wide) manager of the example index of a .db file.
+
+    Parameters:
+    -----------
+    path: Path
+        The path to the .db file with the examples and their embeddings.
+
+    Returns:
+    -----------
+    ExampleIndexManager
+        The manager of the example index.
+    """
+
+    key = str(Path(path).resolve())
+    with _index_managers_lock:
+        manager = _index_managers.get(key)
+        if manager is None:
+            manager = ExampleIndexManager(path)
+            _index_managers[key] = manager
+    return manager
+
+
+def get_example_index(path: Path) -> ExampleIndex:
+    """
+    Return the active example index of a .db file, building it the first time it is requested.
+
+    Parameters:
+    -----------
+    path: Path
+        The path to the .db file with the examples and their embeddings.
+
+    Returns:
+    -----------
+    ExampleIndex
+        The resident index of the examples.
+    """
+
+    return get_index_manager(path).index
+
+
+def build_mmap_index(path_emb: Path, dst: Path | None = None) -> Path:
+    """
+    Write the memory-mapped example index of a .db file (see `ExampleIndex.from_mmap`),
+    which the index managers with `use_mmap` map instead of loading the examples.
+
+    Parameters:
+    -----------
+    path_emb: Path
+        The path to the .db file with the examples and their embeddings.
+    dst: Path | None
+        The file to write (default: `mmap_index_path(path_emb)`). An existing file is replaced atomically.
+
+    Returns:
+    -----------
+    Path
+        The path of the mapped index.
+    """
+
+    dst = Path(dst) if dst is not None else mmap_index_path(path_emb)
+    source_hash = file_digest(path_emb)
+    ExampleIndex.from_db(path_emb).save_mmap(dst, source_hash)
+    return dst
@@ -0,0 +1,138 @@
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+import httpx
+import numpy as np
+
+
+class LoadReport:
+    """
+    Latencies and outcomes of the requests of a load test.
+    """
+
+    def __init__(self):
+        self.latencies = []  # seconds, of every request (successful or not)
+        self.statuses = Counter()  # HTTP status codes, or exception names for the requests without a response
+        self.duration = 0.0
+
+
+    def record(self, latency: float, status: int | str):
+        self.latencies.append(latency)
+        self.statuses[status] += 1
+
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+
+    @property
+    def errors(self) -> int:
+        return sum(count for status, count in self.statuses.items() if not (isinstance(status, int) and status < 400))
+
+
+    def summary(self) -> dict:
+        latencies_ms = 1000 * np.asarray(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "throughput_rps": self.requests / self.duration if self.duration else 0.0,
+            "duration_s": self.duration,
+            "latency_ms": {
+                "mean": float(latencies_ms.mean()),
+                "p50": float(np.percentile(latencies_ms, 50)),
+                "p95": float(np.percentile(latencies_ms, 95)),
+                "p99": float(np.percentile(latencies_ms, 99)),
+                "max": float(latencies_ms.max()),
+            },
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+        }
+
+
+async def _send(client: httpx.AsyncClient, path: str, text: str, scheduled: float, report: LoadReport):
+    try:
+        response = await client.post(path, json={"original_text": text})
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    report.record(time.perf_counter() - scheduled, status)
+
+
+async def run_load(base_url: str, texts: list[str], rps: float | None = None, concurrency: int | None = None,
+                   duration: float | None = None, num_requests: int | None = None, path: str = "/api/messages/",
+                   timeout: float = 60.0, transport: httpx.AsyncBaseTransport | None = None) -> LoadReport:
+    """
+    Send POST requests with the texts (in a loop) to the app, and measure their latency.
+
+    With `rps`, the requests are sent at a fixed rate whatever the response times (open loop);
+    the latency of a request is measured from the time it was scheduled, so a slow server does not
+    hide its queueing delay (coordinated omission). With `concurrency`, that many clients each
+    send a request as soon as their previous one returns (closed loop).
+
+    Parameters:
+    -----------
+    base_url: str
+        URL of the app, e.g. http://127.0.0.1:8000.
+    texts: list[str]
+        The original texts sent, in a loop.
+    rps: float | None
+        Requests per second (open loop).
+    concurrency: int | None
+        Number of concurrent clients (closed loop).
+    duration: float | None
+        Seconds during which requests are sent.
+    num_requests: int | None
+        Number of requests to send (the test stops at the first limit reached).
+    path: str
+        Path of the endpoint.
+    timeout: float
+        Timeout of a request, in seconds.
+    transport: httpx.AsyncBaseTransport | None
+        Transport of the HTTP client (e.g. an ASGI transport to call the app in process).
+
+    Returns:
+    -----------
+    LoadReport
+        The latencies and outcomes of the requests.
+    """
+
+    if (rps is None) == (concurrency is None):
+        raise ValueError("Give either rps (open loop) or concurrency (closed loop).")
+    if duration is None and num_requests is None:
+        raise ValueError("Give a duration or a number of requests.")
+    if not texts:
+        raise ValueError("No texts to send.")
+
+    report = LoadReport()
+    texts_cycle = itertools.cycle(texts)
+    sent = itertools.count()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits, transport=transport) as client:
+        start = time.perf_counter()
+        deadline = start + duration if duration is not None else float("inf")
+
+        def more() -> bool:
+            return time.perf_counter() < deadline and (num_requests is None or next(sent) < num_requests)
+
+        if rps is not None:
+            tasks = []
+            scheduled = start
+            while more():
+                tasks.append(asyncio.create_task(_send(client, path, next(texts_cycle), scheduled, report)))
+                scheduled += 1 / rps
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            await asyncio.gather(*tasks)
+        else:
+            async def user():
+                while more():
+                    await _send(client, path, next(texts_cycle), time.perf_counter(), report)
+
+            await asyncio.gather(*(user() for _ in range(concurrency)))
+
+        report.duration = time.perf_counter() - start
+
+    return report
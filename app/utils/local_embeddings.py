@@ -0,0 +1,313 @@
+import io
+import sqlite3
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Protocol
+
+import numpy as np
+from app.utils.embedding_store import connect_read_only, create_binary_db, encode_embedding, read_examples
+from app.utils.example_index import ExampleIndex, get_index_manager
+from app.utils.similarity import normalize_rows
+
+# Name of the local embedding model, recorded in the metadata of its example database
+LOCAL_EMBEDDING_MODEL = "local-hashing-tfidf-svd"
+
+
+class EmbeddingProvider(str, Enum):
+    OPENAI = "openai"  # the OpenAI embeddings API (embeddings.db)
+    LOCAL = "local"  # LocalEmbeddingBackend, on the CPU (embeddings.local.db)
+
+
+def local_index_path(path_emb: Path) -> Path:
+    """
+    Return the path of the example database embedded with the local model, next to a .db file
+    (e.g. embeddings.local.db).
+    """
+
+    path_emb = Path(path_emb)
+    return path_emb.with_name(path_emb.stem + ".local.db")
+
+
+def _array_to_bytes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _array_from_bytes(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class EmbeddingBackend(Protocol):
+    """
+    An embedding provider that can replace the OpenAI embeddings in the example selection
+    (see `select_examples`). Its examples must be embedded with the same provider.
+    """
+
+    name: str
+
+    def embed(self, texts: list[str]) -> np.ndarray: ...
+
+    async def aembed(self, texts: list[str]) -> np.ndarray: ...
+
+
+class LocalEmbeddingBackend:
+    """
+    Embeds texts on the CPU, without calling an API: hashed word n-grams weighted by TF-IDF,
+    projected on the components of a truncated SVD (latent semantic analysis) fitted on the example corpus.
+
+    The vectors live in their own space: the examples must be embedded with the same backend
+    (see `build_local_index`).
+    """
+
+    name = LOCAL_EMBEDDING_MODEL
+
+    def __init__(self, idf: np.ndarray, components: np.ndarray, ngram_range: tuple[int, int] = (1, 2)):
+        """
+        Parameters:
+        -----------
+        idf: np.ndarray
+            Inverse document frequency of each hashed feature.
+        components: np.ndarray
+            SVD components, one per row (n_components, n_features).
+        ngram_range: tuple[int, int]
+            Range of the word n-grams.
+        """
+
+        # scikit-learn is imported only when the local backend is used: it takes longer to import than the rest of the app
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.ngram_range = tuple(ngram_range)
+        self.vectorizer = HashingVectorizer(
+            n_features=self.idf.shape[0],
+            ngram_range=self.ngram_range,
+            alternate_sign=False,
+            norm=None)
+
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+
+    def _tfidf(self, texts: list[str]):
+        from sklearn.preprocessing import normalize
+
+        counts = self.vectorizer.transform(texts)
+        return normalize(counts.multiply(self.idf).tocsr())
+
+
+    @classmethod
+    def fit(cls, texts: list[str], n_features: int = 2 ** 15, n_components: int = 128,
+            ngram_range: tuple[int, int] = (1, 2), seed: int = 0) -> "LocalEmbeddingBackend":
+        """
+        Fit the model on a corpus.
+
+        Parameters:
+        -----------
+        texts: list[str]
+            The corpus (the dysfunctional texts of the examples).
+        n_features: int
+            Number of hashed features.
+        n_components: int
+            Dimension of the embeddings (capped by the size of the corpus).
+        ngram_range: tuple[int, int]
+            Range of the word n-grams.
+        seed: int
+            Seed of the randomized SVD.
+        """
+
+        from sklearn.decomposition import TruncatedSVD
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.preprocessing import normalize
+
+        vectorizer = HashingVectorizer(n_features=n_features, ngram_range=ngram_range, alternate_sign=False, norm=None)
+        counts = vectorizer.transform(texts).tocsc()
+        document_frequency = np.diff(counts.indptr)
+        idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1  # smoothed, as in TfidfTransformer
+
+        tfidf = normalize(counts.multiply(idf).tocsr())
+        n_components = max(1, min(n_components, tfidf.shape[0] - 1, n_features - 1))
+        svd = TruncatedSVD(n_components=n_components, random_state=seed).fit(tfidf)
+
+        return cls(idf, svd.components_, ngram_range)
+
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        Return the unit-norm float32 embeddings of the texts, one row per text.
+        """
+
+        embeddings = np.asarray(self._tfidf(texts) @ self.components.T, dtype=np.float32)
+        return normalize_rows(embeddings)
+
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        # Well under a millisecond per text: not worth a worker thread
+        return self.embed(texts)
+
+
+    def save(self, conn: sqlite3.Connection):
+        """
+        Store the model in the example database it embedded, so the two are always replaced together.
+        """
+
+        conn.execute("CREATE TABLE IF NOT EXISTS embedding_model (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        conn.executemany("INSERT OR REPLACE INTO embedding_model (key, value) VALUES (?, ?)", [
+            ("idf", _array_to_bytes(self.idf)),
+            ("components", _array_to_bytes(self.components)),
+            ("ngram_range", _array_to_bytes(np.array(self.ngram_range))),
+        ])
+
+
+    @classmethod
+    def load(cls, path: Path) -> "LocalEmbeddingBackend":
+        """
+        Load the model stored in an example database by `save`.
+        """
+
+        conn = connect_read_only(path)
+        try:
+            params = {key: _array_from_bytes(value) for key, value in conn.execute("SELECT key, value FROM embedding_model")}
+        finally:
+            conn.close()
+        return cls(params["idf"], params["components"], tuple(int(n) for n in params["ngram_range"]))
+
+
+def build_local_index(path_emb: Path, dst: Path | None = None, n_features: int = 2 ** 15, n_components: int = 128,
+                      batch_size: int = 10_000, seed: int = 0) -> LocalEmbeddingBackend:
+    """
+    Fit the local model on the examples of an embedding database, and write the examples embedded
+    with it to a new database (float32 format), together with the model.
+
+    Parameters:
+    -----------
+    path_emb: Path
+        The database with the examples.
+    dst: Path | None
+        The database to write (default: `local_index_path(path_emb)`). An existing file is replaced atomically.
+    n_features: int
+        Number of hashed features.
+    n_components: int
+        Dimension of the embeddings.
+    batch_size: int
+        Examples embedded and written per batch.
+    seed: int
+        Seed of the randomized SVD.
+
+    Returns:
+    -----------
+    LocalEmbeddingBackend
+        The fitted model.
+    """
+
+    dst = Path(dst) if dst is not None else local_index_path(path_emb)
+    ids, dysfunctional, functional, _ = read_examples(path_emb)
+    if not ids:
+        raise ValueError(f"{path_emb} has no examples.")
+    backend = LocalEmbeddingBackend.fit(dysfunctional, n_features=n_features, n_components=n_components, seed=seed)
+
+    # Write to a temporary file first, so the running app never sees a partial database
+    tmp = dst.with_name(dst.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp)
+    try:
+        with conn:
+            create_binary_db(conn, backend.dim, {"embedding_model": LOCAL_EMBEDDING_MODEL, "source": Path(path_emb).name})
+            backend.save(conn)
+            for start in range(0, len(ids), batch_size):
+                stop = start + batch_size
+                embeddings = backend.embed(dysfunctional[start:stop])
+                conn.executemany(
+                    "INSERT INTO examples (id, dysfunctional, embedding, functional) VALUES (?, ?, ?, ?)",
+                    [(i, d, encode_embedding(e), f) for i, d, e, f in
+                     zip(ids[start:stop], dysfunctional[start:stop], embeddings, functional[start:stop])])
+            conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('num_examples', ?)", (str(len(ids)),))
+    except Exception:
+        conn.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    conn.close()
+    tmp.replace(dst)
+
+    return backend
+
+
+def overlap_report(reference: ExampleIndex, local: ExampleIndex, backend: LocalEmbeddingBackend,
+                   num_queries: int = 200, k: int = 5, seed: int = 0) -> dict:
+    """
+    Compare the examples selected with the local embeddings to those selected with the reference
+    (OpenAI) embeddings. The queries are examples of the corpus, left out of their own results.
+
+    Parameters:
+    -----------
+    reference: ExampleIndex
+        The examples with the reference embeddings.
+    local: ExampleIndex
+        The same examples, embedded with the local model.
+    backend: LocalEmbeddingBackend
+        The local model.
+    num_queries: int
+        Number of examples used as queries.
+    k: int
+        Number of selected examples compared per query.
+    seed: int
+        Seed of the sample of queries.
+
+    Returns:
+    -----------
+    dict
+        The mean overlap@k (share of the reference examples also selected locally), and the latency
+        of the local embedding of a single text (mean and p95, in ms).
+    """
+
+    if list(reference.ids) != list(local.ids):
+        raise ValueError("The two indexes do not have the same examples.")
+
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(reference), min(num_queries, len(reference)), replace=False)
+
+    overlaps, latencies = [], []
+    for row in rows:
+        expected, _ = reference.search(reference.matrix[row], k + 1)
+        expected = set(expected.tolist()) - {row}
+
+        start = time.perf_counter()
+        query = backend.embed([reference.dysfunctional[row]])[0]
+        latencies.append(1000 * (time.perf_counter() - start))
+
+        selected, _ = local.search(query, k + 1)
+        selected = [index for index in selected.tolist() if index != row][:k]
+        overlaps.append(len(expected.intersection(selected)) / max(1, min(k, len(expected))))
+
+    return {
+        f"overlap@{k}": float(np.mean(overlaps)),
+        "num_queries": len(rows),
+        "embed_ms_mean": float(np.mean(latencies)),
+        "embed_ms_p95": float(np.percentile(latencies, 95)),
+    }
+
+
+# Local models, by path of their example database: (source hash of the index snapshot, model)
+_local_backends: dict[str, tuple[str, LocalEmbeddingBackend]] = {}
+_local_backends_lock = threading.Lock()
+
+
+def get_local_backend(path: Path) -> LocalEmbeddingBackend:
+    """
+    Return the local model stored in an example database, reloaded whenever the example index
+    of the database is (so the model always matches the examples it embedded).
+    """
+
+    source_hash = get_index_manager(path).snapshot.source_hash
+    key = str(Path(path).resolve())
+    with _local_backends_lock:
+        cached = _local_backends.get(key)
+        if cached is None or cached[0] != source_hash:
+            cached = (source_hash, LocalEmbeddingBackend.load(path))
+            _local_backends[key] = cached
+    return cached[1]
@@ -0,0 +1,470 @@
+import bisect
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+from uuid import UUID
+
+from app.utils.models import TextModel
+
+logger = logging.getLogger(__name__)
+
+# Queued by `flush`: the writer commits the messages gathered so far without waiting for more
+_FLUSH = object()
+
+
+class InMemoryMessageStore:
+    """
+    In-process store of the transformed messages, indexed by id.
+
+    Messages are kept in a dict (id -> position) and an insertion-ordered list, so lookup, update
+    and delete are O(1), and a page of messages is found by bisecting the sequence numbers.
+    Deleted messages leave a tombstone in the list, removed when the list is compacted.
+    When the store holds more than `max_size` messages, the oldest ones are evicted.
+
+    The pagination cursor is the sequence number of a message: it stays valid when messages are
+    deleted or evicted.
+    """
+
+    def __init__(self, max_size: int | None = None):
+        """
+        Parameters:
+        -----------
+        max_size: int | None
+            Maximum number of messages (None: no limit).
+        """
+
+        self.max_size = max_size
+        self._positions: dict[UUID, int] = {}  # id -> position in _order
+        self._order: list[TextModel | None] = []  # messages in insertion order, None for deleted ones
+        self._seqs: list[int] = []  # sequence number of each position (increasing)
+        self._head = 0  # position of the oldest message that may still be live
+        self._next_seq = 1
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+
+    def append(self, message: TextModel):
+        """
+        Store a message. A message with the id of a stored message replaces it, keeping its position.
+        """
+
+        with self._lock:
+            position = self._positions.get(message.id)
+            if position is not None:
+                self._order[position] = message
+                return
+
+            self._positions[message.id] = len(self._order)
+            self._order.append(message)
+            self._seqs.append(self._next_seq)
+            self._next_seq += 1
+
+            while self.max_size is not None and len(self._positions) > self.max_size:
+                self._evict_oldest()
+            self._maybe_compact()
+
+
+    def get(self, message_id: UUID) -> TextModel | None:
+        with self._lock:
+            position = self._positions.get(message_id)
+            return self._order[position] if position is not None else None
+
+
+    def update(self, message_id: UUID, **fields) -> bool:
+        """
+        Set fields of a message. Return False if there is no message with this id.
+        """
+
+        message = self.get(message_id)
+        if message is None:
+            return False
+        for name, value in fields.items():
+            setattr(message, name, value)
+        return True
+
+
+    def delete(self, message_id: UUID) -> bool:
+        """
+        Delete a message. Return False if there is no message with this id.
+        """
+
+        with self._lock:
+            position = self._positions.pop(message_id, None)
+            if position is None:
+                return False
+            self._order[position] = None
+            self._maybe_compact()
+            return True
+
+
+    def page(self, limit: int | None = None, after: int | None = None) -> tuple[list[TextModel], int | None]:
+        """
+        Return the messages in insertion order, a page at a time.
+
+        Parameters:
+        -----------
+        limit: int | None
+            Maximum number of messages to return (None: all of them).
+        after: int | None
+            Cursor returned with the previous page (None: start from the oldest message).
+
+        Returns:
+        -----------
+        tuple
+            messages: list[TextModel]
+                The messages of the page.
+            next_cursor: int | None
+                Cursor of the next page, or None if this is the last page.
+        """
+
+        with self._lock:
+            start = self._head
+            if after is not None:
+                start = bisect.bisect_right(self._seqs, after, lo=self._head)
+
+            page, last = [], None
+            for position in range(start, len(self._order)):
+                message = self._order[position]
+                if message is None:
+                    continue
+                if limit is not None and len(page) == limit:
+                    return page, last
+                page.append(message)
+                last = self._seqs[position]
+
+            return page, None
+
+
+    def _evict_oldest(self):
+        while self._order[self._head] is None:
+            self._head += 1
+        del self._positions[self._order[self._head].id]
+        self._order[self._head] = None
+        self._head += 1
+        self.evictions += 1
+
+
+    def _maybe_compact(self):
+        # Rebuild the list without tombstones once they are the majority: O(1) amortized per operation
+        if len(self._order) < 64 or len(self._order) < 2 * len(self._positions):
+            return
+        live = [position for position in range(self._head, len(self._order)) if self._order[position] is not None]
+        self._order = [self._order[position] for position in live]
+        self._seqs = [self._seqs[position] for position in live]
+        self._positions = {message.id: position for position, message in enumerate(self._order)}
+        self._head = 0
+
+
+    def clear(self):
+        with self._lock:
+            self._positions.clear()
+            self._order.clear()
+            self._seqs.clear()
+            self._head = 0
+
+
+    def __contains__(self, message_id: UUID) -> bool:
+        return message_id in self._positions
+
+
+    def __iter__(self) -> Iterator[TextModel]:
+        return iter(self.page()[0])
+
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+
+    def close(self):
+        pass
+
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._positions), "max_size": self.max_size, "evictions": self.evictions}
+
+
+class SQLiteMessageStore:
+    """
+    Durable store of the transformed messages in a SQLite file (WAL mode), shared by all the
+    workers of a host (e.g. `uvicorn --workers N`) and kept across restarts.
+
+    `append` only queues the message: a background thread writes the queued messages in one
+    transaction (group commit), so the request path never waits on the disk. Reads, updates and
+    deletes first wait for the messages queued by this process; messages queued by other workers
+    become visible within `commit_interval` seconds. Since they can wait for a commit, the app
+    calls them off the event loop (`asyncio.to_thread`).
+
+    Same interface and pagination cursor (the sequence number of a message) as InMemoryMessageStore.
+    """
+
+    COLUMNS = ("id", "original_text", "prompt", "transformed_text", "from_cache", "semantic_similarity")
+
+    def __init__(self, path: Path, max_size: int | None = None, ttl: float | None = None,
+                 commit_interval: float = 0.05, max_batch: int = 256):
+        """
+        Parameters:
+        -----------
+        path: Path
+            The .db file of the messages (created if missing).
+        max_size: int | None
+            Maximum number of messages; the oldest ones are evicted (None: no limit).
+        ttl: float | None
+            Seconds after which a message is evicted (None: messages don't expire).
+        commit_interval: float
+            Seconds the writer waits to gather more messages into a transaction.
+        max_batch: int
+            Maximum number of messages written per transaction.
+        """
+
+        self.path = Path(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self._lock = threading.Lock()  # serializes the statements of this process
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, NORMAL syncs at checkpoints only: a crash of the host can lose the last commits, not corrupt the file
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                original_text TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                transformed_text TEXT NOT NULL,
+                from_cache INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                semantic_similarity REAL
+            )""")
+        # Files created before the semantic cache
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if "semantic_similarity" not in columns:
+            try:
+                self._conn.execute("ALTER TABLE messages ADD COLUMN semantic_similarity REAL")
+            except sqlite3.OperationalError:
+                pass  # added by another worker in the meantime
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)")
+        self._queue: queue.Queue = queue.Queue()
+        self._writer: threading.Thread | None = None
+        self._writer_lock = threading.Lock()
+        self.commits = 0
+        self.written = 0
+        self.evictions = 0
+        self.write_errors = 0
+
+
+    def append(self, message: TextModel):
+        """
+        Queue a message for the next group commit. A message with the id of a stored message replaces it.
+        """
+
+        self._ensure_writer()
+        self._queue.put((message, time.time()))
+
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="message-store-writer", daemon=True)
+                self._writer.start()
+
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is _FLUSH:
+                self._queue.task_done()
+                continue
+            if item is None:
+                self._queue.task_done()
+                return
+
+            # Gather the messages queued during the commit interval into one transaction,
+            # unless a reader is waiting for them
+            batch, markers = [item], 0
+            deadline = time.monotonic() + self.commit_interval
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _FLUSH or item is None:
+                    markers += 1
+                    stop = item is None
+                    break
+                batch.append(item)
+
+            try:
+                self._write(batch)
+            except Exception:
+                self.write_errors += 1
+                logger.exception("Failed to write %d messages to %s", len(batch), self.path)
+            finally:
+                for _ in range(len(batch) + markers):
+                    self._queue.task_done()
+            if stop:
+                return
+
+
+    def _write(self, batch: list[tuple[TextModel, float]]):
+        rows = [
+            (str(message.id), message.original_text, message.prompt, message.transformed_text, int(message.from_cache),
+             message.semantic_similarity, created_at)
+            for message, created_at in batch
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("""
+                    INSERT INTO messages (id, original_text, prompt, transformed_text, from_cache, semantic_similarity, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        original_text = excluded.original_text,
+                        prompt = excluded.prompt,
+                        transformed_text = excluded.transformed_text,
+                        from_cache = excluded.from_cache,
+                        semantic_similarity = excluded.semantic_similarity""", rows)
+                self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.commits += 1
+        self.written += len(rows)
+
+
+    def _evict(self):
+        if self.ttl is not None:
+            self.evictions += self._conn.execute(
+                "DELETE FROM messages WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        if self.max_size is not None:
+            self.evictions += self._conn.execute(
+                "DELETE FROM messages WHERE seq <= (SELECT seq FROM messages ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (self.max_size,)).rowcount
+
+
+    def flush(self):
+        """
+        Wait until the messages queued by this process are committed.
+        """
+
+        if self._writer is not None and self._writer.is_alive() and self._queue.unfinished_tasks:
+            # Tell the writer to commit now rather than at the end of its commit interval
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+
+    def _to_message(self, row: tuple) -> TextModel:
+        fields = dict(zip(self.COLUMNS, row))
+        fields["id"] = UUID(fields["id"])
+        fields["from_cache"] = bool(fields["from_cache"])
+        # Stored messages were validated when they were created
+        return TextModel.model_construct(**fields)
+
+
+    def get(self, message_id: UUID) -> TextModel | None:
+        self.flush()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM messages WHERE id = ?", (str(message_id),)).fetchone()
+        return self._to_message(row) if row is not None else None
+
+
+    def update(self, message_id: UUID, **fields) -> bool:
+        """
+        Set fields of a message. Return False if there is no message with this id.
+        """
+
+        unknown = set(fields) - set(self.COLUMNS[1:])
+        if unknown:
+            raise ValueError(f"Unknown message fields: {sorted(unknown)}")
+        self.flush()
+        if not fields:
+            return message_id in self
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE messages SET {assignments} WHERE id = ?", (*fields.values(), str(message_id)))
+        return cursor.rowcount > 0
+
+
+    def delete(self, message_id: UUID) -> bool:
+        """
+        Delete a message. Return False if there is no message with this id.
+        """
+
+        self.flush()
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM messages WHERE id = ?", (str(message_id),))
+        return cursor.rowcount > 0
+
+
+    def page(self, limit: int | None = None, after: int | None = None) -> tuple[list[TextModel], int | None]:
+        """
+        Return the messages in creation order, a page at a time (see InMemoryMessageStore.page).
+        """
+
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT seq, {', '.join(self.COLUMNS)} FROM messages WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after or 0, limit + 1 if limit is not None else -1)).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return [self._to_message(row[1:]) for row in rows], next_cursor
+
+
+    def clear(self):
+        self.flush()
+        with self._lock:
+            self._conn.execute("DELETE FROM messages")
+
+
+    def __contains__(self, message_id: UUID) -> bool:
+        self.flush()
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM messages WHERE id = ?", (str(message_id),)).fetchone() is not None
+
+
+    def __iter__(self) -> Iterator[TextModel]:
+        return iter(self.page()[0])
+
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+    def close(self):
+        """
+        Commit the queued messages, stop the writer and close the database.
+        """
+
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._lock:
+            self._conn.close()
+
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "path": str(self.path),
+            "max_size": self.max_size,
+            "pending": self._queue.qsize(),
+            "commits": self.commits,
+            "written": self.written,
+            "evictions": self.evictions,
+            "write_errors": self.write_errors,
+        }
@@ -0,0 +1,265 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+from starlette.routing import Match
+
+# Buckets (in seconds) of the latency histograms: from the similarity search to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """
+    A monotonically increasing value per combination of labels.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """
+    The distribution of observed values (e.g. durations in seconds) per combination of labels,
+    as cumulative bucket counts, a sum and a count.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # labels: [count per bucket (not cumulative), sum, count]
+        self._lock = threading.Lock()
+
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return entry[2] if entry is not None else 0
+
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+        for key, bucket_counts, total, count in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process, rendered in the Prometheus text format (GET /metrics).
+
+    Besides its counters and histograms, the registry renders the values of collectors:
+    functions called at each scrape, for the statistics kept elsewhere (e.g. the cache hits).
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._collectors: list[Callable[[], list[tuple]]] = []
+
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"A metric named {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+    def add_collector(self, collector: Callable[[], list[tuple]]):
+        """
+        Add a function returning metrics computed at each scrape, as a list of
+        (name, type, documentation, [(labels, value), ...]) tuples.
+        """
+
+        self._collectors.append(collector)
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "dailogy_stage_seconds", "Time spent in each stage of the requests.", ("stage",))
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "dailogy_http_request_seconds", "Duration of the HTTP requests, until the response is sent.", ("method", "route", "status"))
+TOKENS = metrics.counter(
+    "dailogy_tokens_total", "Tokens used by the OpenAI API calls.", ("model", "type"))
+RETRIES = metrics.counter(
+    "dailogy_retries_total", "Retries of the upstream calls.", ("operation",))
+
+
+class RequestTimings:
+    """
+    Total time spent in each stage during one request, for its Server-Timing header.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self._lock = threading.Lock()  # stages can run in worker threads
+
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+    def server_timing(self) -> str:
+        with self._lock:
+            stages = list(self.stages.items())
+        stages.append(("total", time.perf_counter() - self.start))
+        return ", ".join(f"{stage};dur={1000 * seconds:.1f}" for stage, seconds in stages)
+
+
+# Timings of the request being handled (copied into the tasks and worker threads it starts)
+_request_timings: ContextVar[RequestTimings | None] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block of code: the duration is recorded in the stage histogram and, during a request,
+    in its Server-Timing header.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(name, seconds)
+
+
+def record_tokens(model, prompt_tokens: int, completion_tokens: int):
+    model = getattr(model, "value", model)
+    TOKENS.inc(prompt_tokens, model=model, type="prompt")
+    TOKENS.inc(completion_tokens, model=model, type="completion")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times the HTTP requests (by route template, so the ids in the paths do not
+    create new series) and adds a Server-Timing header with the duration of the stages of the request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+
+    def _route(self, scope) -> str:
+        router = scope.get("router") or getattr(scope.get("app"), "router", None)
+        for route in getattr(router, "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "<unmatched>"
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = [*message["headers"], (b"server-timing", timings.server_timing().encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - timings.start, method=scope["method"], route=self._route(scope), status=status)
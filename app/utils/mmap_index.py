@@ -0,0 +1,154 @@
+import json
+import struct
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+# First bytes of a mapped index file, followed by the length of its JSON header (little-endian uint64)
+MAGIC = b"DLGMMAP1"
+# Alignment of the arrays in the file (a cache line; also enough for any numpy dtype)
+ALIGNMENT = 64
+
+
+def mmap_index_path(path_emb: Path) -> Path:
+    """
+    Return the path of the memory-mapped example index persisted next to a .db file (e.g. embeddings.mmap).
+    """
+
+    path_emb = Path(path_emb)
+    return path_emb.with_name(path_emb.stem + ".mmap")
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode_texts(texts: Sequence[str]) -> tuple[np.ndarray, np.ndarray]:
+    # The UTF-8 texts concatenated, and the offsets of their starts (plus the end of the last text)
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class MappedTexts(Sequence):
+    """
+    Read-only sequence of the texts stored in a mapped index: a text is decoded from the mapped
+    bytes when it is accessed, so the texts are never copied into the memory of the process.
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("text index out of range")
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+def write_mmap_index(path: Path, ids: np.ndarray, matrix: np.ndarray, dysfunctional: Sequence[str],
+                     functional: Sequence[str], source_hash: str):
+    """
+    Write the arrays of an example index to a single file that processes map read-only
+    (see `read_mmap_index`). The file is replaced atomically.
+
+    Layout: MAGIC, the length of the JSON header, the JSON header (shapes, dtypes and offsets of the
+    arrays, and the hash of the .db file they come from), then the arrays, each aligned on 64 bytes.
+
+    Parameters:
+    -----------
+    path: Path
+        The file to write.
+    ids: np.ndarray
+        Integer ids of the examples.
+    matrix: np.ndarray
+        A float32 matrix with the normalized embeddings, one row per example.
+    dysfunctional: Sequence[str]
+        Dysfunctional texts, one per example.
+    functional: Sequence[str]
+        Functional version of the texts, one per example.
+    source_hash: str
+        SHA-256 of the .db file of the examples, to detect a stale mapped index.
+    """
+
+    ids = np.ascontiguousarray(ids)
+    if not np.issubdtype(ids.dtype, np.integer):
+        raise ValueError(f"The ids of a mapped index must be integers, got {ids.dtype}.")
+    dysfunctional_offsets, dysfunctional_data = _encode_texts(dysfunctional)
+    functional_offsets, functional_data = _encode_texts(functional)
+    arrays = {
+        "ids": ids.astype(np.int64, copy=False),
+        "matrix": np.ascontiguousarray(matrix, dtype=np.float32),
+        "dysfunctional_offsets": dysfunctional_offsets,
+        "dysfunctional": dysfunctional_data,
+        "functional_offsets": functional_offsets,
+        "functional": functional_data,
+    }
+
+    # Offsets of the arrays, relative to the start of the data (the end of the padded header)
+    sections, offset = {}, 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        sections[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+        offset += array.nbytes
+    header = {"version": 1, "source_hash": source_hash, "sections": sections}
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    # Write to a temporary file first: a process that mapped the old file keeps reading it
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + sections[name]["offset"])
+            f.write(memoryview(array).cast("B"))
+    tmp.replace(path)
+
+
+def read_mmap_index(path: Path) -> tuple[dict, dict]:
+    """
+    Map the arrays of a file written with `write_mmap_index`.
+
+    The arrays are read-only views of the file: their pages are loaded on demand, and shared
+    (in the page cache of the OS) by all the processes that map the file.
+
+    Returns:
+    -----------
+    tuple
+        header: dict
+            The header of the file (e.g. "source_hash").
+        arrays: dict
+            The mapped arrays, by name.
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a mapped example index.")
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = _align(len(MAGIC) + 8 + header_size)
+
+    arrays = {}
+    for name, section in header["sections"].items():
+        shape = tuple(section["shape"])
+        if 0 in shape:
+            # Nothing to map (mmap rejects empty regions)
+            arrays[name] = np.empty(shape, dtype=section["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=section["dtype"], mode="r", offset=data_start + section["offset"], shape=shape)
+    return header, arrays
@@ -0,0 +1,225 @@
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.utils.embedding_store import EMBEDDING_DTYPE
+
+
+class LatencyModel:
+    """
+    A log-normal latency distribution, given by its median and 99th percentile (in ms).
+    """
+
+    # z-score of the 99th percentile of the standard normal distribution
+    _Z99 = 2.326
+
+    def __init__(self, median_ms: float, p99_ms: float | None = None):
+        """
+        Parameters:
+        -----------
+        median_ms: float
+            Median latency (0: no latency).
+        p99_ms: float | None
+            99th percentile of the latency (None or <= median: constant latency).
+        """
+
+        self.median_ms = median_ms
+        self.p99_ms = p99_ms if p99_ms is not None else median_ms
+        self.sigma = np.log(self.p99_ms / median_ms) / self._Z99 if median_ms > 0 and self.p99_ms > median_ms else 0.0
+
+
+    def sample(self, rng: random.Random) -> float:
+        """
+        Return a latency, in seconds.
+        """
+
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms * np.exp(self.sigma * rng.gauss(0, 1)) / 1000
+
+
+def mock_embedding(text: str, dim: int) -> np.ndarray:
+    """
+    Return a deterministic unit-norm embedding of a text (seeded by its hash): the same text
+    always gets the same embedding, different texts are nearly orthogonal.
+    """
+
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    embedding = np.random.default_rng(seed).normal(size=dim).astype(EMBEDDING_DTYPE)
+    return embedding / np.linalg.norm(embedding)
+
+
+class MockOpenAI:
+    """
+    A local stand-in for the embeddings and chat completions endpoints of the OpenAI API,
+    to measure the throughput and the tail latency of the app without the real API.
+
+    Each call waits for a latency drawn from its latency model; a share of the calls fails with
+    429 (with a retry-after-ms header) or 500. The chat completion echoes the last line of the prompt,
+    and can be streamed (one word per chunk, `token_ms` between two chunks).
+    Point the app at it with OPENAI_BASE_URL (see `app.scripts.mock_openai_server`).
+    """
+
+    def __init__(self, embedding_latency: LatencyModel | None = None, chat_latency: LatencyModel | None = None,
+                 token_ms: float = 0.0, rate_limit_ratio: float = 0.0, server_error_ratio: float = 0.0,
+                 retry_after_ms: float = 100.0, embedding_dim: int = 1536, seed: int | None = None):
+        """
+        Parameters:
+        -----------
+        embedding_latency: LatencyModel | None
+            Latency of an embeddings call (None: no latency).
+        chat_latency: LatencyModel | None
+            Latency of a chat completion, until the first token when streamed (None: no latency).
+        token_ms: float
+            Milliseconds between two chunks of a streamed completion.
+        rate_limit_ratio: float
+            Share of the calls answered with 429.
+        server_error_ratio: float
+            Share of the calls answered with 500.
+        retry_after_ms: float
+            Delay requested by the 429 responses.
+        embedding_dim: int
+            Dimension of the embeddings (1536 for text-embedding-3-small, as in embeddings.db).
+        seed: int | None
+            Seed of the latencies and of the injected errors.
+        """
+
+        self.embedding_latency = embedding_latency or LatencyModel(0)
+        self.chat_latency = chat_latency or LatencyModel(0)
+        self.token_ms = token_ms
+        self.rate_limit_ratio = rate_limit_ratio
+        self.server_error_ratio = server_error_ratio
+        self.retry_after_ms = retry_after_ms
+        self.embedding_dim = embedding_dim
+        self.rng = random.Random(seed)
+        self.reset()
+
+        self.app = FastAPI()
+        self.app.post("/v1/embeddings")(self.create_embeddings)
+        self.app.post("/v1/chat/completions")(self.create_chat_completion)
+        self.app.get("/stats")(self.get_stats)
+        self.app.post("/stats/reset")(self.reset_stats)
+
+
+    def reset(self):
+        self.calls = {"embeddings": 0, "chat": 0}
+        self.texts_embedded = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.tokens = 0
+
+
+    def _injected_error(self) -> JSONResponse | None:
+        # A 429 or a 500, in the format of the OpenAI API, or None
+        draw = self.rng.random()
+        if draw < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": "Rate limit reached (mock).", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"retry-after-ms": str(self.retry_after_ms)})
+        if draw < self.rate_limit_ratio + self.server_error_ratio:
+            self.server_errors += 1
+            return JSONResponse(
+                status_code=500,
+                content={"error": {"message": "The server had an error (mock).", "type": "server_error", "code": None}})
+        return None
+
+
+    async def create_embeddings(self, request: Request):
+        body = await request.json()
+        self.calls["embeddings"] += 1
+        await asyncio.sleep(self.embedding_latency.sample(self.rng))
+        if (error := self._injected_error()) is not None:
+            return error
+
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.texts_embedded += len(texts)
+        data = []
+        for i, text in enumerate(texts):
+            embedding = mock_embedding(text, self.embedding_dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(embedding.astype(np.float32).tobytes()).decode("ascii")
+            else:
+                embedding = embedding.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        tokens = sum(len(text.split()) for text in texts)
+        self.tokens += tokens
+        return {
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+
+    async def create_chat_completion(self, request: Request):
+        body = await request.json()
+        self.calls["chat"] += 1
+        await asyncio.sleep(self.chat_latency.sample(self.rng))
+        if (error := self._injected_error()) is not None:
+            return error
+
+        prompt = body["messages"][-1]["content"]
+        content = "functional: " + prompt.strip().splitlines()[-1].strip()
+        prompt_tokens = sum(len(message["content"].split()) for message in body["messages"])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content.split()),
+                 "total_tokens": prompt_tokens + len(content.split())}
+        self.tokens += usage["total_tokens"]
+        completion_id = f"chatcmpl-mock-{self.calls['chat']}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        async def chunks():
+            def chunk(choices, **fields):
+                return "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                              "model": body["model"], "choices": choices, **fields}) + "\n\n"
+
+            for i, word in enumerate(content.split(" ")):
+                if i and self.token_ms:
+                    await asyncio.sleep(self.token_ms / 1000)
+                yield chunk([{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}])
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+    async def get_stats(self):
+        return self.stats()
+
+
+    async def reset_stats(self):
+        self.reset()
+        return self.stats()
+
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "texts_embedded": self.texts_embedded,
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "tokens": self.tokens,
+        }
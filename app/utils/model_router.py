@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from app.utils.metrics import metrics
+from app.utils.openai_config import OpenAIModels
+from app.utils.request_handler import ahandle_request
+from app.utils.response_cache import ResponseCache
+from app.utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+HEDGED_CALLS = metrics.counter(
+    "dailogy_hedged_calls_total", "Hedged chat completions, by model of the hedge and winner.", ("model", "winner"))
+
+
+class LatencyTracker:
+    """
+    Rolling window of the latencies of the chat completions, per model.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """
+        Parameters:
+        -----------
+        window: int
+            Number of recent latencies kept per model.
+        min_samples: int
+            Latencies needed before the percentiles of a model are used.
+        """
+
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, model: OpenAIModels, seconds: float):
+        with self._lock:
+            self._latencies.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+
+    def percentile(self, model: OpenAIModels, q: float) -> float | None:
+        """
+        Return the q-th percentile of the recent latencies of a model, in seconds
+        (None until `min_samples` latencies were observed).
+        """
+
+        with self._lock:
+            latencies = list(self._latencies.get(model, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return float(np.percentile(latencies, q))
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = {model: list(latencies) for model, latencies in self._latencies.items()}
+        return {
+            getattr(model, "value", model): {
+                "samples": len(latencies),
+                "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+                "p95_ms": 1000 * float(np.percentile(latencies, 95)),
+            }
+            for model, latencies in models.items() if latencies
+        }
+
+
+class ModelRouter:
+    """
+    Choose the model of each chat completion, and hedge the slow ones.
+
+    - Routing: texts of at most `short_text_max_tokens` tokens go to the model of `models` with the
+      lowest median latency; the other texts go to the primary model.
+    - Hedging: when a call has not answered after the observed p95 latency of its model
+      (`hedge_percentile`), a duplicate call is sent to `hedge_model` (the same model if None).
+      The first answer wins and the other call is cancelled. Hedges are limited to `max_hedge_ratio`
+      of the recent calls (the window of the tracker), so a slow upstream does not get twice the load,
+      even after a long quiet period.
+    """
+
+    def __init__(self, primary: OpenAIModels, models: list[OpenAIModels] | None = None, hedge_model: OpenAIModels | None = None,
+                 hedging: bool = True, hedge_percentile: float = 95, min_hedge_delay: float = 0.05, max_hedge_ratio: float = 0.1,
+                 short_text_max_tokens: int = 0, tracker: LatencyTracker | None = None):
+        """
+        Parameters:
+        -----------
+        primary: OpenAIModels
+            The model used by default.
+        models: list[OpenAIModels] | None
+            Models the short texts can be routed to (default: the primary and the hedge model).
+        hedge_model: OpenAIModels | None
+            Model of the hedged calls (None: the model of the original call).
+        hedging: bool
+            Whether slow calls are hedged.
+        hedge_percentile: float
+            Percentile of the latency of a model after which its calls are hedged.
+        min_hedge_delay: float
+            Minimum delay, in seconds, before a call is hedged.
+        max_hedge_ratio: float
+            Maximum share of the recent calls that are hedged.
+        short_text_max_tokens: int
+            Texts up to this number of tokens go to the fastest model (0: disabled).
+        tracker: LatencyTracker | None
+            The latencies of the models (default: a new tracker).
+        """
+
+        self.primary = primary
+        self.hedge_model = hedge_model
+        self.models = models or list(dict.fromkeys(model for model in (primary, hedge_model) if model is not None))
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.short_text_max_tokens = short_text_max_tokens
+        self.tracker = tracker or LatencyTracker()
+
+        self.calls = 0
+        self.hedges = 0
+        self._recent = deque(maxlen=self.tracker.window)  # the recent calls (False) and hedges (True)
+        self.hedges_won = 0  # hedges that answered first
+        self.short_routed = 0  # short texts sent to a model other than the primary
+
+
+    def choose(self, user_text: str | None = None) -> OpenAIModels:
+        """
+        Return the model for a text: the fastest model for a short text, otherwise the primary model.
+        """
+
+        if not self.short_text_max_tokens or user_text is None or len(self.models) < 2:
+            return self.primary
+        if count_tokens(user_text, self.primary) > self.short_text_max_tokens:
+            return self.primary
+
+        # A model without enough latencies gets the short texts until its median is known
+        medians = {model: self.tracker.percentile(model, 50) for model in self.models}
+        unknown = [model for model, median in medians.items() if median is None]
+        model = unknown[0] if unknown else min(medians, key=medians.get)
+        if model != self.primary:
+            self.short_routed += 1
+        return model
+
+
+    def hedge_delay(self, model: OpenAIModels) -> float | None:
+        """
+        Return the seconds after which a call to the model is hedged (None: no hedge).
+        """
+
+        if not self.hedging or not self._may_hedge():
+            return None
+        delay = self.tracker.percentile(model, self.hedge_percentile)
+        return max(delay, self.min_hedge_delay) if delay is not None else None
+
+
+    def _may_hedge(self) -> bool:
+        # One more hedge must keep the hedges within max_hedge_ratio of the recent calls
+        hedges = sum(self._recent)
+        return hedges + 1 <= self.max_hedge_ratio * (len(self._recent) - hedges)
+
+
+    async def _timed_request(self, prompt: str, client: AsyncOpenAI, model: OpenAIModels, temperature: float,
+                             response_cache: ResponseCache | None) -> tuple[str, int, bool, OpenAIModels]:
+        start = time.perf_counter()
+        transformed_text, total_tokens, from_cache = await ahandle_request(
+            prompt=prompt, client=client, model=model, temperature=temperature, response_cache=response_cache)
+        if not from_cache:
+            self.tracker.observe(model, time.perf_counter() - start)
+        return transformed_text, total_tokens, from_cache, model
+
+
+    async def ahandle_request(self, prompt: str, client: AsyncOpenAI, temperature: float,
+                              response_cache: ResponseCache | None = None, user_text: str | None = None) -> tuple[str, int, bool, OpenAIModels]:
+        """
+        Route a chat completion (see `ahandle_request`), hedging it if it is slow.
+
+        Parameters:
+        -----------
+        prompt: str
+            Prompt to pass to the OpenAI model.
+        client: AsyncOpenAI
+            Object that manage the call to OpenAI API.
+        temperature: float
+            Temperature for the OpenAI model.
+        response_cache: ResponseCache | None
+            Cache of the responses.
+        user_text: str | None
+            The user's text, for the routing of the short texts.
+
+        Returns:
+        -----------
+        tuple
+            edited_text: str
+                Text converted in a more functional version.
+            total_token: int
+                Number of tokens used by the call that answered.
+            from_cache: bool
+                Whether the response comes from the cache.
+            model: OpenAIModels
+                The model that answered.
+        """
+
+        model = self.choose(user_text)
+        self.calls += 1
+        self._recent.append(False)
+        delay = self.hedge_delay(model)
+
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(self._timed_request(prompt, client, model, temperature, response_cache))
+        if delay is None:
+            return await primary
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            # The caller is gone (e.g. the client disconnected): don't leave the call running
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+        if not self._may_hedge():
+            # Other calls used the allowance of hedges in the meantime
+            return await primary
+
+        # Hedge: the first successful answer wins
+        self.hedges += 1
+        self._recent.append(True)
+        hedge_model = self.hedge_model or model
+        hedge = asyncio.ensure_future(self._timed_request(prompt, client, hedge_model, temperature, response_cache))
+        started_at = {primary: started, hedge: time.perf_counter()}
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task.exception() is not None):
+                    if task.exception() is None:
+                        winner = "hedge" if task is hedge else "primary"
+                        self.hedges_won += task is hedge
+                        HEDGED_CALLS.inc(model=getattr(hedge_model, "value", hedge_model), winner=winner)
+                        return task.result()
+                    if not pending:
+                        # Both calls failed: no winner
+                        return task.result()
+                    logger.warning("Hedged call to %s failed: %s", model if task is primary else hedge_model, task.exception())
+        finally:
+            for task in pending:
+                task.cancel()
+                # The cancelled call took at least this long: recorded, so the p95 does not ignore the slow calls
+                self.tracker.observe(model if task is primary else hedge_model, time.perf_counter() - started_at[task])
+
+
+    def stats(self) -> dict:
+        return {
+            "primary": getattr(self.primary, "value", self.primary),
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "short_routed": self.short_routed,
+            "latencies": self.tracker.stats(),
+        }
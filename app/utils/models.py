@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, field_validator, ValidationInfo
 from uuid import UUID, uuid4
-from typing import Optional
+from typing import Optional, List
 
 
 class TextModel(BaseModel):
@@ -8,6 +8,9 @@ class TextModel(BaseModel):
     original_text: str = Field(min_length=10)
     prompt: str = Field(default="") # prompt to pass to the LLM
     transformed_text: str = Field(default="") # text transformed into neutral/functional language
+    from_cache: bool = Field(default=False) # whether transformed_text was served from the response cache
+    # similarity with the known text whose transformation was reused (semantic cache), None if the LLM transformed this text
+    semantic_similarity: Optional[float] = Field(default=None)
 
     
     @field_validator("original_text")
@@ -94,7 +97,37 @@ class TextModel(BaseModel):
         return v
 
 
+def parse_fields(fields: str | None, model: type[BaseModel] = TextModel) -> set[str] | None:
+    """
+    Parse a projection of the fields of a model, e.g. "id,transformed_text" (None: all the fields).
+    Raise a ValueError if a field is not a field of the model.
+    """
+
+    if fields is None:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - set(model.model_fields)
+    if unknown or not names:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown)) or fields!r}. "
+                         f"Available fields: {', '.join(model.model_fields)}.")
+    return names
+
+
 class MessageUpdateRequest(BaseModel):
     original_text: Optional[str] = None
     prompt: Optional[str] = None
     transformed_text: Optional[str] = None
+
+
+class BatchTransformRequest(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=100) # texts to transform, at most 100 per batch
+
+
+class BatchItemResult(BaseModel):
+    index: int # position of the text in the request
+    message: Optional[TextModel] = None # the transformed message, if the transformation succeeded
+    error: Optional[str] = None # why the transformation failed, otherwise
+
+
+class BatchTransformResponse(BaseModel):
+    results: List[BatchItemResult]
@@ -11,5 +11,17 @@ class OpenAIModels(str, Enum):
 
 MODEL_TOKEN_LIMITS = {
     OpenAIModels.GPT3_TURBO: 4_096,
-    OpenAIModels.GPT4: 8_192
+    OpenAIModels.GPT4: 8_192,
+    OpenAIModels.GPT4o: 128_000,
+    OpenAIModels.GPT4o_MINI: 128_000,
+}
+
+
+# Requests per minute (rpm) and tokens per minute (tpm) allowed by the OpenAI account (usage tier 1)
+MODEL_RATE_LIMITS = {
+    OpenAIModels.GPT3_TURBO: {"rpm": 3_500, "tpm": 200_000},
+    OpenAIModels.GPT4: {"rpm": 500, "tpm": 10_000},
+    OpenAIModels.GPT4o: {"rpm": 500, "tpm": 30_000},
+    OpenAIModels.GPT4o_MINI: {"rpm": 500, "tpm": 200_000},
+    OpenAIModels.TEXT_EMB_3_SMALL: {"rpm": 3_000, "tpm": 1_000_000},
 }
@@ -0,0 +1,243 @@
+import re
+import string
+import threading
+
+from app.utils.metrics import stage
+from app.utils.openai_config import OpenAIModels, MODEL_TOKEN_LIMITS
+from app.utils.prompts import build_prompt
+from app.utils.request_handler import EXPECTED_COMPLETION_TOKENS
+from app.utils.tokens import count_tokens
+
+
+# Runs of spaces and tabs, and runs of blank lines
+_SPACES = re.compile(r"[ \t]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def normalize_whitespace(text: str) -> str:
+    """
+    Remove the indentation and trailing spaces of each line, collapse runs of spaces,
+    and keep at most one blank line between paragraphs.
+    """
+
+    lines = (_SPACES.sub(" ", line).strip() for line in text.strip().splitlines())
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines))
+
+
+def prompt_token_budget(model: OpenAIModels, max_tokens: int | None = None,
+                        completion_tokens: int = EXPECTED_COMPLETION_TOKENS) -> int | None:
+    """
+    Return the maximum number of prompt tokens for a model: its context window (MODEL_TOKEN_LIMITS)
+    minus the tokens reserved for the completion, capped at `max_tokens`.
+    Returns `max_tokens` if the context window of the model is unknown.
+    """
+
+    limit = MODEL_TOKEN_LIMITS.get(model)
+    if limit is None:
+        return max_tokens
+    limit -= completion_tokens
+    return limit if max_tokens is None else min(limit, max_tokens)
+
+
+class CompiledTemplate:
+    """
+    A str.format template parsed once, with its whitespace normalized.
+    """
+
+    def __init__(self, template: str):
+        self.source = normalize_whitespace(template)
+        self.parts = [
+            (literal, field)
+            for literal, field, _, _ in string.Formatter().parse(self.source)
+        ]
+        self.fields = {field for _, field in self.parts if field}
+
+
+    def render(self, **values) -> str:
+        return "".join(literal + (str(values[field]) if field else "") for literal, field in self.parts)
+
+
+# The prompt of the app, without the indentation of the original triple-quoted strings (see `build_prompt`)
+PROMPT_HEADER = """
+    Below is an instruction that describes a task.
+    Write a response that appropriately completes the request.
+
+    ### Objective:
+    Transform the following text, which originates from the context of dysfunctional communication between couples, into functional language.
+    Make the text actionable or practical, while maintaining a natural, conversational tone.
+
+    ### Instructions:
+    1. Review the provided text carefully.
+    2. Convert the text into functional, everyday language, focusing on making the content actionable and practical.
+    3. Aim for a conversational tone, as if explaining to a friend, to ensure the paragraph is engaging and accessible.
+    4. Ensure the transformed text promotes understanding, empathy, and positive communication, suitable for couples or ex-couples who need to interact constructively.
+    5. Always respond only with the transformed text and nothing else.
+    """
+
+PROMPT_EXAMPLES_HEADER = """
+    ### Examples
+    Here are some examples of how to convert a dysfucntional text into functional version:
+    """
+
+PROMPT_EXAMPLE = """
+    - Input: {dysfunctional}
+    - Expected Output: {functional}
+    """
+
+PROMPT_FOOTER = """
+    ### Input
+    Please transform the following text into functional language:
+
+    {user_text}
+    """
+
+
+class RenderedPrompt:
+    """
+    A prompt rendered by PromptRenderer, with its token counts.
+    """
+
+    def __init__(self, text: str, tokens: int, num_examples: int, num_dropped: int, tokens_saved: int, budget: int | None):
+        self.text = text
+        self.tokens = tokens
+        self.num_examples = num_examples  # examples included in the prompt
+        self.num_dropped = num_dropped  # candidate examples left out to stay within the budget
+        self.tokens_saved = tokens_saved  # tokens saved compared to `build_prompt` with the same examples
+        self.budget = budget
+
+
+    def info(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "num_examples": self.num_examples,
+            "num_dropped": self.num_dropped,
+            "tokens_saved": self.tokens_saved,
+            "budget": self.budget,
+        }
+
+
+class PromptRenderer:
+    """
+    Render the few-shot prompt from precompiled, whitespace-normalized templates, within a token budget.
+
+    The candidate examples are taken in order (highest similarity first) as long as they fit in
+    the budget; an example that does not fit is skipped, so a shorter one after it can still be used.
+    The number of examples is thus set by the budget: pass more candidates than a prompt can hold.
+    The tokens of the fixed parts of the prompt are counted once per model, as are the tokens saved
+    on the fixed parts and on each example compared to `build_prompt`.
+    """
+
+    def __init__(self, model: OpenAIModels, token_budget: int | None = None, header: str = PROMPT_HEADER,
+                 examples_header: str = PROMPT_EXAMPLES_HEADER, example: str = PROMPT_EXAMPLE, footer: str = PROMPT_FOOTER):
+        """
+        Parameters:
+        -----------
+        model: OpenAIModels
+            The chat model (selects the tokenizer).
+        token_budget: int | None
+            Maximum number of prompt tokens (None: no limit), e.g. from `prompt_token_budget`.
+        header: str
+            The instructions.
+        examples_header: str
+            Introduces the examples (left out if no example fits).
+        example: str
+            Template of an example, with the fields {dysfunctional} and {functional}.
+        footer: str
+            Template of the user's text, with the field {user_text}.
+        """
+
+        self.model = model
+        self.token_budget = token_budget
+        self.header = normalize_whitespace(header)
+        self.examples_header = normalize_whitespace(examples_header)
+        self.example = CompiledTemplate(example)
+        self.footer = CompiledTemplate(footer)
+        if self.example.fields != {"dysfunctional", "functional"} or self.footer.fields != {"user_text"}:
+            raise ValueError("The example template needs {dysfunctional} and {functional}, the footer {user_text}.")
+
+        # Tokens of the fixed parts, and of the separators between the parts
+        self._header_tokens = count_tokens(self.header + "\n\n", model)
+        self._examples_header_tokens = count_tokens(self.examples_header + "\n", model)
+        self._footer_tokens = count_tokens("\n\n" + self.footer.render(user_text=""), model)
+        self._min_example_tokens = count_tokens(self.example.render(dysfunctional="", functional="") + "\n", model)
+
+        # Tokens saved compared to `build_prompt`: the indentation of its fixed parts and of each example
+        legacy_tokens = count_tokens(build_prompt("", []), model)
+        legacy_example_tokens = count_tokens(build_prompt("", [{"dysfunctional": "", "functional": ""}]), model) - legacy_tokens
+        self._fixed_tokens_saved = legacy_tokens - self._header_tokens - self._footer_tokens
+        self._example_tokens_saved = legacy_example_tokens - self._min_example_tokens
+
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.tokens = 0
+        self.tokens_saved = 0
+        self.dropped = 0
+
+
+    def render(self, user_text: str, examples: list[dict]) -> RenderedPrompt:
+        """
+        Render the prompt for the user's text with the examples that fit in the budget.
+
+        Parameters:
+        -----------
+        user_text: str
+            The user's text.
+        examples: list[dict]
+            Candidate examples (dictionaries with dysfunctional and functional texts), most similar first.
+
+        Returns:
+        -----------
+        RenderedPrompt
+            The prompt and its token counts.
+        """
+
+        with stage("prompt"):
+            return self._render(user_text, examples)
+
+
+    def _render(self, user_text: str, examples: list[dict]) -> RenderedPrompt:
+        user_text = user_text.strip()
+        tokens = self._header_tokens + self._footer_tokens + count_tokens(user_text, self.model)
+
+        selected = []
+        for candidate in examples:
+            if self.token_budget is not None and tokens + self._min_example_tokens > self.token_budget:
+                break  # not even an empty example fits
+            text = self.example.render(
+                dysfunctional=normalize_whitespace(candidate["dysfunctional"]),
+                functional=normalize_whitespace(candidate["functional"]))
+            cost = count_tokens(text + "\n", self.model) + (0 if selected else self._examples_header_tokens)
+            if self.token_budget is not None and tokens + cost > self.token_budget:
+                continue
+            selected.append(text)
+            tokens += cost
+
+        parts = [self.header]
+        if selected:
+            parts.append(self.examples_header + "\n" + "\n".join(selected))
+        parts.append(self.footer.render(user_text=user_text))
+        text = "\n\n".join(parts)
+        tokens = count_tokens(text, self.model)
+
+        # Compare with the original prompt (indented templates), without rendering it
+        tokens_saved = self._fixed_tokens_saved + len(selected) * self._example_tokens_saved
+        if selected:
+            tokens_saved -= self._examples_header_tokens  # always part of the original prompt
+
+        with self._lock:
+            self.rendered += 1
+            self.tokens += tokens
+            self.tokens_saved += tokens_saved
+            self.dropped += len(examples) - len(selected)
+
+        return RenderedPrompt(text, tokens, len(selected), len(examples) - len(selected), tokens_saved, self.token_budget)
+
+
+    def stats(self) -> dict:
+        return {
+            "token_budget": self.token_budget,
+            "rendered": self.rendered,
+            "mean_tokens": self.tokens / self.rendered if self.rendered else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "dropped_examples": self.dropped,
+        }
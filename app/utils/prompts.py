@@ -1,14 +1,64 @@
-from openai import OpenAI
-import sqlite3
+from openai import OpenAI, AsyncOpenAI
 from pathlib import Path
+import asyncio
 import numpy as np
-import json
-from sklearn.metrics.pairwise import cosine_similarity
 
 from app.utils.openai_config import OpenAIModels
+from app.utils.embedding_cache import EmbeddingCache
+from app.utils.embedding_store import read_examples
+from app.utils.example_index import ExampleIndex, RetrievalBackend, get_example_index
+from app.utils.local_embeddings import EmbeddingBackend
+from app.utils.metrics import record_tokens, stage
+from app.utils.rate_limiter import retry_with_exponential_backoff
+from app.utils.token_bucket import rate_limiters
+from app.utils.tokens import count_tokens
 
 
-def get_embedding(text: str, model: OpenAIModels, client: OpenAI) -> list:
+def _record_embedding_tokens(model: OpenAIModels, response):
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(model, usage.total_tokens, 0)
+
+
+# The clients don't retry (max_retries=0): the embedding calls are retried like the chat completions,
+# each attempt waiting for the rate limiter of the model (if configured)
+@retry_with_exponential_backoff
+def _request_embeddings(texts: list[str], model: OpenAIModels, client: OpenAI):
+    rate_limiter = rate_limiters.get(model)
+    estimated_tokens = sum(count_tokens(text, model) for text in texts)
+    if rate_limiter is not None:
+        with stage("rate_limit_wait"):
+            rate_limiter.acquire_sync(estimated_tokens)
+
+    with stage("embedding"):
+        response = client.embeddings.create(input=texts, model=model)
+
+    if rate_limiter is not None:
+        rate_limiter.reconcile(estimated_tokens, response.usage.total_tokens)
+    _record_embedding_tokens(model, response)
+    return response
+
+
+async def _arequest_embeddings(texts: list[str], model: OpenAIModels, client: AsyncOpenAI):
+    rate_limiter = rate_limiters.get(model)
+    estimated_tokens = sum(count_tokens(text, model) for text in texts)
+    if rate_limiter is not None:
+        with stage("rate_limit_wait"):
+            await rate_limiter.acquire(estimated_tokens)
+
+    with stage("embedding"):
+        response = await client.embeddings.create(input=texts, model=model)
+
+    if rate_limiter is not None:
+        await rate_limiter.areconcile(estimated_tokens, response.usage.total_tokens)
+    _record_embedding_tokens(model, response)
+    return response
+
+
+_arequest_embeddings_with_retries = retry_with_exponential_backoff(_arequest_embeddings)
+
+
+def get_embedding(text: str, model: OpenAIModels, client: OpenAI, cache: EmbeddingCache | None = None) -> list | np.ndarray:
     """
     Generate embeddings for the input text using OpenAI's API.
 
@@ -20,39 +70,109 @@ def get_embedding(text: str, model: OpenAIModels, client: OpenAI) -> list:
         Name of the model for the embeddings.
     client: OpenAI
         A client for the OpenAI API.
+    cache: EmbeddingCache | None
+        Cache of the embeddings. If the text was already embedded, the API is not called.
+
+    Returns:
+    --------
+    list | np.ndarray
+        A list with the vector embedding (a float32 array if the cache is used).
+    """
+
+    if cache is not None:
+        embedding = cache.get_embedding(model, text)
+        if embedding is not None:
+            return embedding
+
+    response = _request_embeddings([text], model, client)
+    embedding = response.data[0].embedding
+
+    if cache is not None:
+        embedding = cache.set_embedding(model, text, embedding)
+
+    return embedding
+
+
+async def aget_embedding(text: str, model: OpenAIModels, client: AsyncOpenAI, cache: EmbeddingCache | None = None) -> list | np.ndarray:
+    """
+    Async version of `get_embedding`, for an AsyncOpenAI client: the event loop keeps serving
+    other requests while waiting for the API.
+    """
+
+    if cache is not None:
+        embedding = await cache.aget_embedding(model, text)
+        if embedding is not None:
+            return embedding
+
+    response = await _arequest_embeddings_with_retries([text], model, client)
+    embedding = response.data[0].embedding
+
+    if cache is not None:
+        embedding = await cache.aset_embedding(model, text, embedding)
+
+    return embedding
+
+
+async def aget_embeddings(texts: list[str], model: OpenAIModels, client: AsyncOpenAI, cache: EmbeddingCache | None = None, retry: bool = True) -> list:
+    """
+    Generate the embeddings of several texts with a single API call.
+    Texts found in the cache, and repeated texts, are not sent to the API.
+
+    Parameters:
+    --------
+    texts: list[str]
+        Texts to use to generated the vector embeddings.
+    model: OpenAIModels
+        Name of the model for the embeddings.
+    client: AsyncOpenAI
+        An async client for the OpenAI API.
+    cache: EmbeddingCache | None
+        Cache of the embeddings.
+    retry: bool
+        Whether to retry the transient API errors (False if the caller retries the whole call).
 
     Returns:
     --------
     list
-        A list with the vector embedding.
+        The embeddings, in the same order as the texts.
     """
 
-    response = client.embeddings.create(input = [text], model=model)
-    return response.data[0].embedding
+    embeddings = [await cache.aget_embedding(model, text) if cache is not None else None for text in texts]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+
+    if missing:
+        request = _arequest_embeddings_with_retries if retry else _arequest_embeddings
+        response = await request(missing, model, client)
+
+        computed = {}
+        for item in response.data:
+            text = missing[item.index]
+            computed[text] = await cache.aset_embedding(model, text, item.embedding) if cache is not None else item.embedding
+        embeddings = [embedding if embedding is not None else computed[text] for text, embedding in zip(texts, embeddings)]
+
+    return embeddings
 
 
 def load_examples(path: Path) -> list[dict]:
-    # Fetch embedding from sql database
-    conn = sqlite3.connect(path)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, dysfunctional, embedding, functional FROM examples')
-    rows = cursor.fetchall()
-    conn.close()
+    # Fetch the examples from sql database (embeddings stored either as JSON or as float32 BLOBs)
+    with stage("load_examples"):
+        ids, dysfunctional, functional, embeddings = read_examples(path)
 
     # Move embedding and text into a list
     examples = []
-    for row in rows:
+    for i in range(len(ids)):
         examples.append({
-            'id': row[0],
-            'dysfunctional': row[1],
-            'embedding': np.array(json.loads(row[2])),
-            'functional': row[3]
+            'id': ids[i],
+            'dysfunctional': dysfunctional[i],
+            'embedding': embeddings[i],
+            'functional': functional[i]
         })
 
     return examples
 
 
-def find_closest(input_embedding: list, examples:list[dict], top_n:int=5) -> tuple:
+def find_closest(input_embedding: list, examples: list[dict] | ExampleIndex, top_n:int=5,
+                 backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None) -> tuple:
     """
     Return top_n pairs of dysfunctional text and its functional version,
     based on the cosine similarity with the input_embedding, which is the
@@ -62,9 +182,10 @@ def find_closest(input_embedding: list, examples:list[dict], top_n:int=5) -> tup
      -----------
     input_embedding: list
         Embedding of the user's text.
-    examples: list[dict]
-        List with dictionaries containing dysfunctional text, the dysfunctinal text embedding, and the functional version.
-        It has this structure:
+    examples: list[dict] | ExampleIndex
+        The resident index of the examples (see `get_example_index`), or a list with dictionaries
+        containing dysfunctional text, the dysfunctinal text embedding, and the functional version.
+        The list has this structure:
             [
                 {'id': 1,
                 'dysfunctional': "A dysfucntional example",
@@ -78,6 +199,11 @@ def find_closest(input_embedding: list, examples:list[dict], top_n:int=5) -> tup
             ]
     top_n: int
         number examples to select.
+    backend: RetrievalBackend
+        Exact search, or approximate search with the IVF index attached to the example index
+        (see `ann_index`). Without an IVF index, the exact search is used.
+    nprobe: int | None
+        Number of IVF clusters to scan (IVF backend only).
 
     Returns:
     -----------
@@ -104,18 +230,75 @@ def find_closest(input_embedding: list, examples:list[dict], top_n:int=5) -> tup
             ]
     """
 
-    example_embeddings = [example['embedding'] for example in examples]
-    similarities = cosine_similarity([input_embedding], example_embeddings)[0]
-    similar_indices = similarities.argsort()[-top_n:][::-1]
+    with stage("search"):
+        if not isinstance(examples, ExampleIndex):
+            examples = ExampleIndex.from_examples(examples)
 
-    selected_examples = [{"dysfunctional":examples[i]["dysfunctional"], "functional":examples[i]["functional"]} for i in similar_indices]
+        similar_indices, similarities = examples.search(input_embedding, top_n, backend, nprobe)
 
-    selected_similarities = [similarities[i] for i in similar_indices]
+    selected_examples = examples.get_examples(similar_indices)
+
+    selected_similarities = [np.float64(similarity) for similarity in similarities]
 
     return selected_examples, selected_similarities
 
 
-def select_examples(text: str, path_emb: Path , emb_model: OpenAIModels, client: OpenAI, num_examples: int=5) -> tuple[list, list]:
+def retrieve_examples(input_embedding: list, path_emb: Path, num_examples: int=5,
+                      backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None) -> list[dict]:
+    """
+    Return the examples closest to an embedding (CPU-bound: the async functions run it in a worker thread).
+
+    Parameters:
+    -----------
+    input_embedding: list
+        Embedding of the user's text.
+    path_emb: Path
+        The path to the .db file with the examples and their embeddings.
+        The examples are loaded once into a resident index (see `get_example_index`).
+    num_examples: int
+        Number examples to select.
+    backend: RetrievalBackend
+        Backend of the similarity search (exact or IVF).
+    nprobe: int | None
+        Number of IVF clusters to scan (IVF backend only).
+
+    Returns:
+    -----------
+    list[dict]
+        A list with dictioraries wiht dysfuntional and functional examples.
+    """
+
+    # Get the examples (loaded from the database only the first time)
+    examples = get_example_index(path_emb)
+
+    # Find the semantically closest example to the input text
+    selected_examples, _ = find_closest(input_embedding, examples, num_examples, backend, nprobe)
+
+    return selected_examples
+
+
+def retrieve_examples_batch(input_embeddings: list, path_emb: Path, num_examples: int=5,
+                            backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None) -> list[list[dict]]:
+    """
+    Return the examples closest to each of several embeddings, with one matrix-matrix product
+    (see `ExampleIndex.search_batch`).
+
+    Returns:
+    -----------
+    list[list[dict]]
+        For each embedding, a list with dictioraries wiht dysfuntional and functional examples.
+    """
+
+    examples = get_example_index(path_emb)
+    with stage("search"):
+        indices, _ = examples.search_batch(np.asarray(input_embeddings, dtype=np.float32), num_examples, backend, nprobe)
+
+    return [examples.get_examples(row) for row in indices]
+
+
+def select_examples(text: str, path_emb: Path , emb_model: OpenAIModels, client: OpenAI, num_examples: int=5,
+                    backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                    embedding_cache: EmbeddingCache | None=None, embedder: EmbeddingBackend | None=None) -> tuple[list, list]:
     """
     Select the most relevant few-shot examples based on cosine similarity.
 
@@ -125,12 +308,22 @@ def select_examples(text: str, path_emb: Path , emb_model: OpenAIModels, client:
         The text to use to generated the vector embedding.
     path_emb: Path
         The path to the .db file with the examples and their embeddings.
+        The examples are loaded once into a resident index (see `get_example_index`).
     emb_model: OpenAIModels
         Name of the model for the embeddings.
     client: OpenAI
         A client for the OpenAI API.
     num_examples: int
         Number examples to select.
+    backend: RetrievalBackend
+        Backend of the similarity search (exact or IVF).
+    nprobe: int | None
+        Number of IVF clusters to scan (IVF backend only).
+    embedding_cache: EmbeddingCache | None
+        Cache of the embeddings of the user's texts (None: always call the API).
+    embedder: EmbeddingBackend | None
+        Embedding provider used instead of the OpenAI API (e.g. LocalEmbeddingBackend).
+        The examples of path_emb must be embedded with the same provider.
 
     Returns:
     -----------
@@ -142,21 +335,102 @@ def select_examples(text: str, path_emb: Path , emb_model: OpenAIModels, client:
     """
 
     # Embed the user text
-    input_embedding = get_embedding(
+    if embedder is not None:
+        with stage("embedding"):
+            input_embedding = embedder.embed([text])[0]
+    else:
+        input_embedding = get_embedding(
+            text=text,
+            model=emb_model,
+            client=client,
+            cache=embedding_cache)
+
+    return retrieve_examples(input_embedding, path_emb, num_examples, backend, nprobe)
+
+
+async def aselect_examples(text: str, path_emb: Path , emb_model: OpenAIModels, client: AsyncOpenAI, num_examples: int=5,
+                           backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                           embedding_cache: EmbeddingCache | None=None, embedder: EmbeddingBackend | None=None) -> list[dict]:
+    """
+    Async version of `select_examples`, for an AsyncOpenAI client.
+    The similarity search runs in a worker thread, so it does not block the event loop.
+    """
+
+    input_embedding = await _aembed_text(text, emb_model, client, embedding_cache, embedder)
+
+    return await asyncio.to_thread(retrieve_examples, input_embedding, path_emb, num_examples, backend, nprobe)
+
+
+async def aselect_examples_scored(text: str, path_emb: Path , emb_model: OpenAIModels, client: AsyncOpenAI, num_examples: int=5,
+                                  backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                                  embedding_cache: EmbeddingCache | None=None,
+                                  embedder: EmbeddingBackend | None=None) -> tuple[list[dict], list, np.ndarray]:
+    """
+    Same as `aselect_examples`, but also return the similarities of the selected examples and the
+    embedding of the text (e.g. for the semantic cache).
+
+    Returns:
+    -----------
+    tuple
+        selected_examples: list[dict]
+            A list with dictioraries wiht dysfuntional and functional examples.
+        selected_similarities: list[np.float64]
+            The cosine similarities of the selected examples (see `find_closest`).
+        input_embedding: np.ndarray
+            The embedding of the text.
+    """
+
+    input_embedding = await _aembed_text(text, emb_model, client, embedding_cache, embedder)
+
+    def search():
+        return find_closest(input_embedding, get_example_index(path_emb), num_examples, backend, nprobe)
+
+    selected_examples, selected_similarities = await asyncio.to_thread(search)
+    return selected_examples, selected_similarities, np.asarray(input_embedding, dtype=np.float32)
+
+
+async def _aembed_text(text: str, emb_model: OpenAIModels, client: AsyncOpenAI, embedding_cache: EmbeddingCache | None,
+                       embedder: EmbeddingBackend | None) -> list:
+    # The embedding of the user's text, with the embedding provider or the OpenAI API
+    if embedder is not None:
+        with stage("embedding"):
+            return (await embedder.aembed([text]))[0]
+    return await aget_embedding(
         text=text,
         model=emb_model,
-        client=client)
-    
-    # Load the examples
-    examples = load_examples(path_emb)
+        client=client,
+        cache=embedding_cache)
 
-    # Find the semantically closest example to the input text
-    selected_examples, _ = find_closest(input_embedding, examples, num_examples)
-   
-    return selected_examples
 
+async def aselect_examples_batch(texts: list[str], path_emb: Path , emb_model: OpenAIModels, client: AsyncOpenAI, num_examples: int=5,
+                                 backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                                 embedding_cache: EmbeddingCache | None=None, embedder: EmbeddingBackend | None=None) -> list[list[dict]]:
+    """
+    Select the few-shot examples of several texts: one embedding API call for all the texts,
+    and one batched similarity search (in a worker thread).
+
+    Returns:
+    -----------
+    list[list[dict]]
+        For each text, a list with dictioraries wiht dysfuntional and functional examples.
+    """
+
+    if embedder is not None:
+        with stage("embedding"):
+            input_embeddings = await embedder.aembed(texts)
+    else:
+        input_embeddings = await aget_embeddings(
+            texts=texts,
+            model=emb_model,
+            client=client,
+            cache=embedding_cache)
+
+    return await asyncio.to_thread(retrieve_examples_batch, input_embeddings, path_emb, num_examples, backend, nprobe)
 
-def create_dynamic_prompt(user_text: str, path_emb: Path , emb_model: OpenAIModels, client: OpenAI, num_examples: int=5) -> str:
+
+def create_dynamic_prompt(user_text: str, path_emb: Path , emb_model: OpenAIModels, client: OpenAI, num_examples: int=5,
+                          backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                          embedding_cache: EmbeddingCache | None=None) -> str:
     """
     Return a prompt based on the user's text and the selected  examples to enter in the prompt as few-shots.
     
@@ -172,6 +446,12 @@ def create_dynamic_prompt(user_text: str, path_emb: Path , emb_model: OpenAIMode
         A client for the OpenAI API.
     num_examples: int
         number examples to select.
+    backend: RetrievalBackend
+        Backend of the similarity search (exact or IVF).
+    nprobe: int | None
+        Number of IVF clusters to scan (IVF backend only).
+    embedding_cache: EmbeddingCache | None
+        Cache of the embeddings of the user's texts (None: always call the API).
         
     Returns:
     -----------
@@ -196,7 +476,52 @@ def create_dynamic_prompt(user_text: str, path_emb: Path , emb_model: OpenAIMode
         path_emb=path_emb,
         emb_model=emb_model,
         client=client,
-        num_examples=num_examples)
+        num_examples=num_examples,
+        backend=backend,
+        nprobe=nprobe,
+        embedding_cache=embedding_cache)
+
+    with stage("prompt"):
+        return build_prompt(user_text, selected_examples)
+
+
+async def acreate_dynamic_prompt(user_text: str, path_emb: Path , emb_model: OpenAIModels, client: AsyncOpenAI, num_examples: int=5,
+                                 backend: RetrievalBackend=RetrievalBackend.EXACT, nprobe: int | None=None,
+                                 embedding_cache: EmbeddingCache | None=None) -> str:
+    """
+    Async version of `create_dynamic_prompt`, for an AsyncOpenAI client.
+    """
+
+    selected_examples = await aselect_examples(
+        text=user_text,
+        path_emb=path_emb,
+        emb_model=emb_model,
+        client=client,
+        num_examples=num_examples,
+        backend=backend,
+        nprobe=nprobe,
+        embedding_cache=embedding_cache)
+
+    with stage("prompt"):
+        return build_prompt(user_text, selected_examples)
+
+
+def build_prompt(user_text: str, selected_examples: list[dict]) -> str:
+    """
+    Return the few-shots prompt for the user's text and the selected examples.
+
+    Parameters:
+    -----------
+    user_text: str
+        The user's text.
+    selected_examples: list[dict]
+        A list with dictioraries wiht dysfuntional and functional examples.
+
+    Returns:
+    -----------
+    str
+        A string for the dynamic few-shots prompting.
+    """
 
     prompt_1 = """
     Below is an instruction that describes a task.
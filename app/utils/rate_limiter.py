@@ -1,23 +1,380 @@
+import asyncio
+import email.utils
+import functools
+import inspect
 import random
+import threading
 import time
 from typing import Callable, Any
-from openai import RateLimitError
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from app.utils.metrics import RETRIES, stage
+
+
+# Errors worth retrying: rate limits, timeouts, connection errors and server errors (5xx)
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+# Status codes worth retrying when the error is a generic APIStatusError
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RetryError(Exception):
+    """
+    Raised when a call still fails after the allowed retries, or when its deadline is exceeded.
+    The last error of the call is chained as the cause.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the upstream when the circuit breaker is open.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Return True if the error is transient (rate limit, timeout, connection error, or 5xx status).
+    """
+
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """
+    Return the delay in seconds requested by the server (retry-after-ms or Retry-After header), if any.
+    """
+
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        # An HTTP date
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        if retry_date is None:
+            return None
+        return max(0.0, retry_date.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """
+    Fail fast when the upstream is down.
+
+    After `failure_threshold` consecutive transient failures the circuit opens: calls are rejected
+    with CircuitOpenError for `recovery_timeout` seconds. Then a single trial call is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+
+    def allow(self) -> bool:
+        """
+        Raise CircuitOpenError if a call is not allowed now.
+        Return True if the call is the trial call of the half-open circuit.
+        """
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            raise CircuitOpenError("The upstream API is unavailable (circuit breaker open).", max(remaining, 0.0))
+
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+
+    def release_trial(self):
+        # The trial call ended without an outcome (e.g. it was cancelled): let the next call be the trial
+        with self._lock:
+            self._trial_in_flight = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "rejected": self.rejected}
+
+
+class RetryBudget:
+    """
+    Process-wide limit on retries, so that retries cannot multiply the load on a struggling upstream.
+
+    Every first attempt deposits `ratio` tokens (up to `max_tokens`); every retry withdraws one token.
+    When the budget is empty, failures are raised without retrying.
+    """
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 20.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+    def stats(self) -> dict:
+        return {"tokens": round(self.tokens, 2), "exhausted": self.exhausted}
+
+
+# Shared by every call to the OpenAI API in this process
+openai_circuit_breaker = CircuitBreaker()
+openai_retry_budget = RetryBudget()
+
+
+class Retrying:
+    """
+    Retry engine for sync and async callables, with exponential backoff, the server's Retry-After,
+    a per-call deadline, a global retry budget and a circuit breaker.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = 1,
+        exponential_base: float = 2,
+        jitter: bool = True,
+        max_retries: int = 3,
+        max_delay: float = 20,
+        deadline: float | None = 60,
+        errors: tuple = (),
+        budget: RetryBudget | None = None,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self.initial_delay = initial_delay
+        self.exponential_base = exponential_base
+        self.jitter = jitter
+        self.max_retries = max_retries
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.errors = errors
+        self.budget = budget
+        self.breaker = breaker
+        self.retries = 0  # total retries performed, for monitoring
+
+
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, self.errors) or is_retryable(error)
+
+
+    def next_delay(self, error: Exception, num_retries: int, started: float) -> float | None:
+        """
+        Return how long to wait before the next attempt, or None to give up.
+        Records the failure in the circuit breaker; errors that are not retryable are raised.
+        """
+
+        if not self.is_retryable(error):
+            # Not an upstream failure (e.g. an invalid request): the upstream is up
+            self.after_success()
+            raise error
+
+        # A rate limit means the upstream is up, but busy: it does not count towards opening the circuit
+        if self.breaker is not None and getattr(error, "status_code", None) != 429:
+            self.breaker.record_failure()
+
+        if num_retries > self.max_retries:
+            return None
+
+        # Delay: what the server asked for, otherwise exponential backoff with jitter
+        delay = get_retry_after(error)
+        if delay is None:
+            delay = self.initial_delay * self.exponential_base ** (num_retries - 1)
+            delay *= 1 + self.jitter * random.random()
+        delay = min(delay, self.max_delay)
+
+        # Give up now rather than sleep past the deadline
+        if self.deadline is not None and time.monotonic() + delay - started > self.deadline:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            return None
+
+        self.retries += 1
+        return delay
+
+
+    def before_call(self) -> bool:
+        if self.breaker is not None:
+            return self.breaker.allow()
+        return False
+
+
+    def abandon_call(self, is_trial: bool):
+        if is_trial:
+            self.breaker.release_trial()
+
+
+    def after_success(self):
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+
+    def give_up(self, error: Exception, num_retries: int):
+        raise RetryError(
+            f"Request failed after {num_retries - 1} retries: {error}"
+        ) from error
+
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        started = time.monotonic()
+        num_retries = 0
+        if self.budget is not None:
+            self.budget.deposit()
+
+        is_trial = False
+        try:
+            while True:
+                is_trial = self.before_call()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    # The attempt has an answer (a 429 too): it no longer holds the trial slot of the breaker,
+                    # which the failure, if any, reopens below
+                    self.abandon_call(is_trial)
+                    is_trial = False
+                    num_retries += 1
+                    delay = self.next_delay(e, num_retries, started)
+                    if delay is None:
+                        self.give_up(e, num_retries)
+                    RETRIES.inc(operation=getattr(func, "__name__", "call"))
+                    with stage("retry_backoff"):
+                        time.sleep(delay)
+                else:
+                    is_trial = False
+                    self.after_success()
+                    return result
+        finally:
+            # Interrupted without an answer (e.g. cancelled): the call must not keep the trial slot
+            self.abandon_call(is_trial)
+
+
+    async def acall(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        started = time.monotonic()
+        num_retries = 0
+        if self.budget is not None:
+            self.budget.deposit()
+
+        is_trial = False
+        try:
+            while True:
+                is_trial = self.before_call()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    # The attempt has an answer (a 429 too): it no longer holds the trial slot of the breaker,
+                    # which the failure, if any, reopens below
+                    self.abandon_call(is_trial)
+                    is_trial = False
+                    num_retries += 1
+                    delay = self.next_delay(e, num_retries, started)
+                    if delay is None:
+                        self.give_up(e, num_retries)
+                    RETRIES.inc(operation=getattr(func, "__name__", "call"))
+                    # Let the event loop serve other requests while waiting
+                    with stage("retry_backoff"):
+                        await asyncio.sleep(delay)
+                else:
+                    is_trial = False
+                    self.after_success()
+                    return result
+        finally:
+            # Interrupted without an answer (e.g. cancelled): the call must not keep the trial slot
+            self.abandon_call(is_trial)
 
 
 # Define a retry decorator with exponential backoff
 def retry_with_exponential_backoff(
-    func: Callable[[Any], Any],  # The function to be decorated
+    func: Callable[[Any], Any] | None = None,  # The function to be decorated
     initial_delay: float = 1,  # Initial delay before the first retry
     exponential_base: float = 2, # Base for the exponential backoff
     jitter: bool = True,  # Whether to add randomness to the delay
-    max_retries: int = 10,  # Maximum number of retries
-    errors: tuple = (RateLimitError,),  # Errors to retry on
+    max_retries: int = 3,  # Maximum number of retries
+    errors: tuple = (RateLimitError,),  # Errors to retry on (in addition to the transient API errors)
+    max_delay: float = 20,  # Maximum delay between two attempts
+    deadline: float | None = 60,  # Maximum time spent on a call, retries included
+    budget: RetryBudget | None = openai_retry_budget,  # Global retry budget
+    breaker: CircuitBreaker | None = openai_circuit_breaker,  # Circuit breaker of the upstream
 ) -> Callable[[Any], Any]:
     """
-    This function is from OpenAI Cookbook.
+    Adapted from the OpenAI Cookbook.
 
     This decorator retries a function with exponential backoff when specified errors occur.
     The retries are performed with an exponential backoff delay (optionally: with randomized jitter).
+    Coroutine functions are supported: their retries wait with `asyncio.sleep`, so the event loop is not blocked.
+
+    Besides the specified errors, the transient API errors are retried: rate limits, timeouts,
+    connection errors and 5xx statuses. When the server sends a Retry-After header, its delay is used.
+    A call gives up when its deadline would be exceeded or the global retry budget is empty,
+    and fails fast with CircuitOpenError while the circuit breaker is open.
+
+    The decorator can be used bare (`@retry_with_exponential_backoff`) or with parameters
+    (`@retry_with_exponential_backoff(max_retries=5)`).
 
     Callable[[Any], Any]:
         Callable: This indicates that the type is a function.
@@ -35,9 +392,17 @@ def retry_with_exponential_backoff(
     jitter : bool, optional
         Whether to add randomness to the delay (default is True).
     max_retries : int, optional
-        The maximum number of retries before giving up (default is 10).
+        The maximum number of retries before giving up (default is 3).
     errors : tuple, optional
         A tuple of exception classes to retry on (default is (openai.RateLimitError,)).
+    max_delay : float, optional
+        The maximum delay between two attempts in seconds (default is 20 seconds).
+    deadline : float | None, optional
+        The maximum time spent on a call in seconds, retries included (default is 60 seconds).
+    budget : RetryBudget | None, optional
+        The global retry budget (default is the one shared by the OpenAI calls).
+    breaker : CircuitBreaker | None, optional
+        The circuit breaker (default is the one shared by the OpenAI calls).
 
     Returns:
     --------
@@ -46,43 +411,39 @@ def retry_with_exponential_backoff(
 
     Raises:
     -------
-    Exception
-        If the maximum number of retries is exceeded, an exception is raised.
-    """
-
-    def wrapper(*args, **kwargs):
-        
-        num_retries = 0  # Counter for the number of retries
-        delay = initial_delay  # Initial delay before retrying
-
-        # Loop until one of these occurs:
-        # - a successful response
-        # - max_retries is hit
-        # - an exception is raised
-        while True:
-            try:
-                # Try to execute the function
-                return func(*args, **kwargs)
-
-            # Retry on specified errors
-            except errors as e:
-                num_retries += 1
-
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    # Raise an exception if the maximum number of retries is exceeded
-                    raise Exception(
-                        f"Maximum number of retries ({max_retries}) exceeded."
-                    )
-
-                # Increment the delay using exponential backoff and jitter
-                delay *= exponential_base * (1 + jitter * random.random())
-
-                # Sleep for the current delay duration before the next retry
-                time.sleep(delay)
-
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e 
-
-    return wrapper
+    RetryError
+        If the call still fails after the retries, or its deadline is exceeded.
+    CircuitOpenError
+        If the circuit breaker is open.
+    """
+
+    retrying = Retrying(
+        initial_delay=initial_delay,
+        exponential_base=exponential_base,
+        jitter=jitter,
+        max_retries=max_retries,
+        max_delay=max_delay,
+        deadline=deadline,
+        errors=errors,
+        budget=budget,
+        breaker=breaker,
+    )
+
+    def decorate(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return retrying.call(func, *args, **kwargs)
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return await retrying.acall(func, *args, **kwargs)
+
+        wrapper = async_wrapper if inspect.iscoroutinefunction(func) else wrapper
+        wrapper.retrying = retrying
+        return wrapper
+
+    if func is None:
+        return decorate
+
+    return decorate(func)
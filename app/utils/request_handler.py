@@ -1,8 +1,16 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 
+from app.utils.metrics import record_tokens, stage
 from app.utils.openai_config import OpenAIModels
 from app.utils.rate_limiter import retry_with_exponential_backoff
+from app.utils.response_cache import ResponseCache
+from app.utils.token_bucket import rate_limiters
+from app.utils.tokens import count_tokens, count_message_tokens
+
+
+# Completion tokens reserved in the tokens-per-minute bucket before a request (corrected with the actual usage)
+EXPECTED_COMPLETION_TOKENS = 256
 
 
 def count_token_usage(api_response: ChatCompletion) -> tuple:
@@ -35,6 +43,7 @@ def count_token_usage(api_response: ChatCompletion) -> tuple:
 def send_request(client: OpenAI, model: OpenAIModels, system_prompt: str, prompt: str, temperature: float) -> tuple[str, tuple]:
     """
     Call the API and get the response.
+    If a rate limiter is configured for the model (see `token_bucket.rate_limiters`), wait for it first.
 
     Parameters:
     -----------
@@ -58,23 +67,164 @@ def send_request(client: OpenAI, model: OpenAIModels, system_prompt: str, prompt
             The number of tokens used.
     """
 
-    chat_completion = client.chat.completions.create(
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+    # Wait for the client-side rate limiter of the model (if configured), instead of getting a 429
+    rate_limiter = rate_limiters.get(model)
+    estimated_tokens = count_message_tokens(messages, model) + EXPECTED_COMPLETION_TOKENS
+    if rate_limiter is not None:
+        with stage("rate_limit_wait"):
+            rate_limiter.acquire_sync(estimated_tokens)
+
+    actual_tokens = 0
+    try:
+        with stage("llm"):
+            chat_completion = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature
+            )
+
+        response = chat_completion.choices[0].message.content
+
+        token_usage = count_token_usage(chat_completion)
+        actual_tokens = token_usage[2]
+        record_tokens(model, token_usage[1], token_usage[0])
+    finally:
+        if rate_limiter is not None:
+            rate_limiter.reconcile(estimated_tokens, actual_tokens)
+
+    return response, token_usage
+
+
+@retry_with_exponential_backoff
+async def asend_request(client: AsyncOpenAI, model: OpenAIModels, system_prompt: str, prompt: str, temperature: float) -> tuple[str, tuple]:
+    """
+    Async version of `send_request`, for an AsyncOpenAI client.
+    """
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+    rate_limiter = rate_limiters.get(model)
+    estimated_tokens = count_message_tokens(messages, model) + EXPECTED_COMPLETION_TOKENS
+    if rate_limiter is not None:
+        with stage("rate_limit_wait"):
+            await rate_limiter.acquire(estimated_tokens)
+
+    actual_tokens = 0
+    try:
+        with stage("llm"):
+            chat_completion = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature
+            )
+
+        response = chat_completion.choices[0].message.content
+
+        token_usage = count_token_usage(chat_completion)
+        actual_tokens = token_usage[2]
+        record_tokens(model, token_usage[1], token_usage[0])
+    finally:
+        if rate_limiter is not None:
+            await rate_limiter.areconcile(estimated_tokens, actual_tokens)
+
+    return response, token_usage
+
+
+@retry_with_exponential_backoff
+async def _aopen_stream(client: AsyncOpenAI, model: OpenAIModels, messages: list[dict], temperature: float):
+    # Only opening the stream is retried: once tokens were forwarded, a retry would repeat them
+    return await client.chat.completions.create(
         model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=temperature
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        # Ask for the token usage in the last chunk
+        extra_body={"stream_options": {"include_usage": True}}
     )
 
-    response = chat_completion.choices[0].message.content
 
-    token_usage = count_token_usage(chat_completion)
+def _usage_of_chunk(chunk) -> tuple | None:
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return (usage["completion_tokens"], usage["prompt_tokens"], usage["total_tokens"])
+    return (usage.completion_tokens, usage.prompt_tokens, usage.total_tokens)
 
-    return response, token_usage
 
+async def astream_request(client: AsyncOpenAI, model: OpenAIModels, system_prompt: str, prompt: str, temperature: float):
+    """
+    Call the API with streaming, and yield the response as it is generated.
+
+    Parameters:
+    -----------
+    client: AsyncOpenAI
+        Object that manage the call to OpenAI API.
+    model: OpenAIModels
+        Name of the OpenAI model.
+    system_prompt: str
+        A prompt used to inform the model how to modify the user text.
+    prompt: str
+        Prompt including the instructions and the original text provided by the user.
+    temperature: float
+        Temperature for the OpenAI model.
+
+    Yields:
+    -----------
+    str | tuple
+        The text deltas (str), then, once the stream is finished, the token usage
+        (completion_tokens, prompt_tokens, total_tokens). If the API does not report
+        the usage, it is estimated.
+    """
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+    rate_limiter = rate_limiters.get(model)
+    prompt_tokens = count_message_tokens(messages, model)
+    estimated_tokens = prompt_tokens + EXPECTED_COMPLETION_TOKENS
+    if rate_limiter is not None:
+        with stage("rate_limit_wait"):
+            await rate_limiter.acquire(estimated_tokens)
+
+    token_usage = None
+    deltas = []
+    try:
+        # Time until the API starts streaming
+        with stage("llm_open_stream"):
+            stream = await _aopen_stream(client, model, messages, temperature)
+        try:
+            async for chunk in stream:
+                token_usage = _usage_of_chunk(chunk) or token_usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    deltas.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+        if token_usage is None:
+            completion_tokens = count_tokens("".join(deltas), model)
+            token_usage = (completion_tokens, prompt_tokens, completion_tokens + prompt_tokens)
+        record_tokens(model, token_usage[1], token_usage[0])
+    finally:
+        if rate_limiter is not None:
+            await rate_limiter.areconcile(estimated_tokens, token_usage[2] if token_usage is not None else prompt_tokens)
 
-def handle_request(prompt: str, client: OpenAI, model: OpenAIModels, temperature: float) -> tuple[str, str]:
+    yield token_usage
+
+
+def handle_request(prompt: str, client: OpenAI, model: OpenAIModels, temperature: float,
+                   response_cache: ResponseCache | None = None, return_from_cache: bool = False) -> tuple:
     """
     This function perform the following steps:
     1) Call a function to create a prompt to split and classify the text.
@@ -92,6 +242,11 @@ def handle_request(prompt: str, client: OpenAI, model: OpenAIModels, temperature
         Name of the OpenAI model.
     temperature: float
         Temperature for the OpenAI model.
+    response_cache: ResponseCache | None
+        Cache of the responses. For a deterministic request (temperature 0) already sent,
+        the cached response is returned without calling the API.
+    return_from_cache: bool
+        Whether to also return `from_cache`.
 
     Returns:
     -----------
@@ -99,18 +254,116 @@ def handle_request(prompt: str, client: OpenAI, model: OpenAIModels, temperature
         A tuple with the following objects:
         edited_text: str
             Text converted in a more functional version.
-        total_token: str
-            Total count of used tokens.
+        total_token: int
+            Total count of used tokens (0 if the response comes from the cache).
+        from_cache: bool
+            Whether the response comes from the cache (only with `return_from_cache`).
     """
 
+    system_prompt = ""
+
+    if response_cache is not None:
+        cached = response_cache.get_response(model, temperature, system_prompt, prompt)
+        if cached is not None:
+            transformed_text, _ = cached
+            return (transformed_text, 0, True) if return_from_cache else (transformed_text, 0)
+
     transformed_text, token_usage = send_request(
         client= client,
         model=model,
-        system_prompt="",
+        system_prompt=system_prompt,
+        prompt=prompt,
+        temperature=temperature)
+
+    if response_cache is not None:
+        response_cache.set_response(model, temperature, system_prompt, prompt, transformed_text, token_usage)
+
+    # Get total token usage
+    _, _, total_token = token_usage
+
+    return (transformed_text, total_token, False) if return_from_cache else (transformed_text, total_token)
+
+
+async def ahandle_request(prompt: str, client: AsyncOpenAI, model: OpenAIModels, temperature: float,
+                          response_cache: ResponseCache | None = None) -> tuple[str, int, bool]:
+    """
+    Async version of `handle_request`, for an AsyncOpenAI client.
+    """
+
+    system_prompt = ""
+
+    if response_cache is not None:
+        cached = await response_cache.aget_response(model, temperature, system_prompt, prompt)
+        if cached is not None:
+            transformed_text, _ = cached
+            return transformed_text, 0, True
+
+    transformed_text, token_usage = await asend_request(
+        client=client,
+        model=model,
+        system_prompt=system_prompt,
         prompt=prompt,
         temperature=temperature)
-    
+
+    if response_cache is not None:
+        await response_cache.aset_response(model, temperature, system_prompt, prompt, transformed_text, token_usage)
+
     # Get total token usage
     _, _, total_token = token_usage
 
-    return transformed_text, total_token
+    return transformed_text, total_token, False
+
+
+async def ahandle_request_stream(prompt: str, client: AsyncOpenAI, model: OpenAIModels, temperature: float,
+                                 response_cache: ResponseCache | None = None):
+    """
+    Streaming version of `ahandle_request`: yield the transformed text as it is generated.
+
+    Parameters:
+    -----------
+    prompt: str
+        Prompt to pass to the OpenAI model.
+    client: AsyncOpenAI
+        Object that manage the call to OpenAI API.
+    model: OpenAIModels
+        Name of the OpenAI model.
+    temperature: float
+        Temperature for the OpenAI model.
+    response_cache: ResponseCache | None
+        Cache of the responses. A cached response is yielded as a single delta.
+
+    Yields:
+    -----------
+    str | tuple
+        The text deltas (str), then a tuple with the following objects:
+        edited_text: str
+            Text converted in a more functional version.
+        token_usage: tuple
+            (completion_tokens, prompt_tokens, total_tokens); all 0 if the response comes from the cache.
+        from_cache: bool
+            Whether the response comes from the cache.
+    """
+
+    system_prompt = ""
+
+    if response_cache is not None:
+        cached = await response_cache.aget_response(model, temperature, system_prompt, prompt)
+        if cached is not None:
+            transformed_text, _ = cached
+            yield transformed_text
+            yield transformed_text, (0, 0, 0), True
+            return
+
+    deltas = []
+    async for item in astream_request(client, model, system_prompt, prompt, temperature):
+        if isinstance(item, str):
+            deltas.append(item)
+            yield item
+        else:
+            token_usage = item
+    transformed_text = "".join(deltas)
+
+    if response_cache is not None:
+        await response_cache.aset_response(model, temperature, system_prompt, prompt, transformed_text, token_usage)
+
+    yield transformed_text, token_usage, False
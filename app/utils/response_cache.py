@@ -0,0 +1,101 @@
+import hashlib
+import json
+from pathlib import Path
+
+from app.utils.cache import LRUCache, SQLiteCache, TieredCache
+
+
+def response_cache_key(model: str, temperature: float, system_prompt: str, prompt: str) -> str:
+    """
+    Return the cache key of a chat completion: the model, the temperature and the hash of the prompts.
+    """
+
+    digest = hashlib.sha256(f"{system_prompt}\x00{prompt}".encode("utf-8")).hexdigest()
+    return f"{getattr(model, 'value', model)}:{float(temperature)}:{digest}"
+
+
+def response_size(value: tuple) -> int:
+    response, _ = value
+    return len(response.encode("utf-8"))
+
+
+def encode_response(value: tuple) -> bytes:
+    response, token_usage = value
+    return json.dumps([response, list(token_usage)]).encode("utf-8")
+
+
+def decode_response(data: bytes) -> tuple:
+    response, token_usage = json.loads(data)
+    return response, tuple(token_usage)
+
+
+class ResponseCache(TieredCache):
+    """
+    Cache of the chat completions, keyed by (model, temperature, prompt hash).
+
+    Only deterministic requests (temperature 0) are cached: with a higher temperature the same
+    prompt is expected to give different answers, so the cache is bypassed.
+    The in-process tier is an LRU cache limited in entries, bytes and TTL; the optional
+    persistent tier is a SQLite file that survives restarts.
+    """
+
+    def __init__(self, max_size: int = 1_000, ttl: float | None = None, max_bytes: int | None = None,
+                 path: Path | None = None, max_temperature: float = 0.0):
+        """
+        Parameters:
+        -----------
+        max_size: int
+            Maximum number of responses in the in-process tier.
+        ttl: float | None
+            Seconds after which a response expires, in both tiers (None: never).
+        max_bytes: int | None
+            Maximum total size of the responses in the in-process tier (None: no limit).
+        path: Path | None
+            The .db file of the persistent tier (None: in-process only).
+        max_temperature: float
+            Requests with a higher temperature bypass the cache.
+        """
+
+        super().__init__(
+            memory=LRUCache(max_size=max_size, ttl=ttl, max_bytes=max_bytes, size_of=response_size),
+            store=SQLiteCache(path, table="responses", ttl=ttl) if path is not None else None,
+            encode=encode_response,
+            decode=decode_response)
+        self.max_temperature = max_temperature
+        self.bypassed = 0
+
+
+    def is_cacheable(self, temperature: float) -> bool:
+        return temperature <= self.max_temperature
+
+
+    def get_response(self, model: str, temperature: float, system_prompt: str, prompt: str) -> tuple | None:
+        """
+        Return the cached (response, token_usage) of a request, or None.
+        """
+
+        if not self.is_cacheable(temperature):
+            self.bypassed += 1
+            return None
+        return self.get(response_cache_key(model, temperature, system_prompt, prompt))
+
+
+    def set_response(self, model: str, temperature: float, system_prompt: str, prompt: str, response: str, token_usage: tuple):
+        if self.is_cacheable(temperature):
+            self.set(response_cache_key(model, temperature, system_prompt, prompt), (response, tuple(token_usage)))
+
+
+    async def aget_response(self, model: str, temperature: float, system_prompt: str, prompt: str) -> tuple | None:
+        if not self.is_cacheable(temperature):
+            self.bypassed += 1
+            return None
+        return await self.aget(response_cache_key(model, temperature, system_prompt, prompt))
+
+
+    async def aset_response(self, model: str, temperature: float, system_prompt: str, prompt: str, response: str, token_usage: tuple):
+        if self.is_cacheable(temperature):
+            await self.aset(response_cache_key(model, temperature, system_prompt, prompt), (response, tuple(token_usage)))
+
+
+    def stats(self) -> dict:
+        return {**super().stats(), "bypassed": self.bypassed}
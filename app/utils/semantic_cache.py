@@ -0,0 +1,204 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from app.utils.embedding_cache import normalize_text
+
+
+class SemanticHit:
+    """
+    A transformation reused from the semantic cache.
+    """
+
+    def __init__(self, transformed_text: str, similarity: float, source: str, original_text: str):
+        self.transformed_text = transformed_text
+        self.similarity = similarity  # cosine similarity between the user's text and `original_text`
+        self.source = source  # "history" (a text already transformed) or "corpus" (an example of the database)
+        self.original_text = original_text
+
+
+class SemanticCache:
+    """
+    Cache of the transformations, looked up by the embedding of the user's text rather than by its exact value,
+    so near-paraphrases of a text already transformed reuse its transformation without an LLM call.
+
+    The transformations of the past texts are kept in a matrix of normalized embeddings, one row per
+    text, searched with a matrix-vector product. The dysfunctional examples of the embedding database are
+    searched by the example selection anyway: `lookup` also takes the closest example, whose functional
+    text is reused the same way. The closest text wins if its similarity reaches `threshold`.
+
+    Entries are evicted least recently used first beyond `max_size`, and are no longer matched `ttl` seconds
+    after they were stored. Like the response cache, only deterministic requests (temperature 0) use the cache.
+    """
+
+    def __init__(self, threshold: float = 0.97, max_size: int = 10_000, ttl: float | None = None, max_temperature: float = 0.0):
+        """
+        Parameters:
+        -----------
+        threshold: float
+            Minimum cosine similarity between the user's text and a known text to reuse its transformation.
+        max_size: int
+            Maximum number of past transformations (the matrix takes max_size x dim float32 values).
+        ttl: float | None
+            Seconds after which a transformation expires (None: never).
+        max_temperature: float
+            Requests with a higher temperature bypass the cache.
+        """
+
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self._matrix: np.ndarray | None = None  # rows of the slots, allocated on the first `add`
+        self._expires = np.zeros(0, dtype=np.float64)
+        self._entries: list[tuple[str, str]] = []  # (original_text, transformed_text) of each slot
+        self._slots: OrderedDict = OrderedDict()  # normalized original text -> slot, least recently used first
+        self._lock = threading.Lock()
+        self.hits_history = 0
+        self.hits_corpus = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+
+    def is_cacheable(self, temperature: float) -> bool:
+        return temperature <= self.max_temperature
+
+
+    def _grow(self, dim: int):
+        # Double the capacity of the slots, up to max_size
+        size = len(self._entries)
+        capacity = min(self.max_size, max(64, 2 * size))
+        matrix = np.zeros((capacity, dim), dtype=np.float32)
+        if self._matrix is not None:
+            matrix[:size] = self._matrix[:size]
+        self._matrix = matrix
+        self._expires = np.concatenate([self._expires[:size], np.zeros(capacity - size)])
+
+
+    def lookup(self, embedding, temperature: float = 0.0, corpus_match: tuple[float, str, str] | None = None) -> SemanticHit | None:
+        """
+        Return the transformation of the known text closest to the user's text, if it is similar enough.
+
+        Parameters:
+        -----------
+        embedding: list | np.ndarray
+            Embedding of the user's text.
+        temperature: float
+            Temperature of the request.
+        corpus_match: tuple[float, str, str] | None
+            The example of the database closest to the user's text, as (similarity, dysfunctional, functional).
+
+        Returns:
+        -----------
+        SemanticHit | None
+            The reused transformation, or None if no known text reaches the threshold.
+        """
+
+        if not self.is_cacheable(temperature):
+            self.bypassed += 1
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        hit = None
+        if corpus_match is not None and corpus_match[0] >= self.threshold:
+            similarity, dysfunctional, functional = corpus_match
+            hit = SemanticHit(functional, float(similarity), "corpus", dysfunctional)
+
+        with self._lock:
+            size = len(self._entries)
+            if self._matrix is not None and size and self._matrix.shape[1] == query.shape[0]:
+                scores = self._matrix[:size] @ query
+                # Expired slots never match
+                scores[self._expires[:size] <= time.monotonic()] = -np.inf
+                slot = int(scores.argmax())
+                if scores[slot] >= self.threshold and (hit is None or scores[slot] > hit.similarity):
+                    original_text, transformed_text = self._entries[slot]
+                    hit = SemanticHit(transformed_text, float(scores[slot]), "history", original_text)
+                    self._slots.move_to_end(normalize_text(original_text))
+
+            if hit is None:
+                self.misses += 1
+            elif hit.source == "history":
+                self.hits_history += 1
+            else:
+                self.hits_corpus += 1
+        return hit
+
+
+    def add(self, embedding, original_text: str, transformed_text: str, temperature: float = 0.0):
+        """
+        Store the transformation of a text, evicting the least recently used one if the cache is full.
+        """
+
+        if not self.is_cacheable(temperature) or self.max_size <= 0:
+            return
+
+        row = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(row)
+        if norm > 0:
+            row = row / norm
+        key = normalize_text(original_text)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else np.inf
+
+        with self._lock:
+            if self._matrix is not None and self._matrix.shape[1] != row.shape[0]:
+                # Another embedding model: the stored embeddings can't be compared with the new ones
+                self._clear()
+            slot = self._slots.pop(key, None)
+            if slot is None:
+                if len(self._entries) < self.max_size:
+                    if self._matrix is None or len(self._entries) == self._matrix.shape[0]:
+                        self._grow(row.shape[0])
+                    slot = len(self._entries)
+                    self._entries.append((original_text, transformed_text))
+                else:
+                    _, slot = self._slots.popitem(last=False)
+                    self.evictions += 1
+            self._matrix[slot] = row
+            self._expires[slot] = expires_at
+            self._entries[slot] = (original_text, transformed_text)
+            self._slots[key] = slot
+
+
+    def _clear(self):
+        self._matrix = None
+        self._expires = np.zeros(0, dtype=np.float64)
+        self._entries = []
+        self._slots.clear()
+
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+    @property
+    def hits(self) -> int:
+        return self.hits_history + self.hits_corpus
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._slots),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "hits_history": self.hits_history,
+            "hits_corpus": self.hits_corpus,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+        }
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scale each row of a matrix to unit L2 norm (rows with norm 0 are left as they are).
+
+    Parameters:
+    -----------
+    matrix: np.ndarray
+        A 2D array with one vector per row.
+
+    Returns:
+    -----------
+    np.ndarray
+        A float32, C-contiguous array with the normalized rows.
+    """
+
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return the indices of the k largest scores, sorted from the highest to the lowest.
+    Only the k selected scores are sorted (argpartition), not the whole array.
+
+    Parameters:
+    -----------
+    scores: np.ndarray
+        A 1D array with the scores.
+    k: int
+        Number of indices to return.
+
+    Returns:
+    -----------
+    np.ndarray
+        The indices of the top k scores.
+    """
+
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < scores.shape[0]:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.shape[0])
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
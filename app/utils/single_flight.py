@@ -0,0 +1,69 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent computations: while a computation for a key is in flight,
+    callers with the same key wait for it instead of starting their own, and all receive its
+    result (or its exception).
+
+    The computation runs in its own task, so a caller that is cancelled (e.g. its client
+    disconnects) does not cancel it for the other callers.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+        self.calls = 0  # computations started
+        self.coalesced = 0  # callers served by a computation started by another caller
+
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        Return the result of `func()` for the key, sharing the computation in flight, if any.
+
+        Parameters:
+        -----------
+        key: Hashable
+            Identifies identical computations.
+        func: Callable[[], Awaitable[Any]]
+            Starts the computation (called only if none is in flight for the key).
+
+        Returns:
+        -----------
+        tuple
+            result: Any
+                The result of the computation.
+            shared: bool
+                True if the computation was started by another caller.
+        """
+
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+
+        return await asyncio.shield(task), shared
+
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Retrieve the exception: if all the callers were cancelled, nobody else would
+        # (and asyncio would log "Task exception was never retrieved")
+        if not task.cancelled():
+            task.exception()
+
+
+    def stats(self) -> dict:
+        requests = self.calls + self.coalesced
+        return {
+            "in_flight": len(self._in_flight),
+            "upstream_calls": self.calls,
+            "coalesced": self.coalesced,
+            "saved_ratio": self.coalesced / requests if requests else 0.0,
+        }
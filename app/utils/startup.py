@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from app.utils.example_index import RetrievalBackend, get_index_manager
+from app.utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Modules that are slow to import and not needed by the default request path (see `StartupTracker.status`)
+HEAVY_MODULES = ("sklearn", "scipy", "pandas", "tiktoken")
+
+
+class StartupTracker:
+    """
+    Duration of the phases of the startup (imports, warm-ups), and whether the app is ready to serve.
+
+    The warm-up phases are best effort: a failed phase is logged and reported, and only the failure
+    of a required phase (e.g. loading the example index) keeps the app from being ready.
+    """
+
+    def __init__(self, started: float | None = None):
+        """
+        Parameters:
+        -----------
+        started: float
+            time.perf_counter() when the startup began (default: now).
+        """
+
+        self.started = started if started is not None else time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.required_failed = False
+        self.ready = False
+        self.ready_after: float | None = None  # seconds from the start to ready
+
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = seconds
+
+
+    @contextmanager
+    def phase(self, name: str, required: bool = False):
+        """
+        Time a phase of the startup. Its errors are recorded instead of raised.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+            self.required_failed |= required
+            logger.warning("Startup phase %s failed: %s", name, e)
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+
+    def mark_ready(self):
+        self.ready = not self.required_failed
+        self.ready_after = time.perf_counter() - self.started
+        logger.info("Startup %s in %.2f s: %s", "ready" if self.ready else "failed", self.ready_after,
+                    ", ".join(f"{name} {1000 * seconds:.0f} ms" for name, seconds in self.phases.items()))
+
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "ready_after_ms": 1000 * self.ready_after if self.ready_after is not None else None,
+            "phases_ms": {name: 1000 * seconds for name, seconds in self.phases.items()},
+            "errors": self.errors,
+            "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+        }
+
+
+def warm_example_index(path: Path, backend: RetrievalBackend = RetrievalBackend.EXACT, nprobe: int | None = None) -> int:
+    """
+    Load the example index of a database and run one search on it, so that the first request finds
+    the matrix in memory and the BLAS routines initialized. Returns the number of examples.
+    """
+
+    index_manager = get_index_manager(path)
+    if not Path(path).exists():
+        raise FileNotFoundError(f"embedding database {path} does not exist")
+    index_manager.reload()
+    index = index_manager.index
+    index.search(np.ones(index.dim, dtype=np.float32), 5, backend, nprobe)
+    return len(index)
+
+
+def warm_tokenizers(models: list) -> None:
+    """
+    Load the tokenizers of the models (tiktoken downloads and parses its files on first use).
+    """
+
+    for model in dict.fromkeys(models):
+        count_tokens("warm up", model)
+
+
+async def warm_upstream(client: AsyncOpenAI, connections: int = 2, timeout: float = 5.0) -> None:
+    """
+    Open connections to the OpenAI API (DNS, TCP and TLS) in the pool of the client,
+    with cheap authenticated calls (GET /models), so the first requests reuse them.
+    """
+
+    await asyncio.wait_for(asyncio.gather(*(client.models.list() for _ in range(connections))), timeout)
@@ -0,0 +1,257 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+
+class MemoryBucketStore:
+    """
+    Keeps the state of the token buckets in process memory.
+    """
+
+    def __init__(self):
+        self._states: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+
+    def transact(self, key: str, initial: dict, update: Callable[[dict, float], tuple]):
+        """
+        Atomically read the state of a key, compute its new state with `update(state, now)`
+        (which returns (result, new_state)), save it and return the result.
+        """
+
+        with self._lock:
+            result, self._states[key] = update(self._states.get(key, initial), time.time())
+        return result
+
+
+class SQLiteBucketStore:
+    """
+    Keeps the state of the token buckets in a SQLite file, so that all the workers of a host
+    (e.g. `uvicorn --workers N`) share the same quota.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                key TEXT PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+
+
+    def transact(self, key: str, initial: dict, update: Callable[[dict, float], tuple]):
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock: the read-modify-write is atomic across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT requests, tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+                state = dict(zip(("requests", "tokens", "updated_at"), row)) if row is not None else initial
+                result, new_state = update(state, time.time())
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO token_buckets (key, requests, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                    (key, new_state["requests"], new_state["tokens"], new_state["updated_at"]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ModelRateLimiter:
+    """
+    Client-side rate limiter of a model, with a requests-per-minute and a tokens-per-minute token bucket.
+
+    A request waits until both buckets have enough capacity (one request, and its estimated tokens),
+    so requests are spread over the minute instead of being rejected with a 429.
+    Async waiters are served in arrival order. After the response, `reconcile` corrects the
+    tokens bucket with the actual usage.
+    """
+
+    def __init__(self, model: str, rpm: float, tpm: float, store: MemoryBucketStore | SQLiteBucketStore | None = None):
+        """
+        Parameters:
+        -----------
+        model: str
+            Name of the model (key of the buckets).
+        rpm: float
+            Requests per minute.
+        tpm: float
+            Tokens per minute.
+        store: MemoryBucketStore | SQLiteBucketStore | None
+            Where the state of the buckets is kept (default: process memory).
+        """
+
+        self.model = getattr(model, "value", model)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.store = store or MemoryBucketStore()
+        self._queue = asyncio.Lock()  # FIFO: waiters are woken in arrival order
+        self._thread_queue = threading.Lock()
+        self.acquired = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+
+    def _initial_state(self) -> dict:
+        return {"requests": float(self.rpm), "tokens": float(self.tpm), "updated_at": time.time()}
+
+
+    def _refill(self, state: dict, now: float) -> tuple[float, float]:
+        elapsed = max(0.0, now - state["updated_at"])
+        requests = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+        tokens = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+        return requests, tokens
+
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Take one request and `tokens` tokens if both are available.
+
+        Returns:
+        -----------
+        float
+            0 if the capacity was taken, otherwise the seconds to wait before it is available.
+        """
+
+        # A request larger than the bucket would never pass: let it through when the bucket is full
+        tokens = min(tokens, self.tpm)
+
+        def update(state, now):
+            requests, available = self._refill(state, now)
+            wait = max(
+                (1 - requests) * 60 / self.rpm,
+                (tokens - available) * 60 / self.tpm,
+                0.0)
+            if wait == 0:
+                requests -= 1
+                available -= tokens
+            return wait, {"requests": requests, "tokens": available, "updated_at": now}
+
+        return self.store.transact(self.model, self._initial_state(), update)
+
+
+    async def acquire(self, tokens: int):
+        """
+        Wait (without blocking the event loop) until a request with `tokens` tokens can be sent.
+        """
+
+        start = time.monotonic()
+        async with self._queue:
+            while (wait := await self._offload(self.try_acquire, tokens)) > 0:
+                await asyncio.sleep(wait)
+        self._record(start)
+
+
+    async def _offload(self, func: Callable, *args):
+        # The SQLite store may wait for the write lock held by another worker: off the event loop
+        if isinstance(self.store, SQLiteBucketStore):
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+
+    def acquire_sync(self, tokens: int):
+        """
+        Blocking version of `acquire`, for scripts.
+        """
+
+        start = time.monotonic()
+        with self._thread_queue:
+            while (wait := self.try_acquire(tokens)) > 0:
+                time.sleep(wait)
+        self._record(start)
+
+
+    def _record(self, start: float):
+        waited = time.monotonic() - start
+        self.acquired += 1
+        if waited > 0.001:
+            self.throttled += 1
+            self.waited_seconds += waited
+
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Give back (or take) the difference between the estimated and the actual tokens of a request.
+        """
+
+        difference = min(estimated_tokens, self.tpm) - actual_tokens
+        if difference == 0:
+            return
+
+        def update(state, now):
+            requests, available = self._refill(state, now)
+            return None, {"requests": requests, "tokens": min(self.tpm, available + difference), "updated_at": now}
+
+        self.store.transact(self.model, self._initial_state(), update)
+
+
+    async def areconcile(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Async version of `reconcile`, for the event loop.
+        """
+
+        await self._offload(self.reconcile, estimated_tokens, actual_tokens)
+
+
+    def stats(self) -> dict:
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "waited_seconds": round(self.waited_seconds, 3),
+        }
+
+
+class RateLimiterRegistry:
+    """
+    The process-wide rate limiters, one per model. Models without a configured limit are not limited.
+    """
+
+    def __init__(self):
+        self._limiters: dict[str, ModelRateLimiter] = {}
+        self.store: MemoryBucketStore | SQLiteBucketStore | None = None
+
+
+    def configure(self, limits: dict, path: Path | None = None):
+        """
+        Set up a rate limiter per model.
+
+        Parameters:
+        -----------
+        limits: dict
+            {model: {"rpm": ..., "tpm": ...}}, e.g. MODEL_RATE_LIMITS.
+        path: Path | None
+            SQLite file shared by the workers of the host (None: limits per process).
+        """
+
+        self.store = SQLiteBucketStore(path) if path is not None else MemoryBucketStore()
+        self._limiters = {
+            getattr(model, "value", model): ModelRateLimiter(model, limit["rpm"], limit["tpm"], self.store)
+            for model, limit in limits.items()
+        }
+
+
+    def get(self, model: str) -> ModelRateLimiter | None:
+        return self._limiters.get(getattr(model, "value", model))
+
+
+    def stats(self) -> dict:
+        return {model: limiter.stats() for model, limiter in self._limiters.items()}
+
+
+rate_limiters = RateLimiterRegistry()
@@ -0,0 +1,53 @@
+import math
+
+try:
+    import tiktoken
+except ImportError:  # in requirements.txt; without it, the tokens are estimated
+    tiktoken = None
+
+
+# Average number of characters per token of English text for the OpenAI tokenizers
+CHARS_PER_TOKEN = 4
+
+# Tokens added by the chat format to each message (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+
+def _get_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """
+    Count the tokens of a text: exactly with tiktoken if it is installed, otherwise estimated
+    from the number of characters.
+
+    Parameters:
+    -----------
+    text: str
+        The text.
+    model: str | None
+        Name of the OpenAI model (selects the tokenizer when tiktoken is installed).
+
+    Returns:
+    -----------
+    int
+        The number of tokens.
+    """
+
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_get_encoding(getattr(model, "value", model) or "gpt-4o-mini").encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def count_message_tokens(messages: list[dict], model: str | None = None) -> int:
+    """
+    Count the prompt tokens of a list of chat messages.
+    """
+
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["content"], model) for message in messages) + 3